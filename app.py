@@ -11,6 +11,9 @@ import io
 import json
 import base64
 from chat_storage import ChatSessionStorage
+from resilience import backend_stats
+from telemetry import aggregator as telemetry_aggregator
+from lab_pool import LabPoolTimeout
 import os
 import logging
 from typing import Dict, Any, Union, List
@@ -21,17 +24,25 @@ from flask_mail import Mail, Message
 from itsdangerous import URLSafeTimedSerializer
 
 from simulate_ai import (
-    get_chemistry_lab,
+    get_lab_pool,
+    CHAT_HISTORY_DIR,
+    get_rag_service,
     process_smiles,
     process_smiles_for_3d,
-    llava_call,
-    llava_config_list,
-    tavily_search,
     process_search_results,
-    is_valid_url,
+    search_cache,
+    image_analysis_cache,
+    tool_executor,
+    RequestContext,
+    MessageStream,
+    get_intent_classifier,
+    get_conversation_memory,
+    model_router,
+    completion_cache,
     MoleculeValidator
 )
 import random
+import threading
 import time
 # from concurrent.futures import ThreadPoolExecutor # 如果未使用，可以注释掉
 # from browser_automation import execute_chemical_purchase # 如果未使用，可以注释掉
@@ -75,7 +86,7 @@ class User(db.Model): # 定义用户模型
     def __repr__(self):
         return f'<User {self.username}>'
 
-chat_storage = ChatSessionStorage()
+chat_storage = ChatSessionStorage(CHAT_HISTORY_DIR)
 
 def create_app():
     app = Flask(__name__, static_folder='static', template_folder='templates')
@@ -134,11 +145,29 @@ def create_app():
 
     os.makedirs(os.path.join(app.static_folder, "screenshots"), exist_ok=True)
 
-    chemistry_lab = None
-    literature_path_nonlocal = {"path": ""} 
-    web_url_path_nonlocal = {"path": ""}    
+    # Load the embedding model and literature index off the request path
+    if os.environ.get('GVIM_RAG_WARMUP', 'True').lower() == 'true':
+        threading.Thread(target=get_rag_service().warmup, name="rag-warmup", daemon=True).start()
+
+    # Labs are built in the background and leased warm, one per in-flight request; the first is ready before the first message
+    lab_pool = get_lab_pool()
+    lab_pool.warm()
+    # Per-user literature collection and web URL; collections share one RAG service and embedding worker
+    user_settings: Dict[str, Dict[str, str]] = {}
+    user_settings_lock = threading.Lock()
+    # SocketIO connections per user, so streamed replies only go to the user's own browser
+    user_socket_ids: Dict[str, set] = {}
     molecule_validator = MoleculeValidator()
 
+    def get_user_settings() -> Dict[str, str]:
+        username = session.get('username', 'default')
+        with user_settings_lock:
+            return user_settings.setdefault(username, {
+                'literature_path': '',
+                'web_url_path': '',
+                'collection': f"user:{username}"
+            })
+
     # --- Authentication Routes (Using SQLAlchemy) ---
     @app.route('/register', methods=['GET', 'POST'])
     def register():
@@ -425,89 +454,96 @@ def create_app():
     def configure():
         if 'user_id' not in session:
             return jsonify({"error": "Authentication required"}), 401
-        nonlocal chemistry_lab 
         data = request.json
-        literature_path_nonlocal["path"] = data.get('literature_path', '')
-        web_url_path_nonlocal["path"] = data.get('web_url_path', '')
-        chemistry_lab = get_chemistry_lab(literature_path_nonlocal["path"])
-        logger.info(f"Configured with literature_path: {literature_path_nonlocal['path']}, web_url_path: {web_url_path_nonlocal['path']}")
-        return jsonify({'status': 'Configuration updated', 'literature_path': literature_path_nonlocal["path"]})
+        settings = get_user_settings()
+        settings['literature_path'] = data.get('literature_path', '')
+        settings['web_url_path'] = data.get('web_url_path', '')
+        if data.get('project'):
+            settings['collection'] = f"project:{data['project']}"
+        # Only the user's collection changes; the lab and other users' indexes are untouched
+        get_rag_service().configure_collection(settings['collection'], settings['literature_path'])
+        logger.info(f"Configured collection {settings['collection']} with literature_path: {settings['literature_path']}, web_url_path: {settings['web_url_path']}")
+        return jsonify({'status': 'Configuration updated', 'literature_path': settings['literature_path'], 'collection': settings['collection']})
 
     @app.route('/simulate', methods=['POST'])
     def simulate():
         if 'user_id' not in session:
             return jsonify([{'role': 'assistant', 'name': 'System', 'content': 'Authentication required. Please log in.'}]), 401
-        
-        # Get the chemistry lab instance
-        nonlocal chemistry_lab
-        if not chemistry_lab:
-            chemistry_lab = get_chemistry_lab(literature_path_nonlocal["path"])
+
+        request.start_time = time.time()
+        session_id_val = session.get('username', f"guest_{random.randint(1000,9999)}")
+        # Each request gets a lab of its own for its group chat, agent histories and evolution;
+        # when all labs are busy the request queues until one is released
+        try:
+            with lab_pool.lease(session_id=session_id_val) as chemistry_lab:
+                request.lab_wait = time.time() - request.start_time
+                return run_simulation(chemistry_lab, session_id_val)
+        except LabPoolTimeout as e:
+            logger.warning(f"Rejected request of {session_id_val}: {str(e)}")
+            return jsonify([{'role': 'assistant', 'name': 'System', 'content': 'The lab is busy with other requests. Please try again in a moment.'}]), 503
+
+    def run_simulation(chemistry_lab, session_id_val):
+        settings = get_user_settings()
 
         user_input_text = request.form.get('message', '')
         image_file_obj = request.files.get('image')
         new_literature_path_val = request.form.get('literature_path', '')
         new_web_url_path_val = request.form.get('web_url_path', '')
-        session_id_val = session.get('username', f"guest_{random.randint(1000,9999)}")
         
         logger.info(f"Received request - User input: {user_input_text[:50]}..., Literature path: {new_literature_path_val}, Web URL path: {new_web_url_path_val}, Session ID: {session_id_val}")
-        request.start_time = time.time()
 
-        # Update literature path if necessary
-        current_literature_path = literature_path_nonlocal["path"]
+        # Update the user's literature collection if necessary
+        current_literature_path = settings['literature_path']
         if new_literature_path_val and new_literature_path_val != current_literature_path:
-            logger.info(f"Updating literature path from {current_literature_path} to {new_literature_path_val}")
-            literature_path_nonlocal["path"] = new_literature_path_val
-            chemistry_lab = get_chemistry_lab(literature_path_nonlocal["path"])
+            logger.info(f"Updating literature path of {settings['collection']} from {current_literature_path} to {new_literature_path_val}")
+            settings['literature_path'] = new_literature_path_val
         
-        web_url_path_nonlocal["path"] = new_web_url_path_val
+        settings['web_url_path'] = new_web_url_path_val
         
         image_data_bytes = None
         image_data_b64_for_history = None
 
+        # Push agent messages and tokens to the requesting browser while the group chat runs
+        message_stream = None
+        socket_id = request.form.get('socket_id')
+        if socket_id:
+            with user_settings_lock:
+                owns_socket = socket_id in user_socket_ids.get(session.get('username', 'default'), set())
+            if owns_socket:
+                message_stream = MessageStream(
+                    lambda event, payload: socketio.emit(event, payload, to=socket_id),
+                    annotate=chemistry_lab.annotate_content
+                )
+
+        # One context per message: the lab fans out image analysis, search, RAG and intent
+        # detection concurrently and leaves the results here for the response and history
+        request_context = RequestContext()
         try:
-            search_results = []
-            llava_response = None
-            
-            # Process image if provided
             if image_file_obj:
-                try:
-                    image_data_bytes = image_file_obj.read()
-                    image_data_b64_for_history = base64.b64encode(image_data_bytes).decode('utf-8')
-                    logger.info(f"Image received: {image_file_obj.filename}, size: {len(image_data_bytes)} bytes")
-                    llava_response = llava_call(user_input_text, image_data_bytes, llava_config_list[0])
-                    logger.info(f"LLaVA Response: {llava_response}")
-                    combined_query = f"{user_input_text} {llava_response}"
-                    search_results = tavily_search(combined_query, url=web_url_path_nonlocal["path"]) if web_url_path_nonlocal["path"] and is_valid_url(web_url_path_nonlocal["path"]) else tavily_search(combined_query)
-                except Exception as e:
-                    logger.error(f"Error in image processing: {str(e)}")
-                    llava_response = f"Error processing image: {str(e)}"
-            else:
-                try:
-                    search_results = tavily_search(user_input_text, url=web_url_path_nonlocal["path"]) if web_url_path_nonlocal["path"] and is_valid_url(web_url_path_nonlocal["path"]) else tavily_search(user_input_text)
-                except Exception as e:
-                    logger.error(f"Error in web search: {str(e)}")
+                image_data_bytes = image_file_obj.read()
+                image_data_b64_for_history = base64.b64encode(image_data_bytes).decode('utf-8')
+                logger.info(f"Image received: {image_file_obj.filename}, size: {len(image_data_bytes)} bytes")
             
-            # RAG search if available
-            rag_results = None
-            if chemistry_lab and hasattr(chemistry_lab, 'db') and chemistry_lab.db:
-                try:
-                    # from simulate_ai import rag_search 
-                    # rag_results = rag_search(user_input_text, chemistry_lab.db) 
-                    logger.info("RAG search skipped (if rag_search not implemented or imported).")
-                    pass
-                except NameError:
-                    logger.warning("rag_search function not defined or imported.")
-                except Exception as e:
-                    logger.error(f"Error in RAG search: {str(e)}")
-
             # Process user input through chemistry lab
-            response_messages_list = chemistry_lab.process_user_input(
-                user_input_text,
-                image_data=image_data_bytes,
-                literature_path=literature_path_nonlocal["path"],
-                web_url_path=web_url_path_nonlocal["path"]
-            )
+            with request_context.activate():
+                response_messages_list = chemistry_lab.process_user_input(
+                    user_input_text,
+                    image_data=image_data_bytes,
+                    literature_path=settings['literature_path'],
+                    web_url_path=settings['web_url_path'],
+                    collection=settings['collection'],
+                    stream=message_stream,
+                    session_id=session_id_val
+                )
             
+            llava_response = request_context.prefetched.get('image_analysis')
+            search_results = request_context.prefetched.get('web_search')
+            if not isinstance(search_results, list):
+                search_results = []
+            rag_results = request_context.prefetched.get('rag')
+            if isinstance(rag_results, str) and rag_results.startswith(('Error', 'RAG search is not available')):
+                rag_results = None
+
             # Simulate for agent evolution
             chemistry_lab.simulate(1)
             
@@ -547,19 +583,28 @@ def create_app():
                 'session_id': session_id_val, 
                 'user_input': user_input_text,
                 'image_data': image_data_b64_for_history, 
-                'literature_path': literature_path_nonlocal["path"], 
-                'web_url_path': web_url_path_nonlocal["path"],
+                'literature_path': settings['literature_path'], 
+                'web_url_path': settings['web_url_path'],
                 'response': response_messages_list, 
                 'feedback': feedback_data,
                 'files': {
                     'image': bool(image_data_b64_for_history), 
-                    'literature': bool(literature_path_nonlocal["path"]), 
-                    'web_url': bool(web_url_path_nonlocal["path"])
+                    'literature': bool(settings['literature_path']), 
+                    'web_url': bool(settings['web_url_path'])
                 },
+                # Only this request's numbers; process-wide cache, backend and pool statistics are on /metrics
                 'performance_metrics': {
                     'response_time': time.time() - request.start_time if hasattr(request, 'start_time') else None,
                     'agent_updates': len(updated_agents_list),
-                    'search_results_count': len(search_results) if search_results else 0
+                    'search_results_count': len(search_results) if search_results else 0,
+                    'external_calls': request_context.stats(),
+                    'prefetch_timings': request_context.prefetch_timings,
+                    'intent': request_context.prefetched.get('intent'),
+                    'chat': request_context.chat_report,
+                    'stages': request_context.stage_report,
+                    'telemetry': request_context.telemetry.summary(),
+                    'lab_wait': round(request.lab_wait, 3),
+                    'time_to_first_output': message_stream.time_to_first_output() if message_stream else None
                 }
             }
             
@@ -580,14 +625,14 @@ def create_app():
                 'session_id': session_id_val, 
                 'user_input': user_input_text,
                 'image_data': image_data_b64_for_history, 
-                'literature_path': literature_path_nonlocal["path"], 
-                'web_url_path': web_url_path_nonlocal["path"],
+                'literature_path': settings['literature_path'], 
+                'web_url_path': settings['web_url_path'],
                 'response': error_response_msg, 
                 'feedback': {},
                 'files': {
                     'image': bool(image_data_b64_for_history), 
-                    'literature': bool(literature_path_nonlocal["path"]), 
-                    'web_url': bool(web_url_path_nonlocal["path"])
+                    'literature': bool(settings['literature_path']), 
+                    'web_url': bool(settings['web_url_path'])
                 },
                 'error': {'message': str(e), 'traceback': traceback.format_exc()}
             }
@@ -620,8 +665,8 @@ def create_app():
     def initialize_chat():
         if 'user_id' not in session:
             return jsonify({'status': 'Authentication required'}), 401
-        nonlocal chemistry_lab
-        chemistry_lab = get_chemistry_lab(literature_path_nonlocal["path"]) 
+        # Requests lease their own lab and return it reset; only make sure warm ones are ready
+        lab_pool.warm()
         return jsonify({'status': 'Chemistry Lab initialized successfully'})
 
     @app.route('/feedback', methods=['POST'])
@@ -646,6 +691,29 @@ def create_app():
             logger.error(f"Error processing feedback: {str(e)}")
             return jsonify({'error': str(e)}), 400
 
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        if 'user_id' not in session:
+            return jsonify({'error': 'Authentication required'}), 401
+        try:
+            return jsonify({
+                'telemetry': telemetry_aggregator.snapshot(),
+                'backends': backend_stats(),
+                'model_endpoints': model_router.stats(),
+                'completion_cache': completion_cache.metrics() if completion_cache else None,
+                'rag_cache': {'answers': get_rag_service().answer_cache.metrics(),
+                              'contexts': get_rag_service().context_cache.metrics()},
+                'search_cache': search_cache.metrics(),
+                'image_cache': image_analysis_cache.metrics(),
+                'tool_calls': tool_executor.stats(),
+                'intent_classifier': get_intent_classifier().stats(),
+                'lab_pool': lab_pool.stats(),
+                'conversation_memory': get_conversation_memory().stats()
+            })
+        except Exception as e:
+            logger.error(f"Error collecting metrics: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+
     @app.route('/history', methods=['GET'])
     def history():
         if 'user_id' not in session:
@@ -772,11 +840,15 @@ def create_app():
             logger.info('Unauthenticated client tried to connect via WebSocket.')
         else:
             logger.info(f'Client {session.get("username", "Unknown")} (ID: {session["user_id"]}) connected via WebSocket.')
+            with user_settings_lock:
+                user_socket_ids.setdefault(session.get('username', 'default'), set()).add(request.sid)
 
     @socketio.on('disconnect')
     def handle_disconnect():
         username = session.get("username", "Unknown client")
         user_id = session.get("user_id", "Unknown ID")
+        with user_settings_lock:
+            user_socket_ids.get(session.get('username', 'default'), set()).discard(request.sid)
         logger.info(f'Client {username} (ID: {user_id}) disconnected from WebSocket.')
 
     return app, socketio
@@ -0,0 +1,154 @@
+"""
+Repeatable benchmark of the /simulate path from recorded external traffic.
+
+First record a cassette against the real services (or the fakes from
+fake_services.py):
+
+    python benchmark_simulate.py --mode record --cassette instance/cassettes/bench.json
+
+then time our own code against it, with external calls answered instantly
+(--latency-scale 0) or with their recorded latency (--latency-scale 1):
+
+    python benchmark_simulate.py --mode replay --cassette instance/cassettes/bench.json --repeat 5
+
+Result caches are bypassed and random seeds fixed, so every run sends the
+same requests. --profile prints the functions where the time went (SMILES
+processing, chat storage, evolution statistics, JSON serialization, ...).
+"""
+import argparse
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import time
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROMPTS = [
+    "What is the molecular weight of aspirin, SMILES CC(=O)OC1=CC=CC=C1C(=O)O?",
+    "Suggest a synthesis route for paracetamol and the safety precautions for each step.",
+    "Compare the acidity of phenol (c1ccc(cc1)O) and ethanol (CCO).",
+]
+
+
+def configure_environment(args: argparse.Namespace, scratch: str) -> None:
+    """Cassette settings and cache bypasses; must run before the app is imported"""
+    os.environ["GVIM_CASSETTE_MODE"] = args.mode
+    os.environ["GVIM_CASSETTE_PATH"] = args.cassette
+    os.environ["GVIM_CASSETTE_LATENCY_SCALE"] = str(args.latency_scale)
+    # Loose matching hands a changed request whatever was recorded next for its URL, which depends on timing
+    os.environ["GVIM_CASSETTE_STRICT"] = str(not args.loose)
+    # Every run must send the same requests: no answers from earlier runs or iterations
+    os.environ["GVIM_COMPLETION_CACHE"] = "False"
+    os.environ["GVIM_SEARCH_CACHE_DIR"] = os.path.join(scratch, "search_cache")
+    os.environ["GVIM_SEARCH_CACHE_TTL"] = "0"
+    os.environ["GVIM_SEARCH_CACHE_STALE_TTL"] = "0"
+    os.environ["GVIM_IMAGE_CACHE_DIR"] = os.path.join(scratch, "image_cache")
+    os.environ["GVIM_IMAGE_CACHE_TTL"] = "0"
+    os.environ["GVIM_RAG_CACHE_TTL"] = "0"
+    # Stored history would add conversation context that was not there at record time, and the
+    # benchmark must not write into the production chat history or intent labels
+    os.environ["GVIM_CHAT_HISTORY_DIR"] = os.path.join(scratch, "chat_history")
+    os.environ["GVIM_INTENT_LABELS_PATH"] = os.path.join(scratch, "intent_labels.jsonl")
+    # Background summaries would make the order of LLM requests depend on timing
+    os.environ["GVIM_MEMORY_LLM_SUMMARY"] = "False"
+    # Latency-based routing would send the same prompt to a different model than at record time,
+    # and sampled intent audits add LLM requests on a background thread
+    os.environ["GVIM_MODEL_ROUTING"] = "False"
+    os.environ["GVIM_INTENT_AUDIT_RATE"] = "0"
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    from app import create_app
+    import cassettes
+
+    app, _ = create_app()
+    app.config["TESTING"] = True
+    client = app.test_client()
+
+    prompts = DEFAULT_PROMPTS
+    if args.prompts:
+        with open(args.prompts, "r", encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()]
+
+    profiler = cProfile.Profile() if args.profile else None
+    timings: List[float] = []
+    failures = 0
+    for iteration in range(args.repeat):
+        random.seed(args.seed)
+        # A fresh session per pass: every pass sees the conversation history the recorded pass saw
+        with client.session_transaction() as session:
+            session["user_id"] = 0
+            session["username"] = f"benchmark-{iteration}"
+        for prompt in prompts:
+            start = time.perf_counter()
+            if profiler:
+                profiler.enable()
+            response = client.post("/simulate", data={"message": prompt})
+            if profiler:
+                profiler.disable()
+            elapsed = time.perf_counter() - start
+            timings.append(elapsed)
+            if response.status_code != 200:
+                failures += 1
+                logger.warning(f"/simulate returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+            print(f"[{iteration + 1}/{args.repeat}] {elapsed:7.3f}s  {prompt[:60]}")
+        if args.mode == "record":
+            # One pass is enough to record; further passes would only append duplicates
+            break
+
+    cassette = cassettes.active_cassette()
+    result = {
+        "mode": args.mode,
+        "latency_scale": args.latency_scale,
+        "requests": len(timings),
+        "failures": failures,
+        "mean": round(sum(timings) / len(timings), 4),
+        "p50": round(percentile(timings, 0.5), 4),
+        "p95": round(percentile(timings, 0.95), 4),
+        "cassette": cassette.stats() if cassette else None,
+    }
+    cassettes.uninstall()
+    if profiler:
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(args.profile)
+        print(output.getvalue())
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark /simulate against recorded external traffic")
+    parser.add_argument("--mode", choices=["record", "replay"], default="replay")
+    parser.add_argument("--cassette", default=os.path.join("instance", "cassettes", "simulate.json"))
+    parser.add_argument("--latency-scale", type=float, default=0.0, help="Replay delay as a multiple of the recorded latency")
+    parser.add_argument("--prompts", help="File with one prompt per line")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--loose", action="store_true",
+                        help="Answer requests whose body changed with the next response recorded for the same URL")
+    parser.add_argument("--profile", type=int, default=0, help="Print the N functions with the most cumulative time")
+    parser.add_argument("--output", help="Write the summary as JSON to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    with tempfile.TemporaryDirectory() as scratch:
+        configure_environment(args, scratch)
+        result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+Record/replay of external HTTP traffic for reproducible pipeline runs.
+
+In record mode every request the app sends through httpx (OpenAI and
+LangChain models, Replicate) or requests (Tavily) is passed to the real
+service and the response is stored in a JSON cassette together with its
+latency. In replay mode the same requests are answered from the cassette
+without touching the network, after the recorded latency multiplied by
+`latency_scale` (0 serves instantly, which leaves only our own overhead in
+a /simulate timing).
+
+Requests are matched by method, URL and JSON body (keys sorted, secrets
+removed); identical requests are answered with their recorded responses in
+order. A request that was not recorded fails the replay; with strict=False
+a request whose body changed (a timestamp in a prompt, say) gets the next
+unused response recorded for the same method and URL instead, which is
+only deterministic when requests are sent in the recorded order. Hosts in `ignore_hosts` (model downloads, telemetry)
+bypass the cassette. Enable with GVIM_CASSETTE_MODE=record|replay and
+GVIM_CASSETTE_PATH, see simulate_ai.py.
+"""
+import atexit
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import httpx
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Request fields that carry credentials; they are neither stored nor part of the match key
+SECRET_FIELDS = {"api_key", "apikey", "key", "token", "access_token"}
+# Response headers worth keeping (content negotiation and rate limits)
+KEPT_HEADERS = ("content-type", "retry-after")
+KEPT_HEADER_PREFIXES = ("x-ratelimit-",)
+DEFAULT_IGNORE_HOSTS = ("huggingface.co", "hf.co", "posthog.com")
+# Response headers describing the wire encoding of a body that is stored decoded
+WIRE_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+
+class CassetteMiss(Exception):
+    """Raised in replay mode for a request that was not recorded"""
+
+
+def _scrub(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {key: _scrub(item) for key, item in value.items() if key.lower() not in SECRET_FIELDS}
+    if isinstance(value, list):
+        return [_scrub(item) for item in value]
+    return value
+
+
+def _normalize_url(url: str) -> str:
+    parts = urlsplit(url)
+    query = urlencode(sorted((key, value) for key, value in parse_qsl(parts.query) if key.lower() not in SECRET_FIELDS))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path.rstrip("/"), query, ""))
+
+
+def _normalize_body(body: Optional[bytes]) -> str:
+    if not body:
+        return ""
+    try:
+        return json.dumps(_scrub(json.loads(body)), sort_keys=True, ensure_ascii=False)
+    except (ValueError, UnicodeDecodeError):
+        return "sha256:" + hashlib.sha256(body).hexdigest()
+
+
+def _encode_body(body: bytes) -> Dict[str, str]:
+    try:
+        return {"text": body.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"base64": base64.b64encode(body).decode("ascii")}
+
+
+def _decode_body(stored: Dict[str, str]) -> bytes:
+    if "base64" in stored:
+        return base64.b64decode(stored["base64"])
+    return stored.get("text", "").encode("utf-8")
+
+
+class Cassette:
+    """Recorded request/response pairs of one run, stored as a JSON file"""
+
+    def __init__(self, path: str, mode: str = "replay", latency_scale: float = 1.0,
+                 ignore_hosts: Iterable[str] = DEFAULT_IGNORE_HOSTS, strict: bool = True):
+        """
+        Args:
+            path (str): Cassette file
+            mode (str): "record" (call the services and store responses) or "replay" (serve stored responses)
+            latency_scale (float): Replay delay as a multiple of the recorded latency; 0 answers instantly
+            ignore_hosts: Host suffixes whose requests bypass the cassette in both modes
+            strict (bool): Fail on any request not recorded with exactly the same body (the default)
+        """
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.strict = strict
+        self.ignore_hosts = tuple(host.strip().lower() for host in ignore_hosts if host.strip())
+        self._lock = threading.Lock()
+        self._interactions: List[Dict[str, Any]] = []
+        self._by_key: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._by_endpoint: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._cursor: Dict[str, int] = defaultdict(int)
+        self._used = set()
+        self._stats = {"recorded": 0, "replayed": 0, "loose_matches": 0, "misses": 0, "bypassed": 0}
+        if mode == "replay":
+            self.load()
+
+    def load(self) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            interactions = json.load(f)["interactions"]
+        with self._lock:
+            self._interactions = interactions
+            self._by_key.clear()
+            self._by_endpoint.clear()
+            self._cursor.clear()
+            self._used.clear()
+            for interaction in interactions:
+                self._by_key[interaction["key"]].append(interaction)
+                self._by_endpoint[self._endpoint(interaction["request"]["method"], interaction["request"]["url"])].append(interaction)
+        logger.info(f"Loaded {len(interactions)} interactions from cassette {self.path}")
+
+    def save(self) -> None:
+        with self._lock:
+            interactions = list(self._interactions)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "interactions": interactions}, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, self.path)
+        logger.info(f"Saved {len(interactions)} interactions to cassette {self.path}")
+
+    def bypass(self, url: str) -> bool:
+        host = (urlsplit(url).hostname or "").lower()
+        if any(host == ignored or host.endswith("." + ignored) for ignored in self.ignore_hosts):
+            with self._lock:
+                self._stats["bypassed"] += 1
+            return True
+        return False
+
+    @staticmethod
+    def _endpoint(method: str, url: str) -> str:
+        return f"{method.upper()} {_normalize_url(url)}"
+
+    @staticmethod
+    def key(method: str, url: str, body: Optional[bytes]) -> Tuple[str, str]:
+        """(match key, normalized request) of a request"""
+        normalized = f"{method.upper()} {_normalize_url(url)}\n{_normalize_body(body)}"
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest(), normalized
+
+    def record(self, method: str, url: str, body: Optional[bytes], status: int, headers: Dict[str, str],
+               content: bytes, elapsed: float) -> None:
+        key, normalized = self.key(method, url, body)
+        kept = {
+            name.lower(): value for name, value in headers.items()
+            if name.lower() in KEPT_HEADERS or name.lower().startswith(KEPT_HEADER_PREFIXES)
+        }
+        interaction = {
+            "key": key,
+            "request": {"method": method.upper(), "url": _normalize_url(url), "body": normalized.split("\n", 1)[1][:2000]},
+            "response": dict(status=status, headers=kept, **_encode_body(content)),
+            "elapsed": round(elapsed, 4)
+        }
+        with self._lock:
+            self._interactions.append(interaction)
+            self._by_key[key].append(interaction)
+            self._by_endpoint[self._endpoint(method, url)].append(interaction)
+            self._stats["recorded"] += 1
+
+    def replay(self, method: str, url: str, body: Optional[bytes]) -> Tuple[int, Dict[str, str], bytes]:
+        """Recorded (status, headers, content) for the request, after the scaled recorded latency"""
+        key, _ = self.key(method, url, body)
+        endpoint = self._endpoint(method, url)
+        with self._lock:
+            candidates = self._by_key.get(key)
+            if candidates:
+                # Repeated identical requests get the recorded responses in order, then the last one again
+                interaction = candidates[min(self._cursor[key], len(candidates) - 1)]
+                self._cursor[key] += 1
+            else:
+                unused = [] if self.strict else [i for i in self._by_endpoint.get(endpoint, ()) if id(i) not in self._used]
+                if not unused:
+                    self._stats["misses"] += 1
+                    raise CassetteMiss(f"No recorded response for {endpoint}")
+                interaction = unused[0]
+                self._stats["loose_matches"] += 1
+                logger.debug(f"Request body for {endpoint} not recorded, serving the next response of that endpoint")
+            self._used.add(id(interaction))
+            self._stats["replayed"] += 1
+        if self.latency_scale > 0:
+            time.sleep(interaction["elapsed"] * self.latency_scale)
+        response = interaction["response"]
+        return response["status"], response["headers"], _decode_body(response)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, interactions=len(self._interactions), mode=self.mode)
+
+
+_active: Optional[Cassette] = None
+_original_httpx_send = httpx.HTTPTransport.handle_request
+_original_requests_send = requests.adapters.HTTPAdapter.send
+
+
+def _httpx_handle_request(transport: httpx.HTTPTransport, request: httpx.Request) -> httpx.Response:
+    cassette = _active
+    if cassette is None or cassette.bypass(str(request.url)):
+        return _original_httpx_send(transport, request)
+    body = request.read()
+    if cassette.mode == "replay":
+        status, headers, content = cassette.replay(request.method, str(request.url), body)
+        return httpx.Response(status, headers=headers, content=content, request=request)
+    start = time.perf_counter()
+    response = _original_httpx_send(transport, request)
+    # Streamed responses (server-sent events) are buffered; they replay as one body
+    try:
+        content = response.read()
+    finally:
+        response.close()
+    cassette.record(request.method, str(request.url), body, response.status_code, dict(response.headers), content,
+                    time.perf_counter() - start)
+    headers = [(name, value) for name, value in response.headers.items() if name.lower() not in WIRE_HEADERS]
+    return httpx.Response(response.status_code, headers=headers, content=content, request=request)
+
+
+def _requests_send(adapter: requests.adapters.HTTPAdapter, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+    cassette = _active
+    if cassette is None or cassette.bypass(request.url):
+        return _original_requests_send(adapter, request, **kwargs)
+    body = request.body.encode("utf-8") if isinstance(request.body, str) else request.body
+    if cassette.mode == "replay":
+        status, headers, content = cassette.replay(request.method, request.url, body)
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response._content = content
+        response.url = request.url
+        response.request = request
+        return response
+    start = time.perf_counter()
+    response = _original_requests_send(adapter, request, **kwargs)
+    cassette.record(request.method, request.url, body, response.status_code, dict(response.headers), response.content,
+                    time.perf_counter() - start)
+    return response
+
+
+def install(cassette: Cassette) -> Cassette:
+    """Route httpx and requests traffic of the whole process through the cassette"""
+    global _active
+    _active = cassette
+    httpx.HTTPTransport.handle_request = _httpx_handle_request
+    requests.adapters.HTTPAdapter.send = _requests_send
+    if cassette.mode == "record":
+        atexit.register(cassette.save)
+    logger.info(f"Cassette {cassette.path} installed in {cassette.mode} mode")
+    return cassette
+
+
+def uninstall() -> None:
+    """Restore the original transports; a recording cassette is saved first"""
+    global _active
+    cassette, _active = _active, None
+    httpx.HTTPTransport.handle_request = _original_httpx_send
+    requests.adapters.HTTPAdapter.send = _original_requests_send
+    if cassette is not None and cassette.mode == "record":
+        cassette.save()
+
+
+def active_cassette() -> Optional[Cassette]:
+    return _active
@@ -0,0 +1,121 @@
+"""
+Adaptive round budget and early termination for the group chat.
+
+AdaptiveChatController wraps the group chat's speaker selection. Before each
+selection it checks the request's round, token and time budgets and whether
+the answer has converged (the latest agent message adds few new terms and no
+tool call is pending). When a check fires it returns None, which makes
+autogen end the chat, and records why.
+"""
+import logging
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Union
+
+from autogen import Agent, GroupChat
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"[a-z0-9][a-z0-9\-\(\)=#\[\]@+]*", re.IGNORECASE)
+
+
+def content_terms(text: str) -> Set[str]:
+    """Lower-cased terms of at least 4 characters (SMILES kept whole)"""
+    return {term.lower() for term in _WORD.findall(text or "") if len(term) >= 4}
+
+
+class AdaptiveChatController:
+    """Per-request round, token and time budgets plus a novelty-based convergence check"""
+
+    def __init__(self, token_budget: int = 6000, time_budget: float = 90.0, novelty_threshold: float = 0.25,
+                 min_rounds: int = 2, max_rounds: int = 12, count_tokens: Optional[Callable[[str], int]] = None,
+                 padding_replies: Optional[List[str]] = None, proxy_name: str = "User_Proxy"):
+        """
+        Args:
+            token_budget (int): Tokens of agent messages after which the chat ends
+            time_budget (float): Seconds after which the chat ends
+            novelty_threshold (float): Share of new terms below which an answer counts as converged
+            min_rounds (int): Agent messages before convergence may end the chat
+            max_rounds (int): Upper bound for any round budget
+            count_tokens: Token counter, defaults to ~4 characters per token
+            padding_replies: Automatic user proxy replies that only ask the agents to keep going
+            proxy_name (str): Name of the user proxy agent
+        """
+        self.token_budget = token_budget
+        self.time_budget = time_budget
+        self.novelty_threshold = novelty_threshold
+        self.min_rounds = min_rounds
+        self.max_rounds = max_rounds
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4)
+        self.padding_replies = {reply.strip() for reply in padding_replies or []}
+        self.proxy_name = proxy_name
+        self.begin_request(0)
+
+    def begin_request(self, start_index: int, round_budget: Optional[int] = None, time_budget: Optional[float] = None) -> None:
+        """Start budgets for a request whose messages begin at groupchat.messages[start_index]"""
+        self.start_index = start_index
+        self.round_budget = min(round_budget or self.max_rounds, self.max_rounds)
+        self.request_time_budget = min(time_budget or self.time_budget, self.time_budget)
+        self.started_at = time.time()
+        self.stop_reason: Optional[str] = None
+        self.rounds = 0
+        self.tokens = 0
+        self.last_novelty: Optional[float] = None
+        self._counted = start_index
+        self._seen_terms: Set[str] = set()
+
+    def _update(self, messages: List[Dict[str, Any]]) -> None:
+        for message in messages[self._counted:]:
+            content = message.get("content")
+            if message.get("name") == self.proxy_name or not isinstance(content, str):
+                continue
+            self.rounds += 1
+            self.tokens += self.count_tokens(content)
+            if message.get("role") == "tool" or message.get("tool_responses"):
+                self._seen_terms |= content_terms(content)
+                continue
+            terms = content_terms(content)
+            self.last_novelty = len(terms - self._seen_terms) / len(terms) if terms else 0.0
+            self._seen_terms |= terms
+        self._counted = len(messages)
+
+    def check(self, groupchat: GroupChat) -> Optional[str]:
+        """Return the reason to end the chat now, or None to continue"""
+        messages = groupchat.messages
+        self._update(messages)
+        last = messages[-1] if len(messages) > self.start_index else {}
+        # Never stop while a tool call is pending or its result has not been read by an agent
+        if last.get("tool_calls") or last.get("function_call") or last.get("role") == "tool" or last.get("tool_responses"):
+            return None
+        if self.rounds >= self.round_budget:
+            return "round_budget"
+        if self.tokens >= self.token_budget:
+            return "token_budget"
+        if time.time() - self.started_at >= self.request_time_budget:
+            return "time_budget"
+        if last.get("name") == self.proxy_name and (last.get("content") or "").strip() in self.padding_replies and self.rounds >= 1:
+            return "answer_complete"
+        if self.rounds >= self.min_rounds and self.last_novelty is not None and self.last_novelty < self.novelty_threshold:
+            return "converged"
+        return None
+
+    def wrap(self, selector: Optional[Callable[[Agent, GroupChat], Union[Agent, str, None]]] = None):
+        """Speaker selection callable that ends the chat when check() fires, else defers to selector ("auto" if None)"""
+        def select(last_speaker: Agent, groupchat: GroupChat) -> Union[Agent, str, None]:
+            reason = self.check(groupchat)
+            if reason:
+                self.stop_reason = reason
+                logger.info(f"Ending group chat early ({reason}) after {self.rounds} rounds, {self.tokens} tokens")
+                return None
+            return selector(last_speaker, groupchat) if selector else "auto"
+        return select
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "stop_reason": self.stop_reason or "terminated_or_max_round",
+            "rounds": self.rounds,
+            "round_budget": self.round_budget,
+            "tokens": self.tokens,
+            "elapsed": round(time.time() - self.started_at, 3),
+            "last_novelty": round(self.last_novelty, 3) if self.last_novelty is not None else None
+        }
@@ -2,7 +2,9 @@ import json
 import os
 from datetime import datetime, timezone
 import logging
-from typing import Dict, List, Any, Optional
+from typing import Callable, Dict, List, Any, Optional
+
+import numpy as np
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,24 +23,33 @@ class ChatSessionStorage:
         self.ensure_storage_dir()
         self.chat_sessions = self.load_sessions()
     
-    def analyze_feedback_trends(self) -> Dict[str, Any]:
+    def analyze_feedback_trends(self, extract_topic: Callable[[str], str]) -> Dict[str, Any]:
+        """
+        Ratings per agent, per topic and per topic and agent from the stored feedback
+
+        Args:
+            extract_topic: Maps a user message to its topic
+        """
         feedback_analysis = {
             'agent_ratings': {},
             'topic_ratings': {},
+            'topic_agent_ratings': {},
             'improvement_areas': []
         }
         
         for session in self.chat_sessions['session_history']:
-            if 'feedback' in session:
-                for agent, rating in session.get('feedback', {}).items():
-                    if agent not in feedback_analysis['agent_ratings']:
-                        feedback_analysis['agent_ratings'][agent] = []
-                    feedback_analysis['agent_ratings'][agent].append(rating)
-                
-                topic = self.extract_topic(session['user_input'])
-                if topic not in feedback_analysis['topic_ratings']:
-                    feedback_analysis['topic_ratings'][topic] = []
-                feedback_analysis['topic_ratings'][topic].extend(session['feedback'].values())
+            feedback = session.get('feedback') or {}
+            if not feedback:
+                continue
+            topic = extract_topic(session.get('user_input', ''))
+            for agent, value in feedback.items():
+                # Ratings are stored either bare or as {'rating': ..., 'timestamp': ...}
+                rating = value.get('rating') if isinstance(value, dict) else value
+                if not isinstance(rating, (int, float)):
+                    continue
+                feedback_analysis['agent_ratings'].setdefault(agent, []).append(rating)
+                feedback_analysis['topic_ratings'].setdefault(topic, []).append(rating)
+                feedback_analysis['topic_agent_ratings'].setdefault(topic, {}).setdefault(agent, []).append(rating)
     
         for agent, ratings in feedback_analysis['agent_ratings'].items():
             if len(ratings) >= 2:
@@ -0,0 +1,131 @@
+"""
+Persistent, size-bounded LLM completion cache.
+
+One diskcache directory is shared by every process on the host and survives
+restarts. CompletionCache implements autogen's AbstractCache so it can be
+passed as ``cache=`` to initiate_chat (GroupChatManager.run_chat hands it to
+every agent), and LangChainCompletionCache adapts it for ChatOpenAI models.
+Keys are hashes of the model, messages and sampling parameters, built by
+autogen and LangChain respectively. Hits and misses are counted per caller:
+agent hooks set the caller with ``set_llm_caller`` before each reply, inside
+an ``llm_caller`` block that restores the previous caller when the request
+ends, so a name never carries over to the next task of a pooled thread.
+"""
+import contextvars
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+import diskcache
+from autogen.cache.abstract_cache_base import AbstractCache
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+from result_cache import make_cache_key
+
+logger = logging.getLogger(__name__)
+
+_current_llm_caller = contextvars.ContextVar("llm_caller", default="chat_manager")
+
+
+def set_llm_caller(name: str) -> contextvars.Token:
+    """Attribute the following completions of this context to name; the token undoes it"""
+    return _current_llm_caller.set(name)
+
+
+@contextmanager
+def llm_caller(name: str) -> Iterator[None]:
+    """Attribute completions to name inside the block, restoring the previous caller afterwards"""
+    token = set_llm_caller(name)
+    try:
+        yield
+    finally:
+        _current_llm_caller.reset(token)
+
+
+class CompletionCache(AbstractCache):
+    """autogen cache backed by a size-bounded diskcache, with per-caller hit statistics"""
+
+    def __init__(self, directory: str, size_limit: int = 512 * 1024 * 1024):
+        """
+        Args:
+            directory (str): Cache directory, shared by all processes using it
+            size_limit (int): Maximum cache size on disk in bytes (LRU eviction)
+        """
+        self._cache = diskcache.Cache(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0, "stores": 0})
+
+    def _count(self, stat: str, caller: Optional[str] = None) -> None:
+        with self._lock:
+            self._stats[caller or _current_llm_caller.get()][stat] += 1
+
+    def get(self, key: str, default: Optional[Any] = None, caller: Optional[str] = None) -> Optional[Any]:
+        value = self._cache.get(key, default)
+        self._count("misses" if value is default else "hits", caller)
+        return value
+
+    def set(self, key: str, value: Any, caller: Optional[str] = None) -> None:
+        try:
+            self._cache.set(key, value)
+            self._count("stores", caller)
+        except Exception as e:
+            # A completion that cannot be pickled is simply not cached
+            logger.warning(f"Could not cache completion: {str(e)}")
+
+    def close(self) -> None:
+        # autogen enters and exits the cache around every call; the connection stays open for reuse
+        pass
+
+    def __enter__(self) -> "CompletionCache":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            callers = {name: dict(stats) for name, stats in self._stats.items()}
+        for stats in callers.values():
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        hits = sum(stats["hits"] for stats in callers.values())
+        lookups = hits + sum(stats["misses"] for stats in callers.values())
+        return {
+            "callers": callers,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self._cache),
+            "size_bytes": self._cache.volume()
+        }
+
+
+class LangChainCompletionCache(BaseCache):
+    """LangChain cache for one model, stored in a shared CompletionCache under the given caller name"""
+
+    def __init__(self, cache: CompletionCache, caller: str):
+        self.cache = cache
+        self.caller = caller
+
+    def _key(self, prompt: str, llm_string: str) -> str:
+        return make_cache_key("langchain", prompt, llm_string)
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Any]]:
+        value = self.cache.get(self._key(prompt, llm_string), caller=self.caller)
+        if value is None:
+            return None
+        try:
+            return loads(value)
+        except Exception as e:
+            logger.warning(f"Discarding unreadable cached completion: {str(e)}")
+            return None
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Any]) -> None:
+        self.cache.set(self._key(prompt, llm_string), dumps(list(return_val)), caller=self.caller)
+
+    def clear(self, **kwargs: Any) -> None:
+        self.cache.clear()
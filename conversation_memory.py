@@ -0,0 +1,236 @@
+"""
+Bounded per-session conversation memory for the group chat.
+
+The group chat and its agents are reset before every request, so the only
+history a prompt carries is what ConversationMemory hands over: a rolling
+summary of older turns plus a sliding window of the most recent ones, both
+capped in tokens. Turns that leave the window are folded into the summary
+in the background; summaries are cached by content hash, so the same
+history is never summarized twice.
+"""
+import hashlib
+import logging
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """Update the running summary of a conversation between a user and a team of chemistry lab agents.
+Keep the facts, molecules, decisions and open questions that later questions may refer to. Answer with the summary only.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}"""
+
+
+def reset_chat_state(groupchat: Any, agents: Iterable[Any]) -> None:
+    """
+    Drop the messages of the previous request from the group chat and every agent
+
+    Only the histories and auto-reply counters are cleared; agent.reset() would also
+    replace reply function configs (for the manager: a copy of the group chat).
+    """
+    if groupchat is not None:
+        groupchat.reset()
+    for agent in agents:
+        if agent is None:
+            continue
+        agent.clear_history()
+        agent.reset_consecutive_auto_reply_counter()
+
+
+class ConversationMemory:
+    """Sliding window of recent turns plus a rolling summary, per session"""
+
+    def __init__(self, window_turns: int = 4, window_tokens: int = 1200, summary_tokens: int = 400,
+                 max_turn_tokens: int = 400, summarize: Optional[Callable[[str], str]] = None,
+                 count_tokens: Optional[Callable[[str], int]] = None, max_sessions: int = 1000,
+                 summary_cache_size: int = 1000):
+        """
+        Args:
+            window_turns (int): Recent turns kept verbatim
+            window_tokens (int): Token cap of the recent turns in a prompt
+            summary_tokens (int): Token cap of the rolling summary
+            max_turn_tokens (int): Token cap of a single stored turn (user message or answer)
+            summarize: LLM call turning a prompt into a summary; without it older turns are condensed extractively
+            count_tokens: Token counter, defaults to ~4 characters per token
+            max_sessions (int): Sessions kept in memory (least recently used are dropped)
+            summary_cache_size (int): Summaries kept by content hash
+        """
+        self.window_turns = window_turns
+        self.window_tokens = window_tokens
+        self.summary_tokens = summary_tokens
+        self.max_turn_tokens = max_turn_tokens
+        self.summarize = summarize
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4)
+        self.max_sessions = max_sessions
+        self.summary_cache_size = summary_cache_size
+        self._sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+        self._stats = Counter()
+
+    def _truncate(self, text: str, tokens: int) -> str:
+        text = (text or "").strip()
+        if self.count_tokens(text) <= tokens:
+            return text
+        # Cut proportionally, then trim until the counter agrees
+        cut = text[:max(1, len(text) * tokens // max(self.count_tokens(text), 1))]
+        while cut and self.count_tokens(cut) > tokens:
+            cut = cut[:int(len(cut) * 0.9)]
+        return cut.rstrip() + " ..."
+
+    def _session(self, session_id: str) -> Dict[str, Any]:
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = {"turns": deque(), "summary": "", "folding": [], "summarizing": False, "generation": 0}
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def has_session(self, session_id: str) -> bool:
+        with self._lock:
+            return session_id in self._sessions
+
+    def seed(self, session_id: str, turns: Iterable[Tuple[str, str]]) -> None:
+        """
+        Restore a session from stored (user message, answer) pairs, e.g. after a restart
+
+        Only the last window_turns are kept verbatim. Older turns are condensed extractively
+        right away: handing a long-time user's whole history to the LLM in one summary
+        prompt would overflow its context, and would be repeated after every restart.
+        """
+        turns = list(turns)
+        split = max(0, len(turns) - self.window_turns)
+        # Each point of an extractive summary takes a few tokens, so older turns than these never fit
+        older = turns[max(0, split - self.summary_tokens):split]
+        recent = [(self._truncate(user_input, self.max_turn_tokens), self._truncate(answer, self.max_turn_tokens))
+                  for user_input, answer in turns[split:]]
+        summary = self._extractive_summary("", older) if older else ""
+        with self._lock:
+            session = self._session(session_id)
+            session["turns"] = deque(recent)
+            session["summary"] = summary
+            session["folding"] = []
+            # A fold already running for the old turns must not write its summary over the seeded one
+            session["generation"] += 1
+            self._stats["seeded_turns"] += len(turns)
+
+    def context(self, session_id: str) -> str:
+        """Summary and recent turns of the session as prompt text, empty for a new session"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return ""
+            summary = session["summary"]
+            turns = list(session["turns"])
+            pending = list(session["folding"])
+        parts = []
+        if summary or pending:
+            # Turns still being folded in are listed by their questions only, so nothing is lost meanwhile
+            earlier = summary
+            if pending:
+                earlier = f"{earlier}\nAlso asked earlier: " + "; ".join(user for user, _ in pending)
+            parts.append(f"Summary of earlier conversation: {self._truncate(earlier, self.summary_tokens)}")
+        recent, used = [], 0
+        for user_input, answer in reversed(turns):
+            turn = f"User: {user_input}\nLab: {answer}"
+            tokens = self.count_tokens(turn)
+            if recent and used + tokens > self.window_tokens:
+                break
+            recent.append(self._truncate(turn, self.window_tokens) if not recent else turn)
+            used += tokens
+        if recent:
+            parts.append("Recent turns:\n" + "\n".join(reversed(recent)))
+        return "\n".join(parts)
+
+    def record(self, session_id: str, user_input: str, answer: str) -> None:
+        """Add a finished turn; turns beyond the window are folded into the summary in the background"""
+        turn = (self._truncate(user_input, self.max_turn_tokens), self._truncate(answer, self.max_turn_tokens))
+        with self._lock:
+            session = self._session(session_id)
+            session["turns"].append(turn)
+            self._stats["turns"] += 1
+            while len(session["turns"]) > self.window_turns:
+                session["folding"].append(session["turns"].popleft())
+            start = bool(session["folding"]) and not session["summarizing"]
+            if start:
+                session["summarizing"] = True
+        if start:
+            self._executor.submit(self._fold, session_id)
+
+    def _fold(self, session_id: str) -> None:
+        while True:
+            with self._lock:
+                session = self._sessions.get(session_id)
+                if session is None or not session["folding"]:
+                    if session is not None:
+                        session["summarizing"] = False
+                    return
+                summary = session["summary"]
+                folding = list(session["folding"])
+                generation = session["generation"]
+            try:
+                new_summary = self._summarize(summary, folding)
+            except Exception as e:
+                logger.error(f"Error summarizing conversation {session_id}: {str(e)}", exc_info=True)
+                new_summary = self._extractive_summary(summary, folding)
+            with self._lock:
+                # The session was seeded or evicted meanwhile: the folded turns are no longer its history
+                if self._sessions.get(session_id) is not session or session["generation"] != generation:
+                    self._stats["stale_folds"] += 1
+                    continue
+                session["summary"] = new_summary
+                del session["folding"][:len(folding)]
+
+    def _summarize(self, summary: str, turns: List[Tuple[str, str]]) -> str:
+        text = "\n".join(f"User: {user_input}\nLab: {answer}" for user_input, answer in turns)
+        key = hashlib.sha256(f"{summary}\x00{text}".encode("utf-8")).hexdigest()
+        with self._lock:
+            cached = self._summaries.get(key)
+            if cached is not None:
+                self._summaries.move_to_end(key)
+                self._stats["summary_cache_hits"] += 1
+                return cached
+        if self.summarize is not None:
+            result = self._truncate(self.summarize(SUMMARY_PROMPT.format(summary=summary or "(none)", turns=text)),
+                                    self.summary_tokens)
+            kind = "llm_summaries"
+        else:
+            result = self._extractive_summary(summary, turns)
+            kind = "extractive_summaries"
+        with self._lock:
+            self._stats[kind] += 1
+            self._summaries[key] = result
+            while len(self._summaries) > self.summary_cache_size:
+                self._summaries.popitem(last=False)
+        return result
+
+    def _extractive_summary(self, summary: str, turns: List[Tuple[str, str]]) -> str:
+        # First sentence of each question and answer, newest kept when over budget
+        points = [summary] if summary else []
+        for user_input, answer in turns:
+            first = answer.split(". ")[0]
+            points.append(f"Q: {user_input.split('. ')[0]} A: {first}")
+        text = " | ".join(points)
+        while len(points) > 1 and self.count_tokens(text) > self.summary_tokens:
+            points.pop(0)
+            text = " | ".join(points)
+        return self._truncate(text, self.summary_tokens)
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(sessions=len(self._sessions), cached_summaries=len(self._summaries))
+        return stats
@@ -0,0 +1,356 @@
+"""
+Local stand-ins for the paid external services used by the /simulate pipeline.
+
+Three small HTTP servers mimic the parts of the APIs the app calls:
+
+- Tavily: POST /search
+- Replicate (LLaVA): POST /v1/predictions and the model version lookup done by replicate.run
+- OpenAI-compatible chat: POST /v1/chat/completions (including stream=true)
+
+Each server has a configurable latency distribution, error and rate-limit
+rates, and templated responses, so throughput and tail latency of our own
+code can be measured offline. Start them with
+
+    python fake_services.py --config fake_services.json
+
+and run the app with GVIM_FAKE_SERVICES=true (see simulate_ai.py for the
+URL overrides).
+"""
+import argparse
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LatencyDistribution:
+    """Seconds to wait before answering: fixed, uniform, normal or lognormal"""
+    kind: str = "lognormal"
+    mean: float = 0.5
+    stddev: float = 0.25
+    minimum: float = 0.0
+    maximum: float = 30.0
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            value = self.mean
+        elif self.kind == "uniform":
+            value = random.uniform(self.mean - self.stddev, self.mean + self.stddev)
+        elif self.kind == "normal":
+            value = random.gauss(self.mean, self.stddev)
+        else:
+            # Parameterized by the mean and stddev of the resulting delay, long right tail
+            variance = math.log(1 + (self.stddev / self.mean) ** 2) if self.mean > 0 else 0.0
+            value = random.lognormvariate(math.log(self.mean) - variance / 2, math.sqrt(variance)) if self.mean > 0 else 0.0
+        return min(self.maximum, max(self.minimum, value))
+
+
+@dataclass
+class FakeServiceConfig:
+    """Behaviour of one fake service"""
+    port: int
+    latency: LatencyDistribution = field(default_factory=LatencyDistribution)
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    responses: List[str] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], defaults: "FakeServiceConfig") -> "FakeServiceConfig":
+        return cls(
+            port=data.get("port", defaults.port),
+            latency=LatencyDistribution(**data["latency"]) if "latency" in data else defaults.latency,
+            error_rate=data.get("error_rate", defaults.error_rate),
+            rate_limit_rate=data.get("rate_limit_rate", defaults.rate_limit_rate),
+            responses=data.get("responses", defaults.responses)
+        )
+
+
+DEFAULT_CONFIGS = {
+    "tavily": FakeServiceConfig(
+        port=8701,
+        latency=LatencyDistribution(mean=0.8, stddev=0.4),
+        responses=["Recent findings on {query}: reported yields and conditions vary across studies; "
+                   "see the cited sources for experimental details."]
+    ),
+    "replicate": FakeServiceConfig(
+        port=8702,
+        latency=LatencyDistribution(mean=3.0, stddev=1.5),
+        responses=["The image shows a skeletal structure of an organic molecule, likely CCO (ethanol), "
+                   "drawn with standard bond notation."]
+    ),
+    "openai": FakeServiceConfig(
+        port=8703,
+        latency=LatencyDistribution(mean=1.5, stddev=0.8),
+        responses=["Regarding \"{prompt}\": a plausible approach is to start from CC(=O)O and proceed "
+                   "under standard conditions. TERMINATE"]
+    ),
+}
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    """Shared request plumbing: latency injection, error injection and JSON replies"""
+
+    service_name = "fake"
+    config: FakeServiceConfig = None
+    stats: Dict[str, int] = None
+    stats_lock: threading.Lock = None
+
+    def log_message(self, format, *args):
+        logger.debug(f"[{self.service_name}] {format % args}")
+
+    def _count(self, stat: str) -> None:
+        with self.stats_lock:
+            self.stats[stat] = self.stats.get(stat, 0) + 1
+
+    def read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except json.JSONDecodeError:
+            return {}
+
+    def send_json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def simulate_call(self) -> bool:
+        """Sleep for a sampled latency, then answer with an injected error if one is due"""
+        self._count("requests")
+        time.sleep(self.config.latency.sample())
+        roll = random.random()
+        if roll < self.config.rate_limit_rate:
+            self._count("rate_limited")
+            self.send_json(429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}},
+                           headers={"Retry-After": "1"})
+            return False
+        if roll < self.config.rate_limit_rate + self.config.error_rate:
+            self._count("errors")
+            self.send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+            return False
+        self._count("ok")
+        return True
+
+    def render(self, **values: str) -> str:
+        template = random.choice(self.config.responses) if self.config.responses else "{prompt}"
+        try:
+            return template.format(**values)
+        except (KeyError, IndexError):
+            return template
+
+    def do_GET(self):
+        if self.path == "/stats":
+            with self.stats_lock:
+                self.send_json(200, dict(self.stats))
+        else:
+            self.handle_get()
+
+    def handle_get(self):
+        self.send_json(404, {"detail": "Not found"})
+
+
+class TavilyHandler(FakeServiceHandler):
+    service_name = "tavily"
+
+    def do_POST(self):
+        # The Tavily client posts to <base_url>/search or to a base_url that already ends in /search
+        if not self.path.rstrip("/").endswith("search"):
+            self.send_json(404, {"detail": "Not found"})
+            return
+        payload = self.read_json()
+        if not self.simulate_call():
+            return
+        query = payload.get("query", "")
+        domains = payload.get("include_domains") or ["example.org"]
+        max_results = int(payload.get("max_results", 5))
+        results = [{
+            "title": f"{query[:60]} - result {i + 1}",
+            "url": f"https://{domains[i % len(domains)]}/article/{uuid.uuid4().hex[:8]}",
+            "content": self.render(query=query, prompt=query),
+            "score": round(1.0 - i * 0.1, 2),
+            "raw_content": None
+        } for i in range(max_results)]
+        self.send_json(200, {
+            "query": query,
+            "answer": self.render(query=query, prompt=query) if payload.get("include_answer") else None,
+            "results": results,
+            "images": [],
+            "response_time": 0.0
+        })
+
+
+class ReplicateHandler(FakeServiceHandler):
+    service_name = "replicate"
+
+    def handle_get(self):
+        parts = self.path.strip("/").split("/")
+        # replicate.run looks up the version to decide whether the output is an iterator
+        if len(parts) == 6 and parts[:2] == ["v1", "models"] and parts[4] == "versions":
+            self.send_json(200, {
+                "id": parts[5],
+                "created_at": "2024-01-01T00:00:00Z",
+                "cog_version": "0.8.0",
+                "openapi_schema": {"components": {"schemas": {"Output": {"type": "array", "items": {"type": "string"}}}}}
+            })
+        else:
+            self.send_json(404, {"detail": "Not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/predictions":
+            self.send_json(404, {"detail": "Not found"})
+            return
+        payload = self.read_json()
+        if not self.simulate_call():
+            return
+        inputs = payload.get("input", {})
+        prediction_id = uuid.uuid4().hex
+        text = self.render(prompt=inputs.get("prompt", ""), query=inputs.get("prompt", ""))
+        # The prediction is already finished when returned, so the client never polls
+        self.send_json(201, {
+            "id": prediction_id,
+            "model": "fake/llava",
+            "version": payload.get("version", ""),
+            "status": "succeeded",
+            "input": {"prompt": inputs.get("prompt", "")},
+            "output": [token + " " for token in text.split(" ")],
+            "logs": "",
+            "error": None,
+            "metrics": {"predict_time": 0.0},
+            "created_at": "2024-01-01T00:00:00Z",
+            "started_at": "2024-01-01T00:00:00Z",
+            "completed_at": "2024-01-01T00:00:00Z",
+            "urls": {"get": f"/v1/predictions/{prediction_id}", "cancel": f"/v1/predictions/{prediction_id}/cancel"}
+        })
+
+
+class OpenAIHandler(FakeServiceHandler):
+    service_name = "openai"
+
+    def rate_limit_headers(self) -> Dict[str, str]:
+        return {
+            "x-ratelimit-limit-requests": "1000",
+            "x-ratelimit-remaining-requests": str(random.randint(100, 999)),
+            "x-ratelimit-limit-tokens": "100000",
+            "x-ratelimit-remaining-tokens": str(random.randint(10000, 99999))
+        }
+
+    def handle_get(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "fake-model", "object": "model", "owned_by": "fake"}]})
+        else:
+            self.send_json(404, {"detail": "Not found"})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"detail": "Not found"})
+            return
+        payload = self.read_json()
+        if not self.simulate_call():
+            return
+        messages = payload.get("messages") or [{}]
+        last_message = messages[-1].get("content") or ""
+        if isinstance(last_message, list):
+            last_message = " ".join(part.get("text", "") for part in last_message if isinstance(part, dict))
+        content = self.render(prompt=last_message[:200], query=last_message[:200])
+        model = payload.get("model", "fake-model")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        prompt_tokens = sum(len(str(m.get("content") or "").split()) for m in messages)
+        completion_tokens = len(content.split())
+        if payload.get("stream"):
+            self.stream_completion(completion_id, model, content)
+            return
+        self.send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop", "logprobs": None}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens}
+        }, headers=self.rate_limit_headers())
+
+    def stream_completion(self, completion_id: str, model: str, content: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        for name, value in self.rate_limit_headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> None:
+            event = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason, "logprobs": None}]}
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        chunk({"role": "assistant", "content": ""})
+        for token in content.split(" "):
+            chunk({"content": token + " "})
+            time.sleep(0.01)
+        chunk({}, finish_reason="stop")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+HANDLERS = {"tavily": TavilyHandler, "replicate": ReplicateHandler, "openai": OpenAIHandler}
+
+
+def load_configs(path: Optional[str] = None) -> Dict[str, FakeServiceConfig]:
+    """Read per-service overrides from a JSON file keyed by service name"""
+    overrides = {}
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            overrides = json.load(f)
+    return {name: FakeServiceConfig.from_dict(overrides.get(name, {}), defaults) for name, defaults in DEFAULT_CONFIGS.items()}
+
+
+def start_fake_services(configs: Optional[Dict[str, FakeServiceConfig]] = None, host: str = "127.0.0.1") -> List[ThreadingHTTPServer]:
+    """Start every fake service on a daemon thread and return the servers"""
+    configs = configs or load_configs()
+    servers = []
+    for name, config in configs.items():
+        handler = type(HANDLERS[name].__name__, (HANDLERS[name],), {
+            "config": config, "stats": {}, "stats_lock": threading.Lock()
+        })
+        server = ThreadingHTTPServer((host, config.port), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name=f"fake-{name}", daemon=True).start()
+        logger.info(f"Fake {name} service listening on http://{host}:{config.port}")
+        servers.append(server)
+    return servers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run local fakes of Tavily, Replicate and an OpenAI-compatible LLM")
+    parser.add_argument("--config", help="JSON file with per-service port, latency, error_rate, rate_limit_rate and responses")
+    parser.add_argument("--host", default="127.0.0.1")
+    args = parser.parse_args()
+
+    servers = start_fake_services(load_configs(args.config), host=args.host)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
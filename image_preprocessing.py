@@ -0,0 +1,102 @@
+"""
+Image preparation for the LLaVA image analysis call.
+
+Uploads arrive as camera photos or screenshots of up to several megabytes,
+while LLaVA 1.5 looks at a 336x336 view of the image. prepare_image()
+decodes the upload once, applies the EXIF orientation, downsizes it to
+`max_side` pixels and re-encodes it as the smaller of JPEG and PNG (PNG
+wins for line art such as spectra and TLC sketches). The result carries a
+content hash of the prepared pixels and a perceptual (difference) hash,
+which the analysis cache uses as its image key.
+"""
+import base64
+import hashlib
+import io
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    original_size: int
+    content_hash: str
+    perceptual_hash: Optional[str] = None
+
+    def data_uri(self) -> str:
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode('utf-8')}"
+
+    def cache_key(self, match: str = "content") -> str:
+        """Image part of a cache key: exact pixels, or the perceptual hash when match is "perceptual" """
+        if match == "perceptual" and self.perceptual_hash:
+            return f"dhash:{self.perceptual_hash}"
+        return f"sha256:{self.content_hash}"
+
+
+def difference_hash(image: Image.Image, hash_size: int = 16, noise: int = 3) -> str:
+    """
+    dHash: sign of horizontal gradients of a hash_size x hash_size grayscale thumbnail, as hex
+
+    Gradients within `noise` grey levels count as flat, so re-compressing an image does not flip bits
+    in its uniform areas.
+    """
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | int(pixels[offset + col] - pixels[offset + col + 1] > noise)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def _encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if image_format == "JPEG":
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    else:
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def prepare_image(image_data: bytes, max_side: int = 672, quality: int = 85) -> PreparedImage:
+    """Downsized, re-encoded copy of an upload; the original bytes are passed through if PIL cannot decode them"""
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        original_format, original_dimensions = image.format, image.size
+        # JPEG can decode directly at a reduced scale, which is much faster for large photos
+        image.draft("RGB", (max_side, max_side))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "L"):
+            background = Image.new("RGB", image.size, "white")
+            rgba = image.convert("RGBA")
+            background.paste(rgba, mask=rgba.split()[-1])
+            image = background
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    except Exception as e:
+        logger.warning(f"Could not decode image, sending it unchanged: {str(e)}")
+        return PreparedImage(
+            data=image_data, mime_type="image/jpeg", width=0, height=0, original_size=len(image_data),
+            content_hash=hashlib.sha256(image_data).hexdigest()
+        )
+    candidates = [("image/jpeg", _encode(image, "JPEG", quality)), ("image/png", _encode(image, "PNG", quality))]
+    mime_type, data = min(candidates, key=lambda candidate: len(candidate[1]))
+    if len(data) >= len(image_data) and image.size == original_dimensions and original_format in ("JPEG", "PNG"):
+        # Already small: re-encoding would only lose quality
+        data, mime_type = image_data, Image.MIME[original_format]
+    return PreparedImage(
+        data=data,
+        mime_type=mime_type,
+        width=image.width,
+        height=image.height,
+        original_size=len(image_data),
+        content_hash=hashlib.sha256(image.tobytes() + f"{image.mode}{image.size}".encode()).hexdigest(),
+        perceptual_hash=difference_hash(image)
+    )
@@ -0,0 +1,272 @@
+"""
+Local search-intent classifier.
+
+Decides whether a user message needs a web search ("1"), a literature/RAG
+search ("2"), both ("3") or neither ("4") without an LLM call. Keyword rules
+handle the clear cases; a TF-IDF + logistic regression model trained on
+labels from earlier LLM decisions handles the rest. Only low-confidence
+messages fall back to the LLM, whose answer becomes a new training label,
+and a small share of confident decisions is audited against the LLM, which
+labels them too. Rule decisions are never used as labels: a model trained
+on them would only learn to repeat the rules. The label store keeps the
+latest label of at most max_labels queries, in memory and on disk.
+"""
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+INTENTS = ("1", "2", "3", "4")
+
+REALTIME_PATTERN = re.compile(
+    r"\b(latest|recent(ly)?|news|current(ly)?|today|this (week|month|year)|20[2-3]\d|price[sd]?|cost|buy|"
+    r"supplier|vendor|market|new(est)? (regulation|rule|guideline)s?|trend(s|ing)?|announce[sd]?|update[sd]?)\b",
+    re.IGNORECASE
+)
+DEEP_PATTERN = re.compile(
+    r"\b(mechanism|literature|papers?|articles?|stud(y|ies)|research|documents?|uploaded|experimental data|"
+    r"our (data|results|experiments?)|synthesis|synthesi[sz]e|route|spectr(um|a|oscopy)|nmr|ir|hplc|"
+    r"characteri[sz]ation|kinetics?|thermodynamics?|derive|yield|catalyst|selectivity)\b",
+    re.IGNORECASE
+)
+SMALL_TALK_PATTERN = re.compile(
+    r"^\s*(hi|hello|hey|thanks|thank you|ok(ay)?|good (morning|afternoon|evening)|bye|who are you)\b",
+    re.IGNORECASE
+)
+
+
+def normalize_intent(answer: Any) -> Optional[str]:
+    """Extract the intent digit from an LLM answer"""
+    match = re.search(r"[1-4]", str(answer or ""))
+    return match.group(0) if match else None
+
+
+def rule_intent(query: str) -> Tuple[Optional[str], float]:
+    """Keyword rules, returns (intent, confidence) or (None, 0.0) when no rule applies"""
+    words = query.split()
+    if SMALL_TALK_PATTERN.search(query) and len(words) <= 6:
+        return "4", 0.95
+    realtime = len(REALTIME_PATTERN.findall(query))
+    deep = len(DEEP_PATTERN.findall(query))
+    if realtime and deep:
+        return "3", min(0.9, 0.6 + 0.1 * min(realtime, deep))
+    if realtime:
+        return "1", min(0.9, 0.6 + 0.1 * realtime)
+    if deep:
+        return "2", min(0.9, 0.6 + 0.1 * deep)
+    return None, 0.0
+
+
+class IntentClassifier:
+    """Rules + TF-IDF/logistic regression with LLM fallback below min_confidence"""
+
+    def __init__(self, labels_path: Optional[str] = None, min_confidence: float = 0.7, audit_rate: float = 0.05,
+                 rule_confidence: float = 0.85, min_training_examples: int = 20, retrain_every: int = 20,
+                 max_labels: int = 5000):
+        """
+        Args:
+            labels_path (str): JSONL file where LLM-labelled queries are kept for training
+            min_confidence (float): Below this the LLM decides (and labels the query)
+            audit_rate (float): Share of confident local decisions checked against the LLM in the background
+            rule_confidence (float): Rule decisions at or above this skip the model
+            min_training_examples (int): Labels needed before the model is trained
+            retrain_every (int): Retrain after this many new LLM labels
+            max_labels (int): Labelled queries kept (most recent first); the file is compacted past twice this
+        """
+        self.labels_path = labels_path
+        self.min_confidence = min_confidence
+        self.audit_rate = audit_rate
+        self.rule_confidence = rule_confidence
+        self.min_training_examples = min_training_examples
+        self.retrain_every = retrain_every
+        self.max_labels = max_labels
+        self._model: Optional[Pipeline] = None
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._saved_lines = 0
+        self._labels: "OrderedDict[str, str]" = self._load_labels()
+        self._new_labels = 0
+        self._training = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="intent")
+        self._stats = Counter()
+        self._confusion = Counter()
+        self._local_seconds = 0.0
+        self._predictions = 0
+
+    def _add_label(self, labels: "OrderedDict[str, str]", query: str, intent: str) -> None:
+        # A relabelled query keeps only its latest intent and counts as recent again
+        labels.pop(query, None)
+        labels[query] = intent
+        while len(labels) > self.max_labels:
+            labels.popitem(last=False)
+
+    def _load_labels(self) -> "OrderedDict[str, str]":
+        labels: "OrderedDict[str, str]" = OrderedDict()
+        if self.labels_path and os.path.exists(self.labels_path):
+            try:
+                with open(self.labels_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        self._saved_lines += 1
+                        record = json.loads(line)
+                        if record.get("intent") in INTENTS:
+                            self._add_label(labels, record["query"], record["intent"])
+            except Exception as e:
+                logger.error(f"Error loading intent labels from {self.labels_path}: {e}")
+        return labels
+
+    def _save_label(self, query: str, intent: str) -> None:
+        if not self.labels_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.labels_path) or ".", exist_ok=True)
+            with self._file_lock:
+                self._saved_lines += 1
+                if self._saved_lines <= 2 * self.max_labels:
+                    with open(self.labels_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps({"query": query, "intent": intent, "timestamp": time.time()},
+                                           ensure_ascii=False) + "\n")
+                    return
+                # Rewrite the file with the labels still kept (this one included), so it stops growing
+                with self._lock:
+                    labels = list(self._labels.items())
+                tmp_path = f"{self.labels_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    for kept_query, kept_intent in labels:
+                        f.write(json.dumps({"query": kept_query, "intent": kept_intent, "timestamp": time.time()},
+                                           ensure_ascii=False) + "\n")
+                os.replace(tmp_path, self.labels_path)
+                self._saved_lines = len(labels)
+        except Exception as e:
+            logger.error(f"Error saving intent label: {e}")
+
+    def train(self) -> bool:
+        """
+        Fit the model on the labels of LLM fallbacks and audits
+
+        Returns:
+            bool: True if a model was trained
+        """
+        with self._lock:
+            examples = list(self._labels.items())
+        if len(examples) < self.min_training_examples or len({intent for _, intent in examples}) < 2:
+            logger.info(f"Intent model not trained: {len(examples)} examples")
+            return False
+        model = Pipeline([
+            ("tfidf", TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True, min_df=1)),
+            ("clf", LogisticRegression(max_iter=1000, class_weight="balanced"))
+        ])
+        model.fit([query for query, _ in examples], [intent for _, intent in examples])
+        with self._lock:
+            self._model = model
+            self._new_labels = 0
+        logger.info(f"Intent model trained on {len(examples)} examples")
+        return True
+
+    def train_async(self) -> None:
+        with self._lock:
+            if self._training:
+                return
+            self._training = True
+
+        def run():
+            try:
+                self.train()
+            except Exception as e:
+                logger.error(f"Error training intent model: {e}", exc_info=True)
+            finally:
+                with self._lock:
+                    self._training = False
+        self._executor.submit(run)
+
+    def predict(self, query: str) -> Tuple[Optional[str], float, str]:
+        """Local decision, returns (intent, confidence, source) without any network call"""
+        start = time.perf_counter()
+        intent, confidence = rule_intent(query)
+        source = "rules"
+        if confidence < self.rule_confidence:
+            with self._lock:
+                model = self._model
+            if model is not None:
+                probabilities = model.predict_proba([query])[0]
+                best = int(probabilities.argmax())
+                model_intent, model_confidence = str(model.classes_[best]), float(probabilities[best])
+                if model_intent == intent:
+                    confidence = max(confidence, model_confidence)
+                    source = "rules+model"
+                elif model_confidence > confidence:
+                    intent, confidence, source = model_intent, model_confidence, "model"
+        with self._lock:
+            self._local_seconds += time.perf_counter() - start
+            self._predictions += 1
+        return intent, confidence, source
+
+    def _record_llm_label(self, query: str, local_intent: Optional[str], llm_intent: Optional[str]) -> None:
+        if llm_intent is None:
+            return
+        with self._lock:
+            self._add_label(self._labels, query, llm_intent)
+            self._new_labels += 1
+            retrain = self._new_labels >= self.retrain_every
+            if local_intent is not None:
+                self._stats["compared"] += 1
+                self._stats["agreed"] += int(local_intent == llm_intent)
+                self._confusion[f"{local_intent}->{llm_intent}"] += 1
+        self._save_label(query, llm_intent)
+        if retrain:
+            self.train_async()
+
+    def _audit(self, query: str, local_intent: str, llm_classify: Callable[[str], Any]) -> None:
+        try:
+            self._record_llm_label(query, local_intent, normalize_intent(llm_classify(query)))
+        except Exception as e:
+            logger.warning(f"Intent audit failed: {e}")
+
+    def classify(self, query: str, llm_classify: Optional[Callable[[str], Any]] = None) -> str:
+        """Return the intent digit, asking llm_classify only when the local decision is not confident"""
+        intent, confidence, source = self.predict(query)
+        if confidence >= self.min_confidence or llm_classify is None:
+            with self._lock:
+                self._stats[f"local_{source}"] += 1
+            if llm_classify is not None and random.random() < self.audit_rate:
+                with self._lock:
+                    self._stats["audits"] += 1
+                self._executor.submit(self._audit, query, intent, llm_classify)
+            return intent or "3"
+
+        with self._lock:
+            self._stats["llm_fallback"] += 1
+        try:
+            llm_intent = normalize_intent(llm_classify(query))
+        except Exception as e:
+            logger.warning(f"LLM intent fallback failed, using local decision: {e}")
+            llm_intent = None
+        self._record_llm_label(query, intent, llm_intent)
+        # When nothing is known, searching both sources is the safe default
+        return llm_intent or intent or "3"
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            local = sum(count for key, count in self._stats.items() if key.startswith("local_"))
+            stats.update(
+                local_decisions=local,
+                local_rate=round(local / (local + self._stats["llm_fallback"]), 4) if local + self._stats["llm_fallback"] else None,
+                agreement_rate=round(self._stats["agreed"] / self._stats["compared"], 4) if self._stats["compared"] else None,
+                confusion=dict(self._confusion),
+                model_trained=self._model is not None,
+                training_labels=len(self._labels),
+                avg_local_latency_us=round(self._local_seconds / self._predictions * 1e6, 1) if self._predictions else None
+            )
+        return stats
@@ -0,0 +1,200 @@
+"""
+Bounded pool of pre-warmed ChemistryLab instances, leased per request.
+
+Building a lab creates six agents, their LLM clients and the group chat,
+which is too slow for a user request, and a lab's group chat, agent
+histories and performance history must not be shared by concurrent
+requests. LabPool builds labs on a background thread, keeps `warm_size`
+idle instances and leases each in-flight request a lab of its own. Labs
+are interchangeable: a request picks its literature collection when it
+runs, so nothing about a lab depends on the user it serves. At most `max_size` labs exist at once; further requests
+wait in a FIFO queue until a lab is released. Released labs have their
+per-request state reset and go back to the pool; labs that served
+`max_uses` requests are replaced by fresh ones.
+"""
+import logging
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LabPoolTimeout(Exception):
+    """Raised when no lab becomes available within the acquire timeout"""
+
+
+class _Waiter:
+    def __init__(self, session_id: Optional[str]):
+        self.session_id = session_id
+        self.lab: Any = None
+
+
+class LabPool:
+    """Warm, recycled lab instances, leased exclusively per request"""
+
+    def __init__(self, factory: Callable[[], Any], warm_size: int = 1, max_size: int = 4, max_idle: int = 4,
+                 max_uses: int = 200, acquire_timeout: float = 120.0, builders: int = 1):
+        """
+        Args:
+            factory: Builds a ready-to-use lab
+            warm_size (int): Idle labs kept ready
+            max_size (int): Labs alive at once (idle, leased or being built), i.e. requests served concurrently
+            max_idle (int): Idle labs kept when more are released than needed
+            max_uses (int): Requests a lab serves before it is replaced
+            acquire_timeout (float): Seconds a request waits in the queue before LabPoolTimeout
+            builders (int): Background build threads
+        """
+        self.factory = factory
+        self.max_size = max(1, max_size)
+        self.warm_size = min(warm_size, self.max_size)
+        self.max_idle = max(max_idle, warm_size)
+        self.max_uses = max_uses
+        self.acquire_timeout = acquire_timeout
+        self._idle: Deque[Any] = deque()
+        self._building = 0
+        self._leased = 0
+        self._waiters: Deque[_Waiter] = deque()
+        self._uses: Dict[int, int] = {}
+        self._sessions: Dict[int, Optional[str]] = {}
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=builders, thread_name_prefix="lab-pool")
+        self._stats = Counter()
+        self._wait_seconds = 0.0
+
+    # The helpers below expect the caller to hold self._condition
+
+    def _live(self) -> int:
+        return len(self._idle) + self._leased + self._building
+
+    def _start_build(self) -> None:
+        self._building += 1
+        self._executor.submit(self._build)
+
+    def _forget(self, lab: Any) -> None:
+        self._uses.pop(id(lab), None)
+        self._sessions.pop(id(lab), None)
+
+    def _pop_idle(self, session_id: Optional[str]) -> Any:
+        # Prefer the lab this session used last
+        if session_id is not None:
+            for lab in self._idle:
+                if self._sessions.get(id(lab)) == session_id:
+                    self._idle.remove(lab)
+                    return lab
+        return self._idle.popleft()
+
+    def _dispatch(self) -> None:
+        """Hand idle labs to waiters in arrival order and start builds for those still waiting"""
+        while self._waiters and self._idle:
+            waiter = self._waiters.popleft()
+            waiter.lab = self._pop_idle(waiter.session_id)
+            self._leased += 1
+        while self._building < len(self._waiters) and self._live() < self.max_size:
+            self._start_build()
+        self._condition.notify_all()
+
+    def _schedule_warm(self) -> None:
+        while len(self._idle) + self._building < self.warm_size and self._live() < self.max_size:
+            self._start_build()
+
+    def _build(self) -> None:
+        start = time.time()
+        try:
+            lab = self.factory()
+        except Exception as e:
+            logger.error(f"Error building lab: {str(e)}", exc_info=True)
+            # Back off before waiting requests trigger the next attempt
+            time.sleep(1.0)
+            with self._condition:
+                self._building -= 1
+                self._stats["build_errors"] += 1
+                self._dispatch()
+            return
+        logger.info(f"Built lab in {time.time() - start:.2f}s")
+        with self._condition:
+            self._building -= 1
+            self._uses[id(lab)] = 0
+            self._idle.append(lab)
+            self._stats["builds"] += 1
+            self._dispatch()
+
+    def warm(self) -> None:
+        """Start background builds until warm_size labs are idle or being built"""
+        with self._condition:
+            self._schedule_warm()
+
+    def acquire(self, session_id: Optional[str] = None, timeout: Optional[float] = None) -> Any:
+        """Exclusive use of a warm lab, waiting in FIFO order while the pool is at capacity"""
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.time()
+        waiter = _Waiter(session_id)
+        with self._condition:
+            self._waiters.append(waiter)
+            self._dispatch()
+            while waiter.lab is None:
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    self._waiters.remove(waiter)
+                    self._stats["timeouts"] += 1
+                    self._dispatch()
+                    raise LabPoolTimeout(f"No lab available within {timeout}s ({self._leased} in use)")
+                self._condition.wait(remaining)
+            lab = waiter.lab
+            waited = time.time() - start
+            self._wait_seconds += waited
+            self._stats["leases"] += 1
+            if waited > 0.01:
+                self._stats["waited"] += 1
+            self._sessions[id(lab)] = session_id
+            self._schedule_warm()
+        return lab
+
+    def release(self, lab: Any, discard: bool = False) -> None:
+        """Reset a lab's per-request state and return it to the pool (or retire it)"""
+        with self._condition:
+            if id(lab) not in self._uses or any(idle is lab for idle in self._idle):
+                return
+            uses = self._uses[id(lab)] + 1
+            self._uses[id(lab)] = uses
+        if not discard:
+            try:
+                lab.reset()
+            except Exception as e:
+                logger.error(f"Error resetting lab, retiring it: {str(e)}", exc_info=True)
+                discard = True
+        with self._condition:
+            self._leased -= 1
+            if discard or uses >= self.max_uses or len(self._idle) >= self.max_idle:
+                self._forget(lab)
+                self._stats["retired"] += 1
+            else:
+                self._idle.append(lab)
+                self._stats["recycled"] += 1
+            self._dispatch()
+            self._schedule_warm()
+
+    @contextmanager
+    def lease(self, session_id: Optional[str] = None, timeout: Optional[float] = None) -> Iterator[Any]:
+        """acquire() for the duration of a with block, released even when the request fails"""
+        lab = self.acquire(session_id=session_id, timeout=timeout)
+        try:
+            yield lab
+        finally:
+            self.release(lab)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update(
+                max_size=self.max_size,
+                leased=self._leased,
+                waiting=len(self._waiters),
+                idle=len(self._idle),
+                building=self._building,
+                avg_wait=round(self._wait_seconds / stats["leases"], 3) if stats.get("leases") else None
+            )
+        return stats
@@ -0,0 +1,427 @@
+"""
+Latency-aware routing across the OpenAI-compatible endpoints of config_list.
+
+ModelRouter keeps live statistics per endpoint: EWMA latency, EWMA error
+rate, in-flight requests and the rate-limit headers of its last response.
+Each call goes to the endpoint with the best score that has a free
+concurrency slot. Endpoints that keep failing are shed by a circuit breaker,
+and endpoints that report an exhausted rate limit are skipped until the
+limit resets; when every endpoint is shed a call fails at once. A failed
+call fails over to the next endpoint, and once every endpoint has failed
+with a transient error the round is repeated after a backoff, up to the
+retry policy's attempts. The router is the only layer retrying routed
+calls: its OpenAI clients do not retry, and callers do not wrap routed
+models in resilience.call. User requests never serve as probes:
+the latency of an idle endpoint is re-measured by a synthetic request in
+the background, and only while its breaker is closed.
+
+RoutedOpenAIClient plugs the router into autogen (``model_client_cls``) and
+RoutedChatModel into LangChain, so agents and ChemistryLab.llm share the
+same statistics and limits.
+"""
+import logging
+import re
+import threading
+import time
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import httpx
+from langchain_core.caches import BaseCache
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.load import dumps
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatResult
+from openai import OpenAI
+
+from resilience import CircuitBreaker, RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+class NoEndpointAvailable(Exception):
+    """Raised when every endpoint is tripped or rate limited, or busy past the acquire timeout"""
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Seconds from a rate-limit reset header ("1.5", "20ms", "6m0s", "1h2m3.5s")"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(amount) * scale[unit] for amount, unit in parts)
+
+
+def _is_request_error(error: Exception) -> bool:
+    # The request itself is invalid: another endpoint would reject it too and this one is not to blame
+    return getattr(error, "status_code", None) in (400, 413, 422)
+
+
+class Endpoint:
+    """One OpenAI-compatible endpoint with its concurrency slots and live statistics"""
+
+    def __init__(self, config: Dict[str, Any], max_concurrency: int, breaker: CircuitBreaker):
+        self.config = config
+        self.model = config["model"]
+        self.base_url = config.get("base_url")
+        self.api_key = config.get("api_key") or "NA"
+        self.name = f"{self.model}@{self.base_url}"
+        self.max_concurrency = max_concurrency
+        self.breaker = breaker
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.limited_until = 0.0
+        self.last_used = 0.0
+
+    def available(self, now: float) -> bool:
+        return now >= self.limited_until and self.breaker.state != "open"
+
+    def score(self) -> float:
+        """Expected latency, inflated by queueing on this endpoint and by its recent errors"""
+        if self.latency is None:
+            # Never measured: worth a try while nothing speaks against it
+            return 0.0 if self.breaker.state == "closed" else float("inf")
+        return self.latency * (1 + self.in_flight / self.max_concurrency) * (1 + 4 * self.error_rate)
+
+    def needs_probe(self, now: float, probe_interval: float) -> bool:
+        return (self.latency is not None and self.in_flight == 0 and now - self.last_used >= probe_interval
+                and self.breaker.state == "closed")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "base_url": self.base_url,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "errors": self.errors,
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+            "limited_for": max(0.0, round(self.limited_until - time.time(), 3)),
+            "breaker": self.breaker.state
+        }
+
+
+class ModelRouter:
+    """Picks the fastest healthy endpoint with a free slot and fails over on errors"""
+
+    def __init__(self, configs: List[Dict[str, Any]], max_concurrency: int = 4, alpha: float = 0.3,
+                 failure_threshold: int = 3, reset_timeout: float = 30.0, acquire_timeout: float = 30.0,
+                 probe_interval: float = 60.0, min_remaining_requests: int = 1,
+                 probe: Optional[Callable[["Endpoint"], Any]] = None, retry: Optional[RetryPolicy] = None):
+        """
+        Args:
+            configs: config_list entries (model, api_key, base_url)
+            max_concurrency (int): Concurrent requests allowed per endpoint
+            alpha (float): Weight of the newest observation in the latency and error EWMAs
+            failure_threshold (int): Consecutive failures that trip an endpoint's breaker
+            reset_timeout (float): Seconds before a tripped endpoint gets a trial request
+            acquire_timeout (float): Seconds a call waits for a free slot on a healthy endpoint
+            probe_interval (float): Seconds after which an unused endpoint is probed to refresh its latency
+            min_remaining_requests (int): Skip an endpoint whose remaining request quota is below this until it resets
+            probe: Synthetic request sent to an idle endpoint (in the background); without it idle endpoints keep their last statistics
+            retry (RetryPolicy): Endpoint calls per request and backoff between rounds over all endpoints
+        """
+        self.alpha = alpha
+        self.acquire_timeout = acquire_timeout
+        self.probe_interval = probe_interval
+        self.min_remaining_requests = min_remaining_requests
+        self.probe = probe
+        self.retry = retry or RetryPolicy()
+        self.endpoints = [
+            Endpoint(config, max_concurrency, CircuitBreaker(failure_threshold, reset_timeout, name=config["model"]))
+            for config in configs
+        ]
+        self._condition = threading.Condition()
+
+    def ranked(self, include_unavailable: bool = False) -> List[Endpoint]:
+        """Endpoints by score, healthy ones only unless include_unavailable"""
+        now = time.time()
+        with self._condition:
+            endpoints = [endpoint for endpoint in self.endpoints if include_unavailable or endpoint.available(now)]
+            return sorted(endpoints, key=lambda endpoint: endpoint.score())
+
+    def ranked_configs(self) -> List[Dict[str, Any]]:
+        """config_list ordered healthy and fastest first, for clients that walk the list themselves"""
+        ranked = self.ranked()
+        return [endpoint.config for endpoint in ranked + [e for e in self.endpoints if e not in ranked]]
+
+    def _acquire(self, exclude: set) -> Optional[Endpoint]:
+        deadline = time.time() + self.acquire_timeout
+        with self._condition:
+            while True:
+                candidates = [endpoint for endpoint in self.endpoints if endpoint.name not in exclude]
+                if not candidates:
+                    return None
+                now = time.time()
+                busy = False
+                for endpoint in sorted(candidates, key=lambda endpoint: endpoint.score()):
+                    if not endpoint.available(now):
+                        continue
+                    if endpoint.in_flight >= endpoint.max_concurrency:
+                        busy = True
+                    elif endpoint.breaker.allow():
+                        endpoint.in_flight += 1
+                        endpoint.last_used = now
+                        return endpoint
+                if not busy:
+                    # Every endpoint is tripped or rate limited: fail now instead of waiting out the timeout
+                    return None
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise NoEndpointAvailable(f"No model endpoint available within {self.acquire_timeout}s")
+                # Woken by a released slot; re-check periodically for expired rate limits and breakers
+                self._condition.wait(min(remaining, 0.5))
+
+    def _release(self, endpoint: Endpoint, latency: float, failed: bool) -> None:
+        with self._condition:
+            endpoint.in_flight -= 1
+        self._observe(endpoint, latency, failed)
+
+    def _observe(self, endpoint: Endpoint, latency: float, failed: bool) -> None:
+        with self._condition:
+            endpoint.calls += 1
+            if failed:
+                endpoint.errors += 1
+            else:
+                endpoint.latency = latency if endpoint.latency is None else (
+                    self.alpha * latency + (1 - self.alpha) * endpoint.latency)
+            endpoint.error_rate = self.alpha * float(failed) + (1 - self.alpha) * endpoint.error_rate
+            self._condition.notify_all()
+        if failed:
+            endpoint.breaker.record_failure()
+        else:
+            endpoint.breaker.record_success()
+
+    def _start_probes(self) -> None:
+        if self.probe is None:
+            return
+        now = time.time()
+        with self._condition:
+            due = [endpoint for endpoint in self.endpoints if endpoint.needs_probe(now, self.probe_interval)]
+            for endpoint in due:
+                # Counts as use, so one probe per interval
+                endpoint.last_used = now
+        for endpoint in due:
+            threading.Thread(target=self._run_probe, args=(endpoint,), name=f"probe-{endpoint.model}", daemon=True).start()
+
+    def _run_probe(self, endpoint: Endpoint) -> None:
+        start = time.perf_counter()
+        try:
+            self.probe(endpoint)
+        except Exception as e:
+            logger.warning(f"Probe of model endpoint {endpoint.name} failed: {str(e)}")
+            self._observe(endpoint, time.perf_counter() - start, failed=True)
+            return
+        self._observe(endpoint, time.perf_counter() - start, failed=False)
+
+    def call(self, fn: Callable[[Endpoint], Any]) -> Any:
+        """Run fn(endpoint) on the best endpoint, failing over to the others on errors"""
+        self._start_probes()
+        tried = set()
+        last_error: Optional[Exception] = None
+        attempts = rounds = 0
+        while attempts < self.retry.attempts:
+            endpoint = self._acquire(tried)
+            if endpoint is None:
+                if not tried or not self.retry.retryable(last_error):
+                    break
+                # Every endpoint failed this round: back off, then try them again
+                time.sleep(self.retry.delay(rounds))
+                rounds += 1
+                tried.clear()
+                continue
+            attempts += 1
+            tried.add(endpoint.name)
+            start = time.perf_counter()
+            try:
+                result = fn(endpoint)
+            except Exception as e:
+                if _is_request_error(e):
+                    self._release(endpoint, time.perf_counter() - start, failed=False)
+                    raise
+                self._release(endpoint, time.perf_counter() - start, failed=True)
+                logger.warning(f"Model endpoint {endpoint.name} failed, trying the next one: {str(e)}")
+                last_error = e
+                continue
+            self._release(endpoint, time.perf_counter() - start, failed=False)
+            return result
+        if last_error is not None:
+            raise last_error
+        if not self.endpoints:
+            raise NoEndpointAvailable("No model endpoint configured")
+        raise NoEndpointAvailable("Every model endpoint is tripped or rate limited")
+
+    def observe_response(self, endpoint: Endpoint, response: httpx.Response) -> None:
+        """httpx response hook: track rate-limit headers and back off on 429"""
+        headers = response.headers
+        with self._condition:
+            if "x-ratelimit-remaining-requests" in headers:
+                try:
+                    endpoint.remaining_requests = int(headers["x-ratelimit-remaining-requests"])
+                except ValueError:
+                    pass
+            if "x-ratelimit-remaining-tokens" in headers:
+                try:
+                    endpoint.remaining_tokens = int(headers["x-ratelimit-remaining-tokens"])
+                except ValueError:
+                    pass
+            wait = None
+            if response.status_code == 429:
+                wait = parse_reset(headers.get("retry-after")) or parse_reset(headers.get("x-ratelimit-reset-requests")) or 1.0
+            elif endpoint.remaining_requests is not None and endpoint.remaining_requests < self.min_remaining_requests:
+                wait = parse_reset(headers.get("x-ratelimit-reset-requests"))
+            if wait:
+                endpoint.limited_until = max(endpoint.limited_until, time.time() + wait)
+                logger.info(f"Model endpoint {endpoint.name} rate limited for {wait:.1f}s")
+
+    def http_client(self, endpoint: Endpoint, timeout: Optional[float] = None) -> httpx.Client:
+        """httpx client whose responses update the endpoint's rate-limit state"""
+        return httpx.Client(timeout=timeout, event_hooks={"response": [partial(self.observe_response, endpoint)]})
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {endpoint.name: endpoint.snapshot() for endpoint in self.endpoints}
+
+
+class RankedConfigList(list):
+    """
+    config_list that reads as the router's current ranking every time it is iterated
+
+    For clients built from llm_config on every call, such as autogen's LLM speaker
+    selection: set once on the agent, each new client starts from the healthiest,
+    fastest endpoint and no shared config is rewritten per request.
+    """
+
+    def __init__(self, router: ModelRouter):
+        super().__init__(endpoint.config for endpoint in router.endpoints)
+        self.router = router
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self.router.ranked_configs())
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> "RankedConfigList":
+        # autogen deep-copies llm_config; the view must keep reading the shared router
+        return self
+
+
+class RoutedOpenAIClient:
+    """
+    autogen model client that sends each completion through a ModelRouter
+
+    Use a config_list entry {"model": ..., "model_client_cls": "RoutedOpenAIClient"} and call
+    agent.register_model_client(RoutedOpenAIClient, router=router) after creating the agent.
+    autogen keys its completion cache on the config_list model before the router picks an
+    endpoint, so routed agents get the cache here instead (and none in initiate_chat): answers
+    are stored under the model that served them and looked up under the one that would serve.
+    """
+
+    def __init__(self, config: Dict[str, Any], router: ModelRouter, timeout: Optional[float] = None,
+                 cache: Optional[Any] = None, **kwargs):
+        # Imported here: autogen's client module is heavy and only agents need it
+        from autogen.oai.client import OpenAIClient
+        from autogen.oai.openai_utils import get_key
+        self._client_cls = OpenAIClient
+        self._get_key = get_key
+        self.config = config
+        self.router = router
+        self.timeout = timeout
+        self.cache = cache
+        self._clients: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _client(self, endpoint: Endpoint):
+        with self._lock:
+            client = self._clients.get(endpoint.name)
+            if client is None:
+                # Retries and failover are the router's job, so the OpenAI SDK does not retry itself
+                client = self._client_cls(OpenAI(api_key=endpoint.api_key, base_url=endpoint.base_url, max_retries=0,
+                                                 http_client=self.router.http_client(endpoint, self.timeout)))
+                self._clients[endpoint.name] = client
+            return client
+
+    def create(self, params: Dict[str, Any]):
+        params = {key: value for key, value in params.items() if key != "model_client_cls"}
+        if self.cache is None:
+            return self.router.call(lambda endpoint: self._client(endpoint).create({**params, "model": endpoint.model}))
+        ranked = self.router.ranked()
+        if ranked:
+            response = self.cache.get(self._get_key({**params, "model": ranked[0].model}))
+            if response is not None:
+                return response
+        model, response = self.router.call(
+            lambda endpoint: (endpoint.model, self._client(endpoint).create({**params, "model": endpoint.model}))
+        )
+        self.cache.set(self._get_key({**params, "model": model}), response)
+        return response
+
+    def message_retrieval(self, response):
+        return self._client_cls.message_retrieval(self, response)
+
+    def cost(self, response) -> float:
+        return self._client_cls.cost(self, response)
+
+    @staticmethod
+    def get_usage(response) -> Dict[str, Any]:
+        from autogen.oai.client import OpenAIClient
+        return OpenAIClient.get_usage(response)
+
+
+class RoutedChatModel(BaseChatModel):
+    """
+    LangChain chat model that routes each call to one of several per-endpoint chat models
+
+    Like RoutedOpenAIClient it caches by the serving endpoint's model: pass the cache as
+    response_cache, not as LangChain's cache, which would key every answer on model_name.
+    """
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    router: ModelRouter
+    models: Dict[str, BaseChatModel]
+    model_name: str = "routed"
+    response_cache: Optional[BaseCache] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "routed-chat"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name}
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        if self.response_cache is None:
+            return self.router.call(
+                lambda endpoint: self.models[endpoint.name]._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            )
+        prompt = dumps(messages)
+        ranked = self.router.ranked()
+        if ranked:
+            generations = self.response_cache.lookup(prompt, self.models[ranked[0].name]._get_llm_string(stop=stop, **kwargs))
+            if generations is not None:
+                return ChatResult(generations=generations)
+        name, result = self.router.call(
+            lambda endpoint: (endpoint.name,
+                              self.models[endpoint.name]._generate(messages, stop=stop, run_manager=run_manager, **kwargs))
+        )
+        self.response_cache.update(prompt, self.models[name]._get_llm_string(stop=stop, **kwargs), result.generations)
+        return result
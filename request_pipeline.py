@@ -0,0 +1,113 @@
+"""
+Staged processing of one user message with per-stage timing and budgets.
+
+A request runs through an ordered list of stages (for ChemistryLab:
+preprocess, retrieve, converse, annotate, evolve, persist). Each stage
+
+- can be switched off by configuration, unless it is required;
+- has a skip policy, a predicate on the request state returning the reason
+  to skip it this time (optional stages are also skipped once the request
+  has used up its overall budget);
+- gets a time budget, the smaller of its own and what is left of the
+  request's, which the stage applies to the calls it makes; a stage whose
+  work cannot be cut short treats it as advisory, and an overrun is
+  reported as "over_budget";
+- is timed, and the timing is reported per request and recorded as a
+  "stage" call in the telemetry aggregates.
+
+A failing required stage fails the request; a failing optional stage is
+logged and the request continues.
+"""
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+from telemetry import record
+
+logger = logging.getLogger(__name__)
+
+
+def parse_budgets(value: str, cast: Callable[[str], Union[int, float]] = float) -> Dict[str, Any]:
+    """Budgets from configuration text such as "retrieve=35,annotate=5"; malformed entries are ignored"""
+    budgets = {}
+    for item in (value or "").split(","):
+        name, _, amount = item.partition("=")
+        if not name.strip() or not amount.strip():
+            continue
+        try:
+            budgets[name.strip()] = cast(amount.strip())
+        except ValueError:
+            logger.warning(f"Ignoring malformed budget '{item.strip()}'")
+    return budgets
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable[[Any, Optional[float]], None]
+    budget: Optional[float] = None
+    skip: Optional[Callable[[Any], Optional[str]]] = None
+    required: bool = False
+
+
+class RequestPipeline:
+    """Ordered stages sharing one request state"""
+
+    def __init__(self, stages: List[Stage], enabled: Optional[Iterable[str]] = None,
+                 request_budget: Optional[float] = None):
+        """
+        Args:
+            stages: Stages in execution order
+            enabled: Names of the optional stages to run (all when None); required stages always run
+            request_budget (float): Seconds for the whole request; optional stages are skipped once it is spent
+        """
+        self.stages = stages
+        self.enabled = set(enabled) if enabled is not None else {stage.name for stage in stages}
+        self.request_budget = request_budget
+
+    def run(self, state: Any, report: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """
+        Run the stages on state and return their report, one entry per stage.
+
+        The entries are appended to report as the stages finish, so the caller keeps them
+        when a failed required stage re-raises its error.
+        """
+        report = report if report is not None else []
+        started = time.perf_counter()
+        for stage in self.stages:
+            remaining = self.request_budget - (time.perf_counter() - started) if self.request_budget else None
+            reason = None
+            if not stage.required and stage.name not in self.enabled:
+                reason = "disabled"
+            elif not stage.required and remaining is not None and remaining <= 0:
+                reason = "request_budget"
+            elif stage.skip is not None:
+                reason = stage.skip(state)
+            if reason:
+                report.append({"stage": stage.name, "status": "skipped", "reason": reason})
+                continue
+
+            budgets = [budget for budget in (stage.budget, remaining) if budget is not None]
+            budget = max(0.0, min(budgets)) if budgets else None
+            start = time.perf_counter()
+            error: Optional[Exception] = None
+            try:
+                stage.run(state, budget)
+            except Exception as e:
+                error = e
+            elapsed = time.perf_counter() - start
+            status = "failed" if error else ("over_budget" if budget is not None and elapsed > budget else "ok")
+            entry = {"stage": stage.name, "status": status, "elapsed": round(elapsed, 4),
+                     "budget": round(budget, 3) if budget is not None else None}
+            if error:
+                entry["error"] = str(error)
+            report.append(entry)
+            record("stage", stage.name, elapsed, error=error is not None)
+            if error:
+                if stage.required:
+                    raise error
+                logger.error(f"Stage {stage.name} failed, continuing without it: {str(error)}", exc_info=error)
+            elif status == "over_budget":
+                logger.warning(f"Stage {stage.name} took {elapsed:.2f}s, over its {budget:.2f}s budget")
+        return report
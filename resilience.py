@@ -0,0 +1,294 @@
+"""
+Shared resilience layer for external calls (LLaVA, Tavily, OpenAI).
+
+Every call to a backend goes through ``call(backend, fn, ...)``, which applies
+that backend's circuit breaker, retries with exponential backoff and full
+jitter, an optional hedged second request for tail latency, and records
+per-backend success and latency statistics. A backend whose breaker is open
+fails immediately with CircuitOpenError instead of waiting for retries.
+Only transient errors are retried (transport failures, timeouts, 5xx and
+429); a rejected request (other 4xx) fails at once and does not count
+against the backend's breaker. Callers wrapping an SDK client should turn
+its own retries off, so that exactly one layer retries.
+"""
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+import openai
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the backend while its circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Closed -> open after consecutive failures, half-open trial calls after reset_timeout"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_max_calls: int = 1,
+                 name: str = "backend"):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def _maybe_half_open(self) -> None:
+        if self._state == "open" and time.time() - self._opened_at >= self.reset_timeout:
+            self._state = "half_open"
+            self._trial_calls = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == "closed":
+                return True
+            if self._state == "half_open" and self._trial_calls < self.half_open_max_calls:
+                self._trial_calls += 1
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    logger.warning(f"Circuit for {self.name} opened after {self._failures} consecutive failures")
+                self._state = "open"
+                self._opened_at = time.time()
+
+
+_TRANSPORT_ERRORS = (ConnectionError, TimeoutError, httpx.TransportError, requests.ConnectionError,
+                     requests.Timeout, openai.APIConnectionError)
+
+
+def status_code(error: BaseException) -> Optional[int]:
+    """HTTP status of an SDK or HTTP client error, None when it has none"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether repeating the same request may succeed: transport errors, timeouts, 5xx and 429"""
+    if isinstance(error, _TRANSPORT_ERRORS):
+        return True
+    status = status_code(error)
+    return status is not None and (status == 429 or status >= 500)
+
+
+@dataclass
+class RetryPolicy:
+    """Exponential backoff with full jitter, for errors that retryable() accepts"""
+    attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    retryable: Callable[[BaseException], bool] = is_transient
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class BackendStats:
+    """Thread-safe success, failure and latency counters for one backend"""
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._counts = {"calls": 0, "successes": 0, "failures": 0, "retries": 0,
+                        "rejected": 0, "hedges": 0, "hedge_wins": 0}
+
+    def count(self, stat: str) -> None:
+        with self._lock:
+            self._counts[stat] += 1
+
+    def record_latency(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counts)
+            latencies = sorted(self._latencies)
+        attempts = stats["successes"] + stats["failures"]
+        stats["success_rate"] = round(stats["successes"] / attempts, 4) if attempts else None
+        if latencies:
+            stats["latency_p50"] = round(latencies[len(latencies) // 2], 3)
+            stats["latency_p95"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3)
+        return stats
+
+
+class ResilientBackend:
+    """Circuit breaker, retry policy, hedging and stats for one external backend"""
+
+    def __init__(self, name: str, policy: Optional[RetryPolicy] = None, breaker: Optional[CircuitBreaker] = None,
+                 hedge_after: Optional[float] = None):
+        """
+        Args:
+            name (str): Backend name used in logs and stats
+            policy (RetryPolicy): Retry and backoff settings
+            breaker (CircuitBreaker): Breaker shared by all calls to this backend
+            hedge_after (float): Seconds after which a second identical request is
+                started if the first has not returned; None disables hedging
+        """
+        self.name = name
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge_after = hedge_after
+        self.stats = BackendStats()
+
+    def _attempt(self, fn: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+        start = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.stats.count("failures")
+            if self.policy.retryable(e):
+                self.breaker.record_failure()
+            else:
+                # The backend answered; the request was at fault
+                self.breaker.record_success()
+            raise
+        self.stats.record_latency(time.time() - start)
+        self.stats.count("successes")
+        self.breaker.record_success()
+        return result
+
+    def _hedged_attempt(self, fn: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+        context = contextvars.copy_context()
+        primary = _hedge_executor.submit(context.run, self._attempt, fn, args, kwargs)
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done:
+            return primary.result()
+        if not self.breaker.allow():
+            return primary.result()
+        self.stats.count("hedges")
+        hedge = _hedge_executor.submit(contextvars.copy_context().run, self._attempt, fn, args, kwargs)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.stats.count("hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        self.stats.count("calls")
+        for attempt in range(self.policy.attempts):
+            if not self.breaker.allow():
+                self.stats.count("rejected")
+                raise CircuitOpenError(f"{self.name} is unavailable (circuit open)")
+            try:
+                if self.hedge_after is not None:
+                    return self._hedged_attempt(fn, args, kwargs)
+                return self._attempt(fn, args, kwargs)
+            except Exception as e:
+                if not self.policy.retryable(e) or attempt + 1 >= self.policy.attempts:
+                    raise
+                if self.breaker.state == "open":
+                    self.stats.count("rejected")
+                    raise CircuitOpenError(f"{self.name} is unavailable (circuit open)") from e
+                delay = self.policy.delay(attempt)
+                self.stats.count("retries")
+                logger.warning(f"{self.name} call failed ({str(e)}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+
+_hedge_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("GVIM_HEDGE_WORKERS", "8")), thread_name_prefix="hedge")
+_backends: Dict[str, ResilientBackend] = {}
+_backends_lock = threading.Lock()
+_call_observers: List[Callable[[str, float, Optional[Exception]], None]] = []
+
+
+def _env_float(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+def configure_backend(name: str, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                      failure_threshold: int = 5, reset_timeout: float = 30.0,
+                      hedge_after: Optional[float] = None) -> ResilientBackend:
+    """Register or replace a backend; GVIM_<NAME>_* environment variables override the arguments"""
+    prefix = f"GVIM_{name.upper()}_"
+    backend = ResilientBackend(
+        name,
+        policy=RetryPolicy(
+            attempts=int(os.environ.get(prefix + "ATTEMPTS", attempts)),
+            base_delay=float(os.environ.get(prefix + "BACKOFF", base_delay)),
+            max_delay=max_delay
+        ),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.environ.get(prefix + "BREAKER_THRESHOLD", failure_threshold)),
+            reset_timeout=float(os.environ.get(prefix + "BREAKER_RESET", reset_timeout)),
+            name=name
+        ),
+        hedge_after=_env_float(prefix + "HEDGE_AFTER") or hedge_after
+    )
+    with _backends_lock:
+        _backends[name] = backend
+    return backend
+
+
+def get_backend(name: str) -> ResilientBackend:
+    with _backends_lock:
+        backend = _backends.get(name)
+    return backend or configure_backend(name)
+
+
+def add_call_observer(observer: Callable[[str, float, Optional[Exception]], None]) -> None:
+    """Register observer(backend, seconds, error) to be told about every finished call, retries included"""
+    _call_observers.append(observer)
+
+
+def call(backend: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Call fn through the named backend's breaker, retries and hedging"""
+    start = time.perf_counter()
+    error = None
+    try:
+        return get_backend(backend).call(fn, *args, **kwargs)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        for observer in _call_observers:
+            try:
+                observer(backend, time.perf_counter() - start, error)
+            except Exception as e:
+                logger.warning(f"Call observer failed: {str(e)}")
+
+
+def backend_stats() -> Dict[str, Dict[str, Any]]:
+    with _backends_lock:
+        backends = dict(_backends)
+    return {name: dict(backend.stats.snapshot(), state=backend.breaker.state) for name, backend in backends.items()}
@@ -0,0 +1,117 @@
+"""
+Persistent TTL cache for results of external calls (web search, image analysis).
+
+Entries are stored with diskcache so they survive restarts and are shared by
+every worker process on the host. Within ``ttl`` an entry is fresh; for a
+further ``stale_ttl`` it is served immediately while a background refresh
+fetches a new value (stale-while-revalidate).
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import diskcache
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(*parts: Any) -> str:
+    """Hash JSON-serializable parts into a compact cache key"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PersistentTTLCache:
+    """Size-bounded on-disk cache with TTL, stale-while-revalidate and hit metrics"""
+
+    def __init__(self, directory: str, ttl: float = 3600, stale_ttl: float = 0,
+                 size_limit: int = 256 * 1024 * 1024, name: str = "cache",
+                 is_cacheable: Optional[Callable[[Any], bool]] = None):
+        """
+        Args:
+            directory (str): Cache directory, shared by all processes using it
+            ttl (float): Seconds an entry is fresh
+            stale_ttl (float): Extra seconds a stale entry may be served while refreshing
+            size_limit (int): Maximum cache size on disk in bytes (LRU eviction)
+            name (str): Name used in logs and metrics
+            is_cacheable: Predicate rejecting values that must not be stored (e.g. errors)
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.name = name
+        self.is_cacheable = is_cacheable or (lambda value: value is not None)
+        self._cache = diskcache.Cache(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        self._refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix=f"{name}-refresh")
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "stores": 0, "refreshes": 0, "refresh_errors": 0}
+
+    def _count(self, stat: str) -> None:
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def get(self, key: str) -> Tuple[Optional[Any], str]:
+        """Return (value, state) where state is 'fresh', 'stale' or 'miss'"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None, "miss"
+        age = time.time() - entry["stored_at"]
+        if age <= self.ttl:
+            return entry["value"], "fresh"
+        if age <= self.ttl + self.stale_ttl:
+            return entry["value"], "stale"
+        return None, "miss"
+
+    def set(self, key: str, value: Any) -> bool:
+        if not self.is_cacheable(value):
+            return False
+        self._cache.set(key, {"value": value, "stored_at": time.time()}, expire=self.ttl + self.stale_ttl)
+        self._count("stores")
+        return True
+
+    def _refresh(self, key: str, fetch: Callable[[], Any]) -> None:
+        try:
+            self.set(key, fetch())
+            self._count("refreshes")
+        except Exception as e:
+            self._count("refresh_errors")
+            logger.warning(f"Background refresh failed in {self.name}: {str(e)}")
+        finally:
+            with self._refresh_lock:
+                self._refreshing.discard(key)
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Any]) -> Any:
+        """Serve a fresh or stale value, fetching synchronously only on a miss"""
+        value, state = self.get(key)
+        if state == "fresh":
+            self._count("hits")
+            return value
+        if state == "stale":
+            self._count("stale_hits")
+            with self._refresh_lock:
+                start_refresh = key not in self._refreshing
+                self._refreshing.add(key)
+            if start_refresh:
+                self._refresh_executor.submit(self._refresh, key, fetch)
+            return value
+        self._count("misses")
+        value = fetch()
+        self.set(key, value)
+        return value
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["stale_hits"]) / lookups, 4) if lookups else 0.0
+        stats["entries"] = len(self._cache)
+        stats["size_bytes"] = self._cache.volume()
+        return stats
@@ -0,0 +1,120 @@
+"""
+Semantic answer cache for RAG queries.
+
+Queries are embedded and compared by cosine similarity against previously
+answered queries built on the same index version, so a re-worded repeat of a
+recent question returns the stored answer without retrieval or an LLM call.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticAnswerCache:
+    """Thread-safe LRU cache of answers keyed by query embedding and index version"""
+
+    def __init__(self, embeddings, threshold: float = 0.92, ttl_seconds: float = 3600, max_entries: int = 1000):
+        """
+        Args:
+            embeddings: Object exposing embed_query(text) -> List[float]
+            threshold (float): Minimum cosine similarity for a hit
+            ttl_seconds (float): Entries older than this are ignored and evicted
+            max_entries (int): LRU capacity
+        """
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "evicted": 0, "invalidated": 0}
+
+    def _embed(self, query: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _purge_expired(self, now: float) -> None:
+        expired = [key for key, entry in self._entries.items() if now - entry["created_at"] > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+        self._stats["expired"] += len(expired)
+
+    def lookup(self, query: str, index_version: str, vector: Optional[np.ndarray] = None) -> Optional[Any]:
+        """Return the cached answer for a semantically equivalent query, or None"""
+        vector = self._embed(query) if vector is None else vector
+        with self._lock:
+            self._purge_expired(time.time())
+            candidates = [(key, entry) for key, entry in self._entries.items() if entry["index_version"] == index_version]
+            if candidates:
+                matrix = np.stack([entry["vector"] for _, entry in candidates])
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    key, entry = candidates[best]
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    logger.info(f"Semantic cache hit ({scores[best]:.3f}) for '{query[:50]}' -> '{entry['query'][:50]}'")
+                    return entry["answer"]
+            self._stats["misses"] += 1
+            return None
+
+    def store(self, query: str, answer: Any, index_version: str, vector: Optional[np.ndarray] = None) -> None:
+        vector = self._embed(query) if vector is None else vector
+        with self._lock:
+            self._entries[self._next_id] = {
+                "query": query,
+                "vector": vector,
+                "answer": answer,
+                "index_version": index_version,
+                "created_at": time.time()
+            }
+            self._next_id += 1
+            self._stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evicted"] += 1
+
+    def get_or_compute(self, query: str, index_version: str, compute: Callable[[str], Any]) -> Any:
+        """Serve from cache or compute, embedding the query only once"""
+        vector = self._embed(query)
+        answer = self.lookup(query, index_version, vector=vector)
+        if answer is not None:
+            return answer
+        answer = compute(query)
+        if answer is not None and not (isinstance(answer, str) and answer.startswith("Error")):
+            self.store(query, answer, index_version, vector=vector)
+        return answer
+
+    def invalidate(self, keep_version: Optional[str] = None) -> int:
+        """Drop entries from other index versions (or all entries), returns the number removed"""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if keep_version is None or entry["index_version"] != keep_version]
+            for key in stale:
+                del self._entries[key]
+            self._stats["invalidated"] += len(stale)
+        if stale:
+            logger.info(f"Invalidated {len(stale)} semantic cache entries")
+        return len(stale)
+
+    def invalidate_version(self, index_version: str) -> int:
+        """Drop the entries built on one index version"""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry["index_version"] == index_version]
+            for key in stale:
+                del self._entries[key]
+            self._stats["invalidated"] += len(stale)
+        return len(stale)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return dict(self._stats, entries=len(self._entries),
+                        hit_rate=round(self._stats["hits"] / lookups, 4) if lookups else 0.0)
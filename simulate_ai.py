@@ -3,34 +3,60 @@ import os
 import random
 import re
 import base64
+import hashlib
 import io
 import warnings
 import logging
+import contextvars
+import threading
+import time
+import shutil
+import tempfile
 from collections import deque
-from typing import List, Dict, Any, Union, Set, Optional
-from dataclasses import dataclass
-from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from typing import Callable, List, Dict, Any, Union, Set, Optional, Tuple
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-import plotly.express as px
-import plotly.io as pio
 import autogen
 from autogen import Agent, AssistantAgent, ConversableAgent, UserProxyAgent
 from autogen.agentchat.contrib.llava_agent import LLaVAAgent
+from autogen.io import IOConsole, IOStream
 import replicate
 from PIL import Image
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
 from langchain.text_splitter import CharacterTextSplitter
 from langchain_openai import ChatOpenAI
 from langchain.chains import RetrievalQA
 from langchain_community.document_loaders import TextLoader, PyPDFLoader
 from langchain.agents import Tool
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from vector_store import QuantizedVectorStore, corpus_fingerprint, prune_stores
+from semantic_cache import SemanticAnswerCache
+from result_cache import PersistentTTLCache, make_cache_key
+from image_preprocessing import prepare_image
+import resilience
+import cassettes
+from intent_classifier import IntentClassifier
+from completion_cache import CompletionCache, LangChainCompletionCache, llm_caller, set_llm_caller
+from speaker_selection import SpeakerSelector, build_transition_graph
+from chat_controller import AdaptiveChatController
+from conversation_memory import ConversationMemory, reset_chat_state
+from model_router import ModelRouter, RankedConfigList, RoutedChatModel, RoutedOpenAIClient
+from telemetry import RequestTelemetry, TelemetryCallback, TelemetryLogger, current_telemetry, observe_backend_call, timed
+from lab_pool import LabPool
+from tool_executor import ParallelToolExecutor
+from request_pipeline import RequestPipeline, Stage, parse_budgets
+from chat_storage import ChatSessionStorage
 from tavily import TavilyClient
+from openai import OpenAI
 from rdkit import Chem
 from rdkit.Chem import AllChem, Draw, Descriptors, rdMolDescriptors
-from tenacity import retry, stop_after_attempt, wait_fixed
 import numpy as np
 from scipy import stats
 import py3Dmol
@@ -68,6 +94,158 @@ llava_config_list = [
         "base_url": "yorickvp/llava-13b:80537f9eead1a5bfa72d5ac6ea6414379be41d4d4f6679fd776e9535d1eb58bb",
     }
 ]
+
+# Point every external service at the local fakes from fake_services.py (load tests and offline benchmarks)
+USE_FAKE_SERVICES = os.environ.get("GVIM_FAKE_SERVICES", "False").lower() == "true"
+if USE_FAKE_SERVICES:
+    FAKE_OPENAI_URL = os.environ.get("GVIM_FAKE_OPENAI_URL", "http://127.0.0.1:8703/v1")
+    FAKE_TAVILY_URL = os.environ.get("GVIM_FAKE_TAVILY_URL", "http://127.0.0.1:8701")
+    os.environ["TAVILY_API_KEY"] = "tvly-fake"
+    # Read lazily by the replicate client on its first request
+    os.environ["REPLICATE_BASE_URL"] = os.environ.get("GVIM_FAKE_REPLICATE_URL", "http://127.0.0.1:8702")
+    os.environ["REPLICATE_API_TOKEN"] = "r8_fake"
+    for config in config_list:
+        config.update(api_key="fake", base_url=FAKE_OPENAI_URL)
+    logger.warning("Using fake external services, responses are synthetic")
+
+# Record external HTTP traffic to a cassette, or replay it from one with the recorded latency scaled
+CASSETTE_MODE = os.environ.get("GVIM_CASSETTE_MODE", "off").lower()
+CASSETTE_PATH = os.environ.get("GVIM_CASSETTE_PATH", os.path.join("instance", "cassettes", "simulate.json"))
+CASSETTE_LATENCY_SCALE = float(os.environ.get("GVIM_CASSETTE_LATENCY_SCALE", "1.0"))
+# Strict replay fails on any request not recorded verbatim; loose replay serves the next response for the URL
+CASSETTE_STRICT = os.environ.get("GVIM_CASSETTE_STRICT", "True").lower() == "true"
+if CASSETTE_MODE in ("record", "replay"):
+    if CASSETTE_MODE == "replay":
+        # Clients refuse to start without credentials, although replayed requests never leave the process
+        os.environ.setdefault("TAVILY_API_KEY", "tvly-replay")
+        os.environ.setdefault("REPLICATE_API_TOKEN", "r8_replay")
+    cassettes.install(cassettes.Cassette(CASSETTE_PATH, mode=CASSETTE_MODE, latency_scale=CASSETTE_LATENCY_SCALE,
+                                         strict=CASSETTE_STRICT))
+
+# Vector store backend for literature: "chroma" (in-process) or "quantized" (memory-mapped, shared across workers)
+VECTOR_BACKEND = os.environ.get("GVIM_VECTOR_BACKEND", "chroma").lower()
+VECTOR_STORE_DIR = os.environ.get("GVIM_VECTOR_STORE_DIR", os.path.join("instance", "vector_store"))
+VECTOR_STORE_DTYPE = os.environ.get("GVIM_VECTOR_STORE_DTYPE", "int8")
+# Stores of other corpora not opened for this many days are deleted
+VECTOR_STORE_MAX_AGE = float(os.environ.get("GVIM_VECTOR_STORE_MAX_AGE_DAYS", "30")) * 86400
+
+# Semantic cache for RAG answers
+RAG_CACHE_THRESHOLD = float(os.environ.get("GVIM_RAG_CACHE_THRESHOLD", "0.92"))
+RAG_CACHE_TTL = float(os.environ.get("GVIM_RAG_CACHE_TTL", "3600"))
+
+# Tavily search result cache
+SEARCH_CACHE_DIR = os.environ.get("GVIM_SEARCH_CACHE_DIR", os.path.join("instance", "search_cache"))
+SEARCH_CACHE_TTL = float(os.environ.get("GVIM_SEARCH_CACHE_TTL", "3600"))
+SEARCH_CACHE_STALE_TTL = float(os.environ.get("GVIM_SEARCH_CACHE_STALE_TTL", "86400"))
+SEARCH_CACHE_SIZE_LIMIT = int(os.environ.get("GVIM_SEARCH_CACHE_SIZE_MB", "256")) * 1024 * 1024
+
+# Image uploads: size limit, longest side sent to LLaVA (which sees 336x336) and JPEG quality
+IMAGE_MAX_UPLOAD_BYTES = int(os.environ.get("GVIM_IMAGE_MAX_UPLOAD_MB", "5")) * 1024 * 1024
+IMAGE_MAX_SIDE = int(os.environ.get("GVIM_IMAGE_MAX_SIDE", "672"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("GVIM_IMAGE_JPEG_QUALITY", "85"))
+# LLaVA answer cache keyed by prompt and image: "content" (same pixels) or "perceptual" (also re-compressed copies)
+IMAGE_CACHE_DIR = os.environ.get("GVIM_IMAGE_CACHE_DIR", os.path.join("instance", "image_cache"))
+IMAGE_CACHE_TTL = float(os.environ.get("GVIM_IMAGE_CACHE_TTL", str(7 * 24 * 3600)))
+IMAGE_CACHE_SIZE_LIMIT = int(os.environ.get("GVIM_IMAGE_CACHE_SIZE_MB", "64")) * 1024 * 1024
+IMAGE_CACHE_MATCH = os.environ.get("GVIM_IMAGE_CACHE_MATCH", "content").lower()
+
+# RAG tool output: "context" returns retrieved chunks to the calling agent, "qa" runs the RetrievalQA chain
+RAG_TOOL_MODE = os.environ.get("GVIM_RAG_TOOL_MODE", "context").lower()
+RAG_CONTEXT_K = int(os.environ.get("GVIM_RAG_CONTEXT_K", "4"))
+RAG_CONTEXT_TOKEN_BUDGET = int(os.environ.get("GVIM_RAG_CONTEXT_TOKEN_BUDGET", "1500"))
+
+# Pre-chat fan-out: seconds each call may take before the chat starts without its result
+PREFETCH_TIMEOUTS = {
+    "image_analysis": float(os.environ.get("GVIM_PREFETCH_IMAGE_TIMEOUT", "30")),
+    "web_search": float(os.environ.get("GVIM_PREFETCH_SEARCH_TIMEOUT", "10")),
+    "rag": float(os.environ.get("GVIM_PREFETCH_RAG_TIMEOUT", "15")),
+    "intent": float(os.environ.get("GVIM_PREFETCH_INTENT_TIMEOUT", "5")),
+}
+PREFETCH_WORKERS = int(os.environ.get("GVIM_PREFETCH_WORKERS", "8"))
+PREFETCH_INTENT = os.environ.get("GVIM_PREFETCH_INTENT", "True").lower() == "true"
+
+# Stored chat sessions (sessions.json): feedback, intent classifier training and restored conversations
+CHAT_HISTORY_DIR = os.environ.get("GVIM_CHAT_HISTORY_DIR", "chat_history")
+
+# Local search-intent classifier; the LLM is asked only below GVIM_INTENT_MIN_CONFIDENCE
+INTENT_LABELS_PATH = os.environ.get("GVIM_INTENT_LABELS_PATH", os.path.join("instance", "intent_labels.jsonl"))
+INTENT_MIN_CONFIDENCE = float(os.environ.get("GVIM_INTENT_MIN_CONFIDENCE", "0.7"))
+INTENT_AUDIT_RATE = float(os.environ.get("GVIM_INTENT_AUDIT_RATE", "0.05"))
+INTENT_MAX_LABELS = int(os.environ.get("GVIM_INTENT_MAX_LABELS", "5000"))
+
+# Persistent completion cache shared by agents, the group chat manager and the LangChain models.
+# The configs pin a seed, so sampled (temperature > 0) completions are cached too unless bypassed.
+COMPLETION_CACHE_ENABLED = os.environ.get("GVIM_COMPLETION_CACHE", "True").lower() == "true"
+COMPLETION_CACHE_DIR = os.environ.get("GVIM_COMPLETION_CACHE_DIR", os.path.join("instance", "completion_cache"))
+COMPLETION_CACHE_SIZE_LIMIT = int(os.environ.get("GVIM_COMPLETION_CACHE_SIZE_MB", "512")) * 1024 * 1024
+COMPLETION_CACHE_BYPASS_SAMPLED = os.environ.get("GVIM_COMPLETION_CACHE_BYPASS_SAMPLED", "False").lower() == "true"
+
+# Group chat speaker selection: "rules" routes locally and asks the LLM only when ambiguous, "auto" always asks
+SPEAKER_SELECTION = os.environ.get("GVIM_SPEAKER_SELECTION", "rules").lower()
+SPEAKER_SELECTION_MODEL = os.environ.get("GVIM_SPEAKER_SELECTION_MODEL", "True").lower() == "true"
+
+# Adaptive group chat budgets: the chat ends at the first exhausted budget or once answers stop adding anything new
+CHAT_MAX_ROUNDS = int(os.environ.get("GVIM_CHAT_MAX_ROUNDS", "12"))
+CHAT_TOKEN_BUDGET = int(os.environ.get("GVIM_CHAT_TOKEN_BUDGET", "6000"))
+CHAT_TIME_BUDGET = float(os.environ.get("GVIM_CHAT_TIME_BUDGET", "90"))
+CHAT_NOVELTY_THRESHOLD = float(os.environ.get("GVIM_CHAT_NOVELTY_THRESHOLD", "0.25"))
+CHAT_MIN_ROUNDS = int(os.environ.get("GVIM_CHAT_MIN_ROUNDS", "2"))
+# Agent rounds per search intent: small talk needs one answer, combined research questions a longer discussion
+CHAT_ROUND_BUDGETS = {"1": 4, "2": 6, "3": 8, "4": 2, **parse_budgets(os.environ.get("GVIM_CHAT_ROUND_BUDGETS", ""), int)}
+CHAT_DEFAULT_ROUND_BUDGET = int(os.environ.get("GVIM_CHAT_DEFAULT_ROUND_BUDGET", "6"))
+
+# Conversation memory: the group chat is reset per request and carries only a rolling
+# summary plus the most recent turns of the user's session, capped in tokens
+MEMORY_WINDOW_TURNS = int(os.environ.get("GVIM_MEMORY_WINDOW_TURNS", "4"))
+MEMORY_WINDOW_TOKENS = int(os.environ.get("GVIM_MEMORY_WINDOW_TOKENS", "1200"))
+MEMORY_SUMMARY_TOKENS = int(os.environ.get("GVIM_MEMORY_SUMMARY_TOKENS", "400"))
+MEMORY_LLM_SUMMARY = os.environ.get("GVIM_MEMORY_LLM_SUMMARY", "True").lower() == "true"
+
+# Route every LLM call to the fastest healthy config_list endpoint instead of walking the list in order
+MODEL_ROUTING = os.environ.get("GVIM_MODEL_ROUTING", "True").lower() == "true"
+MODEL_MAX_CONCURRENCY = int(os.environ.get("GVIM_MODEL_MAX_CONCURRENCY", "4"))
+MODEL_PROBE_INTERVAL = float(os.environ.get("GVIM_MODEL_PROBE_INTERVAL", "60"))
+# Idle endpoints are re-measured with a one-token completion, never with user requests
+MODEL_PROBE = os.environ.get("GVIM_MODEL_PROBE", "True").lower() == "true"
+
+# Per-call token, latency and cache accounting (autogen runtime logging, LangChain callbacks, tool and backend timers)
+TELEMETRY_ENABLED = os.environ.get("GVIM_TELEMETRY", "True").lower() == "true"
+
+# Pre-built labs: idle instances kept ready and requests served before a lab is replaced
+LAB_POOL_WARM = int(os.environ.get("GVIM_LAB_POOL_WARM", "1"))
+LAB_POOL_MAX_IDLE = int(os.environ.get("GVIM_LAB_POOL_MAX_IDLE", "4"))
+LAB_POOL_MAX_USES = int(os.environ.get("GVIM_LAB_POOL_MAX_USES", "200"))
+# Leasing: labs alive at once (requests processed concurrently) and seconds a request queues for one
+LAB_POOL_MAX_SIZE = int(os.environ.get("GVIM_LAB_POOL_MAX_SIZE", "4"))
+LAB_POOL_ACQUIRE_TIMEOUT = float(os.environ.get("GVIM_LAB_POOL_ACQUIRE_TIMEOUT", "120"))
+
+# ChemistryLab request pipeline: optional stages to run (preprocess and converse always run),
+# seconds per stage ("retrieve=20,annotate=3") and for the whole request, and the skip policies' thresholds.
+# Retrieve, converse, annotate and evolve stop at their budget; preprocess and persist only report overruns
+PIPELINE_STAGES = [stage.strip() for stage in os.environ.get("GVIM_PIPELINE_STAGES", "retrieve,annotate,evolve,persist").split(",") if stage.strip()]
+PIPELINE_STAGE_BUDGETS = {"preprocess": 2, "retrieve": 35, "converse": CHAT_TIME_BUDGET, "annotate": 5, "evolve": 2, "persist": 2,
+                          **parse_budgets(os.environ.get("GVIM_PIPELINE_STAGE_BUDGETS", ""))}
+REQUEST_BUDGET = float(os.environ.get("GVIM_REQUEST_BUDGET", "150"))
+# Messages shorter than this ("thanks", "ok") go to the agents without searches or image analysis
+RETRIEVE_MIN_CHARS = int(os.environ.get("GVIM_RETRIEVE_MIN_CHARS", "12"))
+# Stored feedback (topic specialists, agent learning) is re-read at most this often
+FEEDBACK_REFRESH_INTERVAL = float(os.environ.get("GVIM_FEEDBACK_REFRESH_INTERVAL", "300"))
+
+# Tool calls of one message run concurrently: pool size, default and per-tool timeouts (seconds)
+PARALLEL_TOOL_CALLS = os.environ.get("GVIM_PARALLEL_TOOL_CALLS", "True").lower() == "true"
+TOOL_WORKERS = int(os.environ.get("GVIM_TOOL_WORKERS", "8"))
+TOOL_TIMEOUT = float(os.environ.get("GVIM_TOOL_TIMEOUT", "60"))
+TOOL_TIMEOUTS = {"tavily_search_tool_function": 30, "rag_search_tool_function": 45, "analyze_and_plot_data": 90}
+
+# Stream LLM tokens of agent replies as they are generated (pushed to the browser by MessageStream)
+STREAM_TOKENS = os.environ.get("GVIM_STREAM_TOKENS", "True").lower() == "true"
+
+# Breakers and retry policies of the external backends (GVIM_<NAME>_* env vars override these).
+# Hedging is opt-in via GVIM_<NAME>_HEDGE_AFTER since a hedged LLaVA call is a second paid prediction.
+resilience.configure_backend("llava", attempts=2, base_delay=1.0, failure_threshold=3, reset_timeout=60)
+resilience.configure_backend("tavily", attempts=3, base_delay=0.5, failure_threshold=5, reset_timeout=30)
+resilience.configure_backend("openai", attempts=3, base_delay=0.5, failure_threshold=5, reset_timeout=30)
+
 @dataclass
 class WordFilter:
     """Filter for identifying common English words and patterns"""
@@ -579,6 +757,201 @@ def process_smiles_in_text(text: str) -> str:
     processor = get_global_smiles_processor()
     return processor.process_text(text)
 
+# Set bits per byte value, for Tanimoto similarity on packed fingerprints
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+class MoleculeIndex:
+    """
+    Fingerprint side index mapping molecules found in document chunks to chunk ids
+
+    Fingerprints are packed bit rows. An index built for the quantized vector store is
+    saved next to it and opened memory-mapped by every worker, with the SMILES and chunk
+    ids of a molecule read from disk only when it matches a query.
+    """
+
+    def __init__(self, validator: Optional[SmilesValidator] = None, radius: int = 2, n_bits: int = 2048):
+        self.validator = validator or SmilesValidator()
+        self.radius = radius
+        self.n_bits = n_bits
+        self._smiles: List[str] = []
+        self._fingerprint_rows: List[np.ndarray] = []
+        self._chunk_ids: List[Set[str]] = []
+        self._rows: Dict[str, int] = {}
+        self._matrix: Optional[np.ndarray] = None
+        # Set by load(): memory-mapped fingerprints and the molecule records on disk
+        self._row_offsets: Optional[np.ndarray] = None
+        self._row_file = None
+        self._row_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._fingerprints())
+
+    def _fingerprint(self, smiles: str) -> Optional[np.ndarray]:
+        mol = Chem.MolFromSmiles(smiles)
+        if mol is None:
+            return None
+        bits = AllChem.GetMorganFingerprintAsBitVect(mol, self.radius, nBits=self.n_bits).ToBitString()
+        return np.packbits(np.frombuffer(bits.encode("ascii"), dtype=np.uint8) - ord("0"))
+
+    def _fingerprints(self) -> np.ndarray:
+        if self._matrix is None:
+            self._matrix = (np.vstack(self._fingerprint_rows) if self._fingerprint_rows
+                            else np.empty((0, self.n_bits // 8), dtype=np.uint8))
+        return self._matrix
+
+    def _molecule(self, row: int) -> Tuple[str, List[str]]:
+        """(SMILES, chunk ids) of a row"""
+        if self._row_file is None:
+            return self._smiles[row], sorted(self._chunk_ids[row])
+        start, stop = int(self._row_offsets[row]), int(self._row_offsets[row + 1])
+        with self._row_lock:
+            self._row_file.seek(start)
+            record = json.loads(self._row_file.read(stop - start).decode("utf-8"))
+        return record["smiles"], record["chunks"]
+
+    def extract_smiles(self, text: str) -> List[str]:
+        """Return canonical SMILES for every valid molecule mentioned in text"""
+        if not text:
+            return []
+        found = []
+        for match in self.validator.smiles_pattern.finditer(text):
+            candidate = match.group(0)
+            if not self.validator.is_valid_smiles(candidate):
+                continue
+            mol = Chem.MolFromSmiles(candidate)
+            if mol is None:
+                continue
+            canonical = Chem.MolToSmiles(mol, canonical=True)
+            if canonical not in found:
+                found.append(canonical)
+        return found
+
+    def add_chunk(self, chunk_id: str, text: str) -> int:
+        """Index the molecules of a chunk, returns the number of molecules found"""
+        if self._row_file is not None:
+            raise RuntimeError("A molecule index opened from disk is read-only")
+        molecules = self.extract_smiles(text)
+        for smiles in molecules:
+            row = self._rows.get(smiles)
+            if row is None:
+                fingerprint = self._fingerprint(smiles)
+                if fingerprint is None:
+                    continue
+                row = len(self._smiles)
+                self._rows[smiles] = row
+                self._smiles.append(smiles)
+                self._fingerprint_rows.append(fingerprint)
+                self._chunk_ids.append(set())
+                self._matrix = None
+            self._chunk_ids[row].add(chunk_id)
+        return len(molecules)
+
+    def search(self, text: str, threshold: float = 0.6, top_k: int = 3, block_size: int = 65536) -> List[Tuple[str, float, str]]:
+        """
+        Find chunks containing molecules similar to those mentioned in text
+
+        Returns:
+            List of (chunk_id, tanimoto_similarity, matched_smiles), best first
+        """
+        fingerprints = self._fingerprints()
+        if not len(fingerprints):
+            return []
+        best: Dict[str, Tuple[float, str]] = {}
+        for smiles in self.extract_smiles(text):
+            query_fp = self._fingerprint(smiles)
+            if query_fp is None:
+                continue
+            for block_start in range(0, len(fingerprints), block_size):
+                block = np.asarray(fingerprints[block_start:block_start + block_size])
+                both = _POPCOUNT[block & query_fp].sum(axis=1, dtype=np.int32)
+                either = _POPCOUNT[block | query_fp].sum(axis=1, dtype=np.int32)
+                similarities = both / np.maximum(either, 1)
+                for offset in np.flatnonzero(similarities >= threshold):
+                    similarity = float(similarities[offset])
+                    matched, chunk_ids = self._molecule(block_start + int(offset))
+                    for chunk_id in chunk_ids:
+                        if chunk_id not in best or similarity > best[chunk_id][0]:
+                            best[chunk_id] = (similarity, matched)
+        ranked = sorted(best.items(), key=lambda item: item[1][0], reverse=True)
+        return [(chunk_id, round(score, 3), smiles) for chunk_id, (score, smiles) in ranked[:top_k]]
+
+    def save(self, directory: str) -> None:
+        """Write the index to directory; kept as is if another worker already wrote it"""
+        if os.path.isdir(directory):
+            return
+        parent = os.path.dirname(directory) or "."
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=".molecules-", dir=parent)
+        try:
+            offsets = np.zeros(len(self._smiles) + 1, dtype=np.int64)
+            with open(os.path.join(staging, "molecules.jsonl"), "wb") as f:
+                for row, smiles in enumerate(self._smiles):
+                    encoded = (json.dumps({"smiles": smiles, "chunks": sorted(self._chunk_ids[row])}) + "\n").encode("utf-8")
+                    f.write(encoded)
+                    offsets[row + 1] = offsets[row] + len(encoded)
+            np.save(os.path.join(staging, "fingerprints.npy"), self._fingerprints())
+            np.save(os.path.join(staging, "offsets.npy"), offsets)
+            with open(os.path.join(staging, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"radius": self.radius, "n_bits": self.n_bits, "molecules": len(self._smiles)}, f)
+            os.replace(staging, directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["MoleculeIndex"]:
+        """Open an index written by save(), memory-mapped; None if there is none"""
+        try:
+            with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            index = cls(radius=meta["radius"], n_bits=meta["n_bits"])
+            index._matrix = np.load(os.path.join(directory, "fingerprints.npy"), mmap_mode="r")
+            index._row_offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+            index._row_file = open(os.path.join(directory, "molecules.jsonl"), "rb")
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"No molecule index at {directory}: {str(e)}")
+            return None
+        return index
+
+def build_molecule_index(chunks: List[Document]) -> MoleculeIndex:
+    """Index the molecules mentioned in chunks (see load_corpus_chunks for their ids)"""
+    molecule_index = MoleculeIndex()
+    for chunk in chunks:
+        molecule_index.add_chunk(chunk.metadata["chunk_id"], chunk.page_content)
+    logger.info(f"Indexed {len(molecule_index)} molecules across {len(chunks)} chunks")
+    return molecule_index
+
+class StructureAwareRetriever(BaseRetriever):
+    """Vector retriever that also returns chunks mentioning molecules similar to those in the query"""
+
+    base_retriever: BaseRetriever
+    molecule_index: Any
+    # Chunk ids to documents: a dict lookup for in-memory stores, a disk read for the quantized store
+    get_chunks: Callable[[List[str]], List[Document]]
+    similarity_threshold: float = 0.6
+    max_structure_hits: int = 2
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        documents = self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        seen = {doc.metadata.get("chunk_id") for doc in documents}
+        hits = self.molecule_index.search(query, threshold=self.similarity_threshold, top_k=self.max_structure_hits + len(seen))
+        hits = [hit for hit in hits if hit[0] not in seen][:self.max_structure_hits]
+        chunks = {chunk.metadata.get("chunk_id"): chunk for chunk in self.get_chunks([chunk_id for chunk_id, _, _ in hits])}
+        added = 0
+        for chunk_id, similarity, smiles in hits:
+            chunk = chunks.get(chunk_id)
+            if chunk is None:
+                continue
+            metadata = dict(chunk.metadata, structure_match=smiles, structure_similarity=similarity)
+            documents.append(Document(page_content=chunk.page_content, metadata=metadata))
+            seen.add(chunk_id)
+            added += 1
+        if added:
+            logger.info(f"Structure search added {added} chunk(s) for query: {query[:50]}")
+        return documents
+
 def is_valid_url(url):
     regex = re.compile(
         r'^(?:http|ftp)s?://'  # http:// or https://
@@ -589,6 +962,14 @@ def is_valid_url(url):
         r'(?:/?|[/?]\S+)$', re.IGNORECASE)
     return re.match(regex, url) is not None
 
+image_analysis_cache = PersistentTTLCache(
+    IMAGE_CACHE_DIR,
+    ttl=IMAGE_CACHE_TTL,
+    size_limit=IMAGE_CACHE_SIZE_LIMIT,
+    name="llava",
+    is_cacheable=lambda answer: isinstance(answer, str) and not answer.startswith("Error")
+)
+
 def llava_call(prompt: str, image_data: Union[bytes, None] = None, config: Dict[str, Any] = None) -> str:
     if config is None:
         config = llava_config_list[0]
@@ -601,33 +982,43 @@ def llava_call(prompt: str, image_data: Union[bytes, None] = None, config: Dict[
     }
 
     if image_data:
+        # Validate image size
+        if len(image_data) > IMAGE_MAX_UPLOAD_BYTES:
+            return f"Error: Image size must be less than {IMAGE_MAX_UPLOAD_BYTES // (1024 * 1024)}MB"
         try:
-            # Validate image size (max 5MB)
-            if len(image_data) > 5 * 1024 * 1024:
-                return "Error: Image size must be less than 5MB"
-                
-            # Convert image data to base64
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
-            inputs["image"] = f"data:image/jpeg;base64,{image_base64}"
-            
-            output = replicate.run(base_url, input=inputs)
-            return "".join(output)
-            
-        except replicate.exceptions.ReplicateError as e:
-            logger.error(f"Replicate API error: {str(e)}")
-            return "Error: The model is currently busy. Please try again in a few moments."
+            # Send a downsized copy; the model does not use more resolution than this
+            image = prepare_image(image_data, max_side=IMAGE_MAX_SIDE, quality=IMAGE_JPEG_QUALITY)
         except Exception as e:
-            logger.error(f"Error calling LLaVA API: {str(e)}")
-            if "timeout" in str(e).lower():
-                return "Error: Request timed out. Please try with a smaller image or try again later."
+            logger.error(f"Error preparing image: {str(e)}")
             return f"Error processing image: {str(e)}"
+        logger.info(f"Prepared image {image.width}x{image.height} {image.mime_type}: {image.original_size} -> {len(image.data)} bytes")
+        inputs["image"] = image.data_uri()
+        # The same image with the same question is analyzed once; error answers are never stored
+        key = make_cache_key("llava", base_url, " ".join(prompt.split()), image.cache_key(IMAGE_CACHE_MATCH))
+        return image_analysis_cache.get_or_fetch(key, lambda: _llava_image_request(base_url, inputs))
     else:
         try:
-            output = replicate.run(base_url, input=inputs)
-            return "".join(output)
+            return resilience.call("llava", _llava_request, base_url, inputs)
         except Exception as e:
             logger.error(f"Error in LLaVA call: {str(e)}")
             return f"Error: {str(e)}"
+
+def _llava_image_request(base_url: str, inputs: Dict[str, Any]) -> str:
+    try:
+        return resilience.call("llava", _llava_request, base_url, inputs)
+    except resilience.CircuitOpenError:
+        return "Error: Image analysis is temporarily unavailable. Please try again in a few moments."
+    except replicate.exceptions.ReplicateError as e:
+        logger.error(f"Replicate API error: {str(e)}")
+        return "Error: The model is currently busy. Please try again in a few moments."
+    except Exception as e:
+        logger.error(f"Error calling LLaVA API: {str(e)}")
+        if "timeout" in str(e).lower():
+            return "Error: Request timed out. Please try with a smaller image or try again later."
+        return f"Error processing image: {str(e)}"
+
+def _llava_request(base_url: str, inputs: Dict[str, Any]) -> str:
+    return "".join(replicate.run(base_url, input=inputs))
         
 def load_documents(file_path):
     if not os.path.exists(file_path):
@@ -641,33 +1032,353 @@ def load_documents(file_path):
 
     return loader.load()
 
-# Load experiment data
-experiment_data = load_documents("E://HuaweiMoveData//Users//makangyong//Desktop//output.txt")
+def load_corpus_chunks(literature_path: str) -> List[Document]:
+    """Load the experiment data and literature and split them into chunks with ids"""
+    logger.info(f"Loading documents. Literature path: {literature_path}")
+    experiment_data = load_documents(EXPERIMENT_DATA_PATH)
+    logger.info(f"Loaded {len(experiment_data)} experiment documents")
+
+    literature = []
+    if literature_path:
+        if os.path.exists(literature_path):
+            literature = load_documents(literature_path)
+            logger.info(f"Loaded {len(literature)} literature documents from {literature_path}")
+        else:
+            logger.warning(f"Literature path does not exist: {literature_path}")
 
-# Load literature (if available)
-literature_path = ""  # Update this path if you have literature to load
-literature = load_documents(literature_path) if literature_path else []
+    all_documents = experiment_data + literature
+    logger.info(f"Total documents loaded: {len(all_documents)}")
+    if not all_documents:
+        return []
+    text_splitter = CharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=0)
+    texts = text_splitter.split_documents(all_documents)
+    for i, chunk in enumerate(texts):
+        chunk.metadata.setdefault("chunk_id", f"chunk-{i}")
+    logger.info(f"Split documents into {len(texts)} chunks")
+    return texts
 
-# Combine all documents
-all_documents = experiment_data + literature
+EXPERIMENT_DATA_PATH = os.environ.get("GVIM_EXPERIMENT_DATA_PATH", "E://HuaweiMoveData//Users//makangyong//Desktop//output.txt")
+CHUNK_SIZE = 1000
 
-# Check if we have any documents before proceeding
-if not all_documents:
-    logger.warning("No documents loaded. Skipping embedding and vector store creation.")
-    db = None
-else:
-    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-    texts = text_splitter.split_documents(all_documents)
+DEFAULT_RAG_COLLECTION = "default"
+_current_rag_collection = contextvars.ContextVar("rag_collection", default=DEFAULT_RAG_COLLECTION)
 
-    embeddings = HuggingFaceEmbeddings()
-    db = Chroma.from_documents(texts, embeddings)
+@contextmanager
+def use_rag_collection(name: Optional[str]):
+    """Route RAG tool calls made inside the block to the named collection"""
+    token = _current_rag_collection.set(name or DEFAULT_RAG_COLLECTION)
+    try:
+        yield
+    finally:
+        _current_rag_collection.reset(token)
 
-llm = ChatOpenAI(model_name="llama-3.3-70b-versatile", openai_api_key=config_list[0]["api_key"], openai_api_base=config_list[0]["base_url"])
-rag_chain = RetrievalQA.from_chain_type(
-    llm=llm,
-    chain_type="stuff",
-    retriever=db.as_retriever(search_kwargs={"k": 3})
-)
+class SharedEmbeddingWorker(Embeddings):
+    """
+    One embedding model instance served by a single worker thread
+
+    Document batches are submitted one at a time so query embeddings from
+    other requests can interleave with a large collection build.
+    """
+
+    def __init__(self, batch_size: int = 64):
+        self.batch_size = batch_size
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-worker")
+
+    def _get_model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    from langchain_huggingface import HuggingFaceEmbeddings
+                    self._model = HuggingFaceEmbeddings()
+                    logger.info("Loaded HuggingFace embedding model")
+        return self._model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            vectors.extend(self._executor.submit(lambda b=batch: self._get_model().embed_documents(b)).result())
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._executor.submit(lambda: self._get_model().embed_query(text)).result()
+
+class LiteratureIndex:
+    """Vector store, molecule index and QA chain for one literature path"""
+
+    def __init__(self, literature_path: str):
+        self.literature_path = literature_path
+        self.db = None
+        self.molecule_index = None
+        self.get_chunks: Optional[Callable[[List[str]], List[Document]]] = None
+        self.index_version = None
+        self.rag_chain = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def build(self, embeddings, llm) -> None:
+        try:
+            if VECTOR_BACKEND == "quantized":
+                self._open_quantized(embeddings)
+            else:
+                self._build_in_memory(embeddings)
+            if self.db is None:
+                logger.warning("No documents loaded. Skipping embedding and vector store creation.")
+            else:
+                self.rag_chain = RetrievalQA.from_chain_type(
+                    llm=llm,
+                    chain_type="stuff",
+                    retriever=self.get_retriever()
+                )
+        except Exception as e:
+            logger.error(f"Error creating vector store: {str(e)}", exc_info=True)
+            self.db = None
+            self.rag_chain = None
+        self.loaded = True
+
+    def _build_in_memory(self, embeddings) -> None:
+        texts = load_corpus_chunks(self.literature_path)
+        if not texts:
+            return
+        # Side index of molecules mentioned in the chunks for structure-aware retrieval
+        self.molecule_index = build_molecule_index(texts)
+        chunks_by_id = {chunk.metadata["chunk_id"]: chunk for chunk in texts}
+        self.get_chunks = lambda ids: [chunks_by_id[chunk_id] for chunk_id in ids if chunk_id in chunks_by_id]
+        from langchain_community.vectorstores import Chroma
+        self.db = Chroma.from_documents(texts, embeddings)
+        logger.info("Successfully created Chroma vector store")
+        self.index_version = corpus_fingerprint([EXPERIMENT_DATA_PATH, self.literature_path], extra=str(len(texts)))
+
+    def _open_quantized(self, embeddings) -> None:
+        """Open the shared store for this corpus; only the worker that builds it loads the documents"""
+        sources = [EXPERIMENT_DATA_PATH, self.literature_path]
+        corpus_key = corpus_fingerprint(sources, extra=f"{CHUNK_SIZE}:{VECTOR_STORE_DTYPE}")
+        directory = os.path.join(VECTOR_STORE_DIR, corpus_key)
+        molecule_directory = os.path.join(directory, "molecules")
+
+        def load():
+            texts = load_corpus_chunks(self.literature_path)
+            # Written before the store is published, so whoever finds the store finds its molecules
+            build_molecule_index(texts).save(molecule_directory)
+            return [t.page_content for t in texts], [t.metadata for t in texts]
+
+        store = QuantizedVectorStore.open_or_build(embeddings, directory, corpus_key, load,
+                                                   dtype=VECTOR_STORE_DTYPE, sources=sources)
+        prune_stores(VECTOR_STORE_DIR, keep=corpus_key, sources=sources, max_age=VECTOR_STORE_MAX_AGE)
+        if not len(store):
+            return
+        logger.info(f"Using quantized vector store with {len(store)} rows ({VECTOR_STORE_DTYPE})")
+        self.db = store
+        self.molecule_index = MoleculeIndex.load(molecule_directory)
+        self.get_chunks = store.get_by_ids
+        self.index_version = corpus_key
+
+    def get_retriever(self, k: int = 3):
+        retriever = self.db.as_retriever(search_kwargs={"k": k})
+        if self.molecule_index is not None and len(self.molecule_index) > 0:
+            return StructureAwareRetriever(
+                base_retriever=retriever,
+                molecule_index=self.molecule_index,
+                get_chunks=self.get_chunks
+            )
+        return retriever
+
+class RagService:
+    """
+    Process-wide RAG state shared by the agent tools and every ChemistryLab
+
+    Nothing is loaded at import time. Named collections (one per user or
+    project) map to a literature path; each path is indexed once, on first
+    use or by an explicit warmup, and all indexes share one embedding worker,
+    one QA LLM client and one semantic answer cache.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.embeddings = SharedEmbeddingWorker()
+        self._llm = None
+        self._collections: Dict[str, str] = {DEFAULT_RAG_COLLECTION: ""}
+        self._indexes: Dict[str, LiteratureIndex] = {}
+        self.answer_cache = SemanticAnswerCache(self.embeddings, threshold=RAG_CACHE_THRESHOLD, ttl_seconds=RAG_CACHE_TTL)
+        # Retrieved passages of context mode, kept apart from the QA answers of the same queries
+        self.context_cache = SemanticAnswerCache(self.embeddings, threshold=RAG_CACHE_THRESHOLD, ttl_seconds=RAG_CACHE_TTL)
+
+    @classmethod
+    def get_instance(cls) -> "RagService":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def get_llm(self):
+        if self._llm is None:
+            with self._lock:
+                if self._llm is None:
+                    # Only called through resilience.call, which owns the retries
+                    self._llm = ChatOpenAI(model_name="llama-3.3-70b-versatile", openai_api_key=config_list[0]["api_key"], openai_api_base=config_list[0]["base_url"],
+                                           max_retries=0, cache=langchain_cache_for("rag_qa", 0.7),
+                                           callbacks=[TelemetryCallback("rag_qa")] if TELEMETRY_ENABLED else None)
+        return self._llm
+
+    def configure_collection(self, name: str, literature_path: str = "") -> None:
+        """Point a collection at a literature path; the index is built on first use"""
+        with self._lock:
+            previous = self._collections.get(name)
+            self._collections[name] = literature_path or ""
+        if previous is not None and previous != (literature_path or ""):
+            logger.info(f"Collection '{name}' switched from '{previous}' to '{literature_path}'")
+            self._release_unused_indexes()
+
+    def _release_unused_indexes(self) -> None:
+        with self._lock:
+            in_use = set(self._collections.values())
+            for path in [p for p in self._indexes if p not in in_use]:
+                index = self._indexes.pop(path)
+                if index.index_version:
+                    self.answer_cache.invalidate_version(index.index_version)
+                    self.context_cache.invalidate_version(index.index_version)
+                logger.info(f"Released index for literature path '{path}'")
+
+    def collection_path(self, name: Optional[str] = None) -> str:
+        name = name or _current_rag_collection.get()
+        with self._lock:
+            return self._collections.get(name, self._collections[DEFAULT_RAG_COLLECTION])
+
+    def peek_index(self, name: Optional[str] = None) -> Optional[LiteratureIndex]:
+        """Return the collection's index if it exists, without building it"""
+        with self._lock:
+            return self._indexes.get(self.collection_path(name))
+
+    def has_documents(self, name: Optional[str] = None) -> bool:
+        """Whether the collection's index has documents to search; before it is built, whether any of its sources exist"""
+        index = self.peek_index(name)
+        if index is not None and index.loaded:
+            return index.rag_chain is not None
+        return any(path and os.path.exists(path) for path in (EXPERIMENT_DATA_PATH, self.collection_path(name)))
+
+    def get_index(self, name: Optional[str] = None) -> LiteratureIndex:
+        """Return the collection's index, building it if needed; other collections are not blocked"""
+        path = self.collection_path(name)
+        with self._lock:
+            index = self._indexes.get(path)
+            if index is None:
+                index = self._indexes[path] = LiteratureIndex(path)
+        if not index.loaded:
+            with index.lock:
+                if not index.loaded:
+                    index.build(self.embeddings, self.get_llm())
+        return index
+
+    def ensure_index(self, literature_path: str = "", collection: str = DEFAULT_RAG_COLLECTION) -> LiteratureIndex:
+        self.configure_collection(collection, literature_path)
+        return self.get_index(collection)
+
+    def search(self, query: str, collection: Optional[str] = None) -> Union[Dict[str, Any], str]:
+        index = self.get_index(collection)
+        if index.rag_chain is None:
+            return "RAG search is not available - no documents loaded"
+        try:
+            return self.answer_cache.get_or_compute(
+                query, index.index_version, lambda q: resilience.call("openai", index.rag_chain.invoke, {"query": q}))
+        except Exception as e:
+            logger.error(f"Error in RAG search for '{query}': {e}", exc_info=True)
+            return f"Error performing RAG search: {str(e)}"
+
+    def retrieve_context(self, query: str, collection: Optional[str] = None, k: int = RAG_CONTEXT_K,
+                         token_budget: int = RAG_CONTEXT_TOKEN_BUDGET) -> str:
+        """Return the top-k chunks with their sources, trimmed to token_budget, without an LLM call"""
+        index = self.get_index(collection)
+        if index.db is None:
+            return "RAG search is not available - no documents loaded"
+        compute = lambda q: self._format_context(index, q, k, token_budget)
+        if (k, token_budget) != (RAG_CONTEXT_K, RAG_CONTEXT_TOKEN_BUDGET):
+            # Cached passages are shaped by the default k and budget
+            return compute(query)
+        return self.context_cache.get_or_compute(query, index.index_version, compute)
+
+    def _format_context(self, index: LiteratureIndex, query: str, k: int, token_budget: int) -> str:
+        try:
+            documents = index.get_retriever(k=k).invoke(query)
+        except Exception as e:
+            logger.error(f"Error retrieving RAG context for '{query}': {e}", exc_info=True)
+            return f"Error performing RAG search: {str(e)}"
+        if not documents:
+            return f"No relevant passages found in the loaded documents for: {query}"
+
+        sections = []
+        remaining = token_budget
+        for i, doc in enumerate(documents, 1):
+            header = f"[{i}] {format_source(doc.metadata)}"
+            available = remaining - count_tokens(header) - 1
+            if available <= 0:
+                break
+            content = truncate_to_tokens(doc.page_content.strip(), available)
+            sections.append(f"{header}\n{content}")
+            remaining -= count_tokens(header) + count_tokens(content) + 1
+        return f"Retrieved passages for '{query}':\n\n" + "\n\n".join(sections)
+
+    def warmup(self, literature_path: str = "", collection: str = DEFAULT_RAG_COLLECTION) -> None:
+        """Load the embedding model and build the index ahead of the first request"""
+        start = time.time()
+        self.ensure_index(literature_path, collection)
+        self.embeddings.embed_query("warmup")
+        logger.info(f"RAG service warmed up in {time.time() - start:.2f}s")
+
+    def collections(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                name: {"literature_path": path, "loaded": path in self._indexes and self._indexes[path].loaded}
+                for name, path in self._collections.items()
+            }
+
+@lru_cache(maxsize=1)
+def _get_token_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken unavailable, estimating tokens from length: {str(e)}")
+        return None
+
+def count_tokens(text: str) -> int:
+    encoding = _get_token_encoding()
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text))
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    encoding = _get_token_encoding()
+    if encoding is None:
+        return text if len(text) <= max_tokens * 4 else text[:max_tokens * 4] + "..."
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens]) + "..."
+
+def format_source(metadata: Dict[str, Any]) -> str:
+    """Describe where a retrieved chunk came from"""
+    source = os.path.basename(str(metadata.get("source", ""))) or "unknown source"
+    parts = [f"source: {source}"]
+    if "page" in metadata:
+        parts.append(f"page {int(metadata['page']) + 1}")
+    if metadata.get("chunk_id"):
+        parts.append(metadata["chunk_id"])
+    if metadata.get("structure_match"):
+        parts.append(f"structure match: {metadata['structure_match']} ({metadata.get('structure_similarity')})")
+    return " | ".join(parts)
+
+def get_rag_service() -> RagService:
+    """Get the process-wide RAG service"""
+    return RagService.get_instance()
+
+def get_rag_chain(collection: Optional[str] = None):
+    """Get the RetrievalQA chain of a collection (the current one by default), building it on first use"""
+    return get_rag_service().get_index(collection).rag_chain
 
 # Initialize Tavily client with error handling and fallback
 def fallback_search(query):
@@ -676,20 +1387,49 @@ def fallback_search(query):
 
 try:
     tavily_client = TavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+    if USE_FAKE_SERVICES:
+        tavily_client.base_url = f"{FAKE_TAVILY_URL}/search"
 except Exception as e:
     logger.error(f"Error initializing Tavily client: {str(e)}")
     tavily_client = None
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+search_cache = PersistentTTLCache(
+    SEARCH_CACHE_DIR,
+    ttl=SEARCH_CACHE_TTL,
+    stale_ttl=SEARCH_CACHE_STALE_TTL,
+    size_limit=SEARCH_CACHE_SIZE_LIMIT,
+    name="tavily",
+    is_cacheable=lambda results: isinstance(results, list)  # error strings are never cached
+)
+
+def normalize_search_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+@timed("tool")
 def tavily_search_tool_function(query: str, url: Optional[str] = None) -> Union[List[Dict[str, str]], str]: # <--- MODIFIED NAME and added type hints
+    context = get_request_context()
+    if context is not None:
+        return context.web_search(query, url)
+    return cached_tavily_search(query, url)
+
+def cached_tavily_search(query: str, url: Optional[str] = None) -> Union[List[Dict[str, str]], str]:
     if tavily_client is None: return "Tavily client not available."
+    include_domains = [url] if url and is_valid_url(url) else []
+    key = make_cache_key("tavily", normalize_search_query(query), sorted(include_domains))
+    # Cache hits skip both the network call and the retry delays
+    return search_cache.get_or_fetch(key, lambda: _tavily_search_uncached(query, url))
+
+def _tavily_search_uncached(query: str, url: Optional[str] = None) -> Union[List[Dict[str, str]], str]:
     try:
         search_params: Dict[str, Any] = {"query": query, "search_depth": "advanced", "max_results": 5, "include_answer": True}
         if url and is_valid_url(url): search_params["include_domains"] = [url]
-        response = tavily_client.search(**search_params)
+        response = resilience.call("tavily", tavily_client.search, **search_params)
         results = [{"url": obj.get("url",""), "title": obj.get("title","N/A"), "content": obj.get("content","")} for obj in response.get("results",[])]
         if response.get("answer"): results.insert(0, {"title": "Tavily Answer", "content": response["answer"], "url": ""})
         return results
+    except resilience.CircuitOpenError as e:
+        logger.warning(f"Skipping Tavily search for '{query}': {e}")
+        return f"Error during Tavily search: {str(e)}"
     except Exception as e: 
         logger.error(f"Error in Tavily search for '{query}': {e}", exc_info=True)
         return f"Error during Tavily search: {str(e)}"
@@ -704,27 +1444,162 @@ tavily_tool = Tool(
     description="Useful for searching the internet for recent information on Chemistry."
 )
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+@timed("tool")
 def rag_search_tool_function(query: str) -> Union[Dict[str, Any], str]: # <--- MODIFIED NAME and added type hints
-    rag_chain_local = get_rag_chain() # Assuming get_rag_chain() correctly fetches your RAG chain
-    if rag_chain_local is None: return "RAG chain is not initialized."
-    try: 
-        return rag_chain_local.invoke({"query": query})
-    except Exception as e: 
-        logger.error(f"Error in RAG search for '{query}': {e}", exc_info=True)
-        return f"Error performing RAG search: {str(e)}"
+    context = get_request_context()
+    if context is not None:
+        return context.rag_search(query)
+    return rag_lookup(query)
+
+def rag_lookup(query: str) -> Union[Dict[str, Any], str]:
+    if RAG_TOOL_MODE == "qa":
+        return get_rag_service().search(query)
+    # Hand the raw passages to the calling agent instead of summarizing them with a second LLM call
+    return get_rag_service().retrieve_context(query)
+
+_current_request_context = contextvars.ContextVar("request_context", default=None)
+
+class RequestContext:
+    """
+    Memoizes image analysis, web search and RAG results for one user message
+
+    The /simulate route and ChemistryLab share the same context (and the agent
+    tools pick it up from a context variable), so each external call with the
+    same inputs runs at most once per message. Concurrent callers with the same
+    key wait for the first call instead of repeating it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures: Dict[Tuple, Future] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+        # Results of the pre-chat fan-out that finished within their timeouts
+        self.prefetched: Dict[str, Any] = {}
+        self.prefetch_timings: Dict[str, Optional[float]] = {}
+        # Rounds, tokens and stop reason of the group chat
+        self.chat_report: Optional[Dict[str, Any]] = None
+        # Tokens, latency and cache status of every LLM, tool and external call
+        self.telemetry = RequestTelemetry()
+        # Status, time and budget of each request pipeline stage
+        self.stage_report: List[Dict[str, Any]] = []
+
+    def _memoize(self, kind: str, key: Tuple, compute):
+        with self._lock:
+            stats = self._stats.setdefault(kind, {"calls": 0, "reused": 0})
+            future = self._futures.get((kind,) + key)
+            owner = future is None
+            if owner:
+                future = self._futures[(kind,) + key] = Future()
+                stats["calls"] += 1
+            else:
+                stats["reused"] += 1
+        if owner:
+            try:
+                future.set_result(compute())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def analyze_image(self, prompt: str, image_data: bytes) -> str:
+        image_hash = hashlib.sha256(image_data).hexdigest()
+        return self._memoize("llava", (image_hash, prompt), lambda: llava_call(prompt, image_data, llava_config_list[0]))
+
+    def web_search(self, query: str, url: Optional[str] = None) -> Union[List[Dict[str, str]], str]:
+        url = url if url and is_valid_url(url) else None
+        return self._memoize("web_search", (normalize_search_query(query), url), lambda: cached_tavily_search(query, url))
+
+    def rag_search(self, query: str) -> Union[Dict[str, Any], str]:
+        collection = _current_rag_collection.get()
+        return self._memoize("rag", (collection, RAG_TOOL_MODE, query.strip()), lambda: rag_lookup(query))
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {kind: dict(counts) for kind, counts in self._stats.items()}
+
+    @contextmanager
+    def activate(self):
+        token = _current_request_context.set(self)
+        try:
+            with self.telemetry.activate():
+                yield self
+        finally:
+            _current_request_context.reset(token)
+
+def get_request_context() -> Optional[RequestContext]:
+    """Get the context of the user message being processed, if any"""
+    return _current_request_context.get()
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+def run_concurrently(calls: Dict[str, Any], timeouts: Optional[Dict[str, float]] = None,
+                     default_timeout: float = 10.0) -> Tuple[Dict[str, Any], Dict[str, Optional[float]]]:
+    """
+    Start independent calls together and collect those that finish within their timeouts
+
+    Each call runs in a copy of the caller's context, so the active request context and
+    RAG collection apply inside it. Calls that time out keep running in the background
+    (their memoized result is still reused later in the request) but are left out.
+
+    Returns:
+        (results, timings): results of the calls that completed, and seconds per call
+        (None for calls that timed out or failed)
+    """
+    timeouts = timeouts or {}
+    start = time.time()
+    futures = {}
+    finished_at = {}
+    for name, call in calls.items():
+        def _run_one(call=call, name=name):
+            try:
+                return call()
+            finally:
+                finished_at[name] = time.time()
+        futures[name] = _prefetch_executor.submit(contextvars.copy_context().run, _run_one)
+
+    results: Dict[str, Any] = {}
+    timings: Dict[str, Optional[float]] = {}
+    for name, future in futures.items():
+        deadline = start + timeouts.get(name, default_timeout)
+        try:
+            results[name] = future.result(timeout=max(0.0, deadline - time.time()))
+            timings[name] = round(finished_at.get(name, time.time()) - start, 3)
+        except FutureTimeoutError:
+            timings[name] = None
+            logger.warning(f"{name} did not finish within {timeouts.get(name, default_timeout)}s, continuing without it")
+        except Exception as e:
+            timings[name] = None
+            logger.error(f"{name} failed during prefetch: {str(e)}")
+    logger.info(f"Prefetch finished in {time.time() - start:.2f}s: {timings}")
+    return results, timings
+
+if TELEMETRY_ENABLED:
+    # autogen reports every completion (cache hits and speaker selection included) to the telemetry logger
+    autogen.runtime_logging.start(logger=TelemetryLogger())
+    resilience.add_call_observer(observe_backend_call)
+
+def probe_model_endpoint(endpoint) -> None:
+    """One-token completion timing an idle endpoint"""
+    client = OpenAI(api_key=endpoint.api_key, base_url=endpoint.base_url, max_retries=0, timeout=10)
+    client.chat.completions.create(model=endpoint.model, messages=[{"role": "user", "content": "ping"}], max_tokens=1)
+
+model_router = ModelRouter(config_list, max_concurrency=MODEL_MAX_CONCURRENCY, probe_interval=MODEL_PROBE_INTERVAL,
+                           probe=probe_model_endpoint if MODEL_PROBE else None)
+# A single entry served by RoutedOpenAIClient, which replaces the model with the serving endpoint's
+routed_config_list = [{"model": config_list[0]["model"], "model_client_cls": "RoutedOpenAIClient"}]
 
 agent_llm_config = {
-    "config_list": config_list,
+    "config_list": routed_config_list if MODEL_ROUTING else config_list,
     "timeout": 60,  # 建议值，您可以调整
     "temperature": 0.8, # 建议值
     "seed": 1234,        # 建议值
+    "cache_seed": None,  # legacy per-seed disk cache replaced by completion_cache
+    "stream": STREAM_TOKENS,
     "tools": [  # 使用正确的 "tools" 格式
         {
             "type": "function",
             "function": {
                 "name": "rag_search_tool_function", # 确保与注册的函数名一致
-                "description": "Search in the loaded chemical documents, experimental data, and literature using RAG. Use for specific, in-depth questions.",
+                "description": "Search in the loaded chemical documents, experimental data, and literature using RAG. Returns the most relevant passages with their sources. Use for specific, in-depth questions.",
                 "parameters": {
                     "type": "object",
                     "properties": {"query": {"type": "string", "description": "The detailed query for document search."}},
@@ -781,12 +1656,48 @@ agent_llm_config = {
 }
 
 manager_llm_config = {
-    "config_list": config_list,
+    # LLM speaker selection builds a fresh client from this on every call, so it reads the router's ranking
+    "config_list": RankedConfigList(model_router) if MODEL_ROUTING else config_list,
     "timeout": 60,
     "temperature": 0.8,
-    "seed": 1234
+    "seed": 1234,
+    "cache_seed": None
 }
 
+completion_cache = CompletionCache(COMPLETION_CACHE_DIR, size_limit=COMPLETION_CACHE_SIZE_LIMIT) if COMPLETION_CACHE_ENABLED else None
+
+def completion_cache_for(temperature: float) -> Optional[CompletionCache]:
+    """The shared completion cache, or None when disabled or bypassed for sampled completions"""
+    if completion_cache is None or (COMPLETION_CACHE_BYPASS_SAMPLED and temperature > 0):
+        return None
+    return completion_cache
+
+def langchain_cache_for(caller: str, temperature: float) -> Optional[LangChainCompletionCache]:
+    cache = completion_cache_for(temperature)
+    return LangChainCompletionCache(cache, caller) if cache is not None else None
+
+def use_model_router(agent: autogen.ConversableAgent) -> autogen.ConversableAgent:
+    """Activate the routed client of an agent created with agent_llm_config"""
+    if MODEL_ROUTING:
+        agent.register_model_client(RoutedOpenAIClient, router=model_router, timeout=agent_llm_config["timeout"],
+                                    cache=completion_cache_for(agent_llm_config["temperature"]))
+    return agent
+
+def routed_chat_model(caller: str, temperature: float = 0.7) -> ChatOpenAI:
+    """LangChain chat model over the config_list endpoints, routed like the agents unless routing is off"""
+    if not MODEL_ROUTING:
+        return ChatOpenAI(model_name="llama3-70b-8192", temperature=temperature, openai_api_key=config_list[1]["api_key"],
+                          openai_api_base=config_list[1]["base_url"], cache=langchain_cache_for(caller, temperature),
+                          callbacks=[TelemetryCallback(caller)] if TELEMETRY_ENABLED else None)
+    models = {
+        endpoint.name: ChatOpenAI(model_name=endpoint.model, temperature=temperature, openai_api_key=endpoint.api_key,
+                                  openai_api_base=endpoint.base_url, max_retries=0, http_client=model_router.http_client(endpoint))
+        for endpoint in model_router.endpoints
+    }
+    return RoutedChatModel(router=model_router, models=models, model_name=f"{config_list[0]['model']}@{temperature}",
+                           response_cache=langchain_cache_for(caller, temperature),
+                           callbacks=[TelemetryCallback(caller)] if TELEMETRY_ENABLED else None)
+
 def process_smiles(smiles):
     try:
         mol = Chem.MolFromSmiles(smiles)
@@ -1123,9 +2034,117 @@ class PerformanceTest:
         
         return results
 
+_current_message_stream = contextvars.ContextVar("message_stream", default=None)
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+
+class MessageStream:
+    """
+    Pushes the group-chat messages and tokens of one request to a listener as they are produced
+
+    emit(event, payload) is called with 'agentTyping' when an agent starts a reply,
+    'agentToken' for each streamed token of that reply and 'agentMessage' with the
+    SMILES-annotated content once the reply is sent. Agent hooks registered in
+    ChemistryLab.setup_groupchat find the stream of the running request through a
+    context variable, so concurrent requests on the same lab do not mix.
+    """
+
+    def __init__(self, emit, annotate=process_smiles_in_text):
+        self.emit = emit
+        self.annotate = annotate
+        self.speaker: Optional[str] = None
+        self.message_count = 0
+        self.started_at = time.time()
+        self.first_output_at: Optional[float] = None
+
+    def _send(self, event: str, payload: Dict[str, Any]) -> None:
+        if self.first_output_at is None and event in ("agentToken", "agentMessage"):
+            self.first_output_at = time.time()
+        try:
+            self.emit(event, payload)
+        except Exception as e:
+            logger.warning(f"Failed to stream {event}: {str(e)}")
+
+    def reply_started(self, name: str) -> None:
+        self.speaker = name
+        self._send("agentTyping", {"name": name})
+
+    def token(self, text: str) -> None:
+        if self.speaker and text:
+            self._send("agentToken", {"name": self.speaker, "token": text})
+
+    def message(self, name: str, content: str) -> None:
+        self.speaker = None
+        self._send("agentMessage", {"name": name, "content": self.annotate(content), "index": self.message_count})
+        self.message_count += 1
+
+    def time_to_first_output(self) -> Optional[float]:
+        return round(self.first_output_at - self.started_at, 3) if self.first_output_at else None
+
+    @contextmanager
+    def activate(self):
+        token = _current_message_stream.set(self)
+        try:
+            with IOStream.set_default(StreamingIOStream(self)):
+                yield self
+        finally:
+            _current_message_stream.reset(token)
+
+class StreamingIOStream:
+    """autogen IOStream that forwards streamed LLM tokens to a MessageStream and the rest to the console"""
+
+    def __init__(self, stream: MessageStream):
+        self.stream = stream
+        self.console = IOConsole()
+
+    def print(self, *objects: Any, sep: str = " ", end: str = "\n", flush: bool = False) -> None:
+        # The OpenAI client prints streamed chunks with end=""; agent transcripts use newlines
+        if end == "" and self.stream.speaker:
+            self.stream.token(_ANSI_ESCAPE.sub("", sep.join(str(obj) for obj in objects)))
+        else:
+            self.console.print(*objects, sep=sep, end=end, flush=flush)
+
+    def input(self, prompt: str = "", *, password: bool = False) -> str:
+        return self.console.input(prompt, password=password)
+
+def _stream_reply_started(name: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    stream = _current_message_stream.get()
+    if stream is not None:
+        stream.reply_started(name)
+    return messages
+
+def _attribute_llm_calls(name: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Completion cache hits and misses until the next reply are counted for this agent
+    set_llm_caller(name)
+    return messages
+
+def _telemetry_round(name: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    telemetry = current_telemetry()
+    if telemetry is not None:
+        telemetry.begin_round(name)
+    return messages
+
+def _release_llm_caller(sender, message, recipient, silent):
+    set_llm_caller("chat_manager")
+    return message
+
+def _stream_message_sent(sender, message, recipient, silent):
+    stream = _current_message_stream.get()
+    if stream is not None:
+        content = message.get("content") if isinstance(message, dict) else message
+        if isinstance(content, str) and content.strip() and not (isinstance(message, dict) and message.get("role") == "tool"):
+            stream.message(sender.name, content)
+    return message
+
+# pyplot keeps global figure state, so plots are drawn one at a time
+tool_executor = ParallelToolExecutor(TOOL_WORKERS, default_timeout=TOOL_TIMEOUT, timeouts=TOOL_TIMEOUTS,
+                                     serial=["analyze_and_plot_data"])
+parallel_tool_calls_reply = tool_executor.reply_func()
+
 class ChemistryAgent(autogen.AssistantAgent):
     def __init__(self, name, *args, **kwargs):
         super().__init__(name, *args, **kwargs)
+        if PARALLEL_TOOL_CALLS:
+            self.replace_reply_func(ConversableAgent.generate_tool_calls_reply, parallel_tool_calls_reply)
         self.knowledge_base = set()
         self.skills = set()
         self.performance_history = []
@@ -1319,7 +2338,7 @@ class DataAnalystAgent(ChemistryAgent):
                          **kwargs)
         self.register_function(
             function_map={
-                "analyze_and_plot_data": self.analyze_and_plot 
+                "analyze_and_plot_data": timed("tool", "analyze_and_plot_data")(self.analyze_and_plot)
             }
         )
 
@@ -1552,26 +2571,56 @@ class DataAnalystAgent(ChemistryAgent):
             
         return llm_reply_obj
 
+@dataclass
+class LabRequest:
+    """State of one user message on its way through ChemistryLab's request pipeline"""
+    user_input: str
+    image_data: Optional[bytes] = None
+    web_url_path: Optional[str] = None
+    session_id: str = "default"
+    context: Optional[RequestContext] = None
+    # Message sent to the group chat, built up by the stages
+    prompt: str = ""
+    topic: str = "general"
+    primary_agent: Optional[Any] = None
+    history: str = ""
+    intent: Optional[str] = None
+    chat_history: List[Dict[str, Any]] = field(default_factory=list)
+    messages: List[Dict[str, Any]] = field(default_factory=list)
+
 class ChemistryLab:
-    def __init__(self, literature_path=""):
+    def __init__(self, literature_path="", collection=DEFAULT_RAG_COLLECTION):
         self.agents = []
         self.groupchat = None
         self.manager = None
+        self.speaker_selector = None
+        self.chat_controller = None
         self.literature_path = literature_path
+        self.collection = collection
+        self.rag_service = get_rag_service()
+        self.rag_service.configure_collection(collection, literature_path)
         self.setup_agents()
-        self.load_documents()
-        self.llm = ChatOpenAI(model_name="llama3-70b-8192", openai_api_key=config_list[1]["api_key"], openai_api_base=config_list[1]["base_url"])
+        self.llm = routed_chat_model("chemistry_lab_llm", 0.7)
         self.performance_history = []
         self.smiles_processor = get_global_smiles_processor()
-    
-        if hasattr(self, 'db') and self.db is not None:
-            self.rag_chain = RetrievalQA.from_chain_type(
-                llm=self.llm,
-                chain_type="stuff",
-                retriever=self.db.as_retriever(search_kwargs={"k": 3})
-            )
-        else:
-            self.rag_chain = None
+        self.topic_specialists: Dict[str, str] = {}
+        self._applied_feedback = None
+        self._next_evolve = 0
+        self.pipeline = self.build_pipeline()
+
+    @property
+    def db(self):
+        index = self.rag_service.peek_index(self.collection)
+        return index.db if index else None
+
+    @property
+    def rag_chain(self):
+        index = self.rag_service.peek_index(self.collection)
+        return index.rag_chain if index else None
+
+    @property
+    def answer_cache(self):
+        return self.rag_service.answer_cache
 
     def extract_topic(self, text: str) -> str:
 
@@ -1597,35 +2646,42 @@ class ChemistryLab:
         return 'general'
         
     def integrate_feedback(self):
-        feedback_analysis = self.chat_storage.analyze_feedback_trends()
+        """Apply stored feedback to the agents and pick the best rated agent per topic"""
+        feedback_analysis = feedback_trends(self.extract_topic)
+        if feedback_analysis is None or feedback_analysis is self._applied_feedback:
+            return
         for agent in self.agents:
             agent.learn_from_feedback(feedback_analysis)
         self.update_response_strategy(feedback_analysis)
+        self._applied_feedback = feedback_analysis
     
     def update_response_strategy(self, feedback_analysis: Dict[str, Any]):
-        best_agents = {}
-        for agent, ratings in feedback_analysis['agent_ratings'].items():
-            if len(ratings) > 0:
-                avg_rating = np.mean(ratings)
-                best_agents[agent] = avg_rating
-                
+        agent_names = {agent.name for agent in self.agents}
         topic_specialists = {}
-        for topic, ratings in feedback_analysis['topic_ratings'].items():
-            best_agent = max(best_agents.items(), key=lambda x: x[1])[0]
-            topic_specialists[topic] = best_agent
+        for topic, agent_ratings in feedback_analysis['topic_agent_ratings'].items():
+            rated = {agent: np.mean(ratings) for agent, ratings in agent_ratings.items() if ratings and agent in agent_names}
+            if rated:
+                topic_specialists[topic] = max(rated.items(), key=lambda x: x[1])[0]
             
         self.topic_specialists = topic_specialists
 
+    def select_primary_agent(self, user_input: str, topic: str):
+        """Agent that answers first: the Data_Analyst for data tasks, else the topic's specialist, else the director"""
+        if "analyze data" in user_input.lower() or "plot" in user_input.lower():
+            return next((agent for agent in self.agents if agent.name == "Data_Analyst"), self.agents[0])
+        if topic in self.topic_specialists:
+            return next((agent for agent in self.agents if agent.name == self.topic_specialists[topic]), self.agents[0])
+        return self.agents[0]
+
     def rag_search(self, query: str) -> str:
-        if self.rag_chain is None:
-            return "RAG search is not available - no documents loaded"
-        try:
-            return self.rag_chain.invoke({"query": query})
-        except Exception as e:
-            logger.error(f"Error in RAG search: {str(e)}")
-            return f"Error performing RAG search: {str(e)}"
+        # Uses the collection selected for the current request, see process_user_input
+        return self.rag_service.search(query)
 
     def recognize_intent(self, query: str) -> str:
+        """Search intent 1-4, decided locally unless the classifier is unsure"""
+        return get_intent_classifier().classify(query, self.llm_intent)
+
+    def llm_intent(self, query: str) -> str:
         prompt = f"""Analyze the following query and determine the most appropriate search strategy:
         Query: {query}
 
@@ -1637,202 +2693,207 @@ class ChemistryLab:
 
         Respond with only the number of the most appropriate intent."""
 
-        response = self.llm.predict(prompt)
-        return response.strip()
+        response = self.llm.predict(prompt).strip()
+        match = re.search(r"[1-4]", response)
+        return match.group(0) if match else response
 
-    def process_user_input(self, user_input: str, image_data: Union[bytes, None] = None, literature_path: str = None, web_url_path: str = None) -> List[Dict[str, Any]]:
-        self.integrate_feedback()
-        topic = self.extract_topic(user_input)
-        
-        if "analyze data" in user_input.lower() or "plot" in user_input.lower():
-            primary_agent = next((agent for agent in self.agents if agent.name == "Data_Analyst"), self.agents[0])
-        elif hasattr(self, 'topic_specialists') and self.topic_specialists and topic in self.topic_specialists:
-            primary_agent = next((agent for agent in self.agents if agent.name == self.topic_specialists[topic]), self.agents[0])
-        else:
-            primary_agent = self.agents[0]
-
-        logger.info(f"Selected primary agent: {primary_agent.name} for topic/task: {topic}")
-        
-        if literature_path and literature_path != self.literature_path:
-            logger.info(f"New literature path detected. Updating from {self.literature_path} to {literature_path}")
-            self.literature_path = literature_path
-            self.load_documents()
+    def prefetch(self, context: "RequestContext", user_input: str, image_data: Optional[bytes] = None,
+                 web_url_path: Optional[str] = None, timeouts: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+        """
+        Run image analysis, web search, RAG and intent detection concurrently
 
-        logger.info(f"Processing user input: {user_input}")
-        logger.info(f"Web URL Path: {web_url_path}")
+        The searches are started speculatively on the raw user input instead of waiting
+        for the image analysis and intent, so pre-chat latency is that of the slowest call
+        (bounded by PREFETCH_TIMEOUTS) rather than their sum.
+        """
+        calls = {"web_search": lambda: context.web_search(user_input, web_url_path)}
+        if image_data:
+            calls["image_analysis"] = lambda: context.analyze_image(user_input, image_data)
+        if self.rag_service.has_documents():
+            calls["rag"] = lambda: context.rag_search(user_input)
+        if PREFETCH_INTENT:
+            calls["intent"] = lambda: self.recognize_intent(user_input)
+        results, timings = run_concurrently(calls, timeouts or PREFETCH_TIMEOUTS)
+        context.prefetched.update(results)
+        context.prefetch_timings.update(timings)
+        return results
 
+    def load_documents(self):
+        """Make sure the shared RAG index covers this lab's literature path"""
+        self.rag_service.ensure_index(self.literature_path, self.collection)
+
+    def process_user_input(self, user_input, image_data=None, literature_path=None, web_url_path=None, collection=None,
+                           stream: Optional[MessageStream] = None, session_id: str = "default"):
+        # Each request selects its own literature collection; switching costs nothing and never rebuilds the lab
+        collection = collection or self.collection
+        if literature_path is not None:
+            self.rag_service.configure_collection(collection, literature_path)
+        # Reuse the caller's request context so image analysis and searches it already ran are not repeated
+        context = get_request_context() or RequestContext()
+        # Agent hooks switch the completion cache caller; the block restores it for the thread's next request
+        with use_rag_collection(collection), context.activate(), llm_caller("chat_manager"):
+            if stream is None:
+                return self._process_user_input(user_input, image_data=image_data, web_url_path=web_url_path, session_id=session_id)
+            with stream.activate():
+                return self._process_user_input(user_input, image_data=image_data, web_url_path=web_url_path, session_id=session_id)
+
+    def warm(self) -> "ChemistryLab":
+        """Create the group chat ahead of the first message"""
         if not self.groupchat or not self.manager:
             self.setup_groupchat()
-
+        return self
+
+    def reset(self) -> None:
+        """Drop the per-request controller state so the lab can serve another user (chat state is cleared in _preprocess)"""
+        if self.chat_controller:
+            self.chat_controller.begin_request(0)
+        if self.speaker_selector:
+            self.speaker_selector.request_topic = None
+
+    def annotate_content(self, content: str) -> str:
+        """SMILES markup for an agent message; results are cached, so streamed and final messages match"""
+        return self.smiles_processor.process_text(process_smiles_in_text(content))
+
+    def build_pipeline(self) -> RequestPipeline:
+        budgets = PIPELINE_STAGE_BUDGETS
+        return RequestPipeline([
+            Stage("preprocess", self._preprocess, budgets.get("preprocess"), required=True),
+            Stage("retrieve", self._retrieve, budgets.get("retrieve"), skip=self._skip_retrieve),
+            Stage("converse", self._converse, budgets.get("converse"), required=True),
+            Stage("annotate", self._annotate, budgets.get("annotate"),
+                  skip=lambda request: None if request.messages else "no_messages"),
+            Stage("evolve", self._evolve, budgets.get("evolve"),
+                  skip=lambda request: None if request.messages else "no_answer"),
+            Stage("persist", self._persist, budgets.get("persist"),
+                  skip=lambda request: None if request.chat_history else "no_answer"),
+        ], enabled=PIPELINE_STAGES, request_budget=REQUEST_BUDGET)
+
+    def _process_user_input(self, user_input, image_data=None, web_url_path=None, session_id="default"):
+        logger.info(f"Processing user input: {user_input}")
+        logger.info(f"Web URL Path: {web_url_path}")
+        context = get_request_context() or RequestContext()
+        request = LabRequest(user_input, image_data=image_data, web_url_path=web_url_path, session_id=session_id,
+                             context=context)
         try:
-            if image_data:
-                llava_response = llava_call(user_input, image_data, llava_config_list[0])
-                user_input = f"{user_input}\n[IMAGE_ANALYSIS:{llava_response}]"
-                
-            intent = self.recognize_intent(user_input)
-            logger.info(f"Recognized intent: {intent}")
-
-            search_results = ""
-            if intent == "1":
-                search_results = tavily_search(user_input, url=web_url_path if web_url_path and is_valid_url(web_url_path) else None)
-                search_results = f"[TAVILY_SEARCH:{search_results}]"
-            elif intent == "2":
-                search_results = rag_search(user_input)
-                search_results = f"[RAG_SEARCH:{search_results}]"
-            elif intent == "3":
-                tavily_results = tavily_search(user_input, url=web_url_path if web_url_path and is_valid_url(web_url_path) else None)
-                rag_results = rag_search(user_input)
-                search_results = f"[TAVILY_SEARCH:{tavily_results}]\n[RAG_SEARCH:{rag_results}]"
-
-            if search_results:
-                user_input = f"{user_input}\n{search_results}"
-                
-            chat_result = self.manager.initiate_chat(
-                primary_agent, 
-                message=user_input,
-            )
-
-            chat_history = chat_result.chat_history if hasattr(chat_result, 'chat_history') else chat_result
-
-            processed_messages = []
-            for message in chat_history:
-                if isinstance(message, dict) and 'role' in message:
-                    processed_content = message['content']
-                    if message['role'] == 'assistant':
-                        processed_content = process_smiles_in_text(processed_content)
-                    
-                    processed_messages.append({
-                        'role': message['role'],
-                        'name': message.get('name', 'AI Assistant') if message['role'] == 'assistant' else 'You',
-                        'content': processed_content
-                    })
-
-            for agent in self.agents:
-                agent.evolve()
-                
-            return processed_messages
-
+            self.pipeline.run(request, report=context.stage_report)
+            logger.info(f"Request stages: {context.stage_report}")
+            return request.messages
         except Exception as e:
-            logger.error(f"Error in process_user_input: {str(e)}", exc_info=True)
+            logger.error(f"Error processing user input: {str(e)}", exc_info=True)
             return [{
                 'role': 'assistant',
                 'name': 'System',
                 'content': f"Error processing your input: {str(e)}"
             }]
-        
-    def load_documents(self):
-        logger.info(f"Loading documents. Literature path: {self.literature_path}")
-
-        # Load experiment data
-        experiment_data = load_documents("E://HuaweiMoveData//Users//makangyong//Desktop//output.txt")
-        logger.info(f"Loaded {len(experiment_data)} experiment documents")
-
-        # Load literature (if available)
-        literature = []
-        if self.literature_path:
-            if os.path.exists(self.literature_path):
-                literature = load_documents(self.literature_path)
-                logger.info(f"Loaded {len(literature)} literature documents from {self.literature_path}")
-            else:
-                logger.warning(f"Literature path does not exist: {self.literature_path}")
-
-        # Combine all documents
-        all_documents = experiment_data + literature
-        logger.info(f"Total documents loaded: {len(all_documents)}")
-
-        # Check if we have any documents before proceeding
-        if not all_documents:
-            logger.warning("No documents loaded. Skipping embedding and vector store creation.")
-            self.db = None
-        else:
-            try:
-                text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-                texts = text_splitter.split_documents(all_documents)
-                logger.info(f"Split documents into {len(texts)} chunks")
-
-                embeddings = HuggingFaceEmbeddings()
-                self.db = Chroma.from_documents(texts, embeddings)
-                logger.info("Successfully created Chroma vector store")
-            except Exception as e:
-                logger.error(f"Error creating vector store: {str(e)}", exc_info=True)
-                self.db = None
-
-    def process_user_input(self, user_input, image_data=None, literature_path=None, web_url_path=None):
-        if literature_path and literature_path != self.literature_path:
-            logger.info(f"New literature path detected. Updating from {self.literature_path} to {literature_path}")
-            self.literature_path = literature_path
-            self.load_documents()  # Reload documents when literature_path changes
-
-        logger.info(f"Processing user input: {user_input}")
-        logger.info(f"Web URL Path: {web_url_path}")
 
+    def _preprocess(self, request: "LabRequest", budget: Optional[float]) -> None:
+        # Advisory budget: group chat setup and agent selection are local steps that cannot stop halfway
         if not self.groupchat or not self.manager:
             self.setup_groupchat()
+        # Earlier requests reach the agents only through the bounded conversation memory; this is the
+        # one place chat state is cleared, so pooled and directly used labs both start clean
+        reset_chat_state(self.groupchat, [self.manager, self.user_proxy] + self.agents)
+        request.prompt = request.user_input
+        request.topic = self.extract_topic(request.user_input)
+        self.integrate_feedback()
+        request.primary_agent = self.select_primary_agent(request.user_input, request.topic)
+        logger.info(f"Selected primary agent: {request.primary_agent.name} for topic/task: {request.topic}")
+        if self.speaker_selector:
+            self.speaker_selector.begin_request(request.user_input, self.topic_specialists)
+        request.history = conversation_context(request.session_id)
+
+    def _skip_retrieve(self, request: "LabRequest") -> Optional[str]:
+        if not request.image_data and len(request.user_input.strip()) < RETRIEVE_MIN_CHARS:
+            return "short_message"
+        return None
 
-        try:
-            if image_data:
-                llava_response = llava_call(user_input, image_data, llava_config_list[0])
-                user_input = f"{user_input}\n[IMAGE_ANALYSIS:{llava_response}]"
-
-            # Check if a valid URL is provided
-            if web_url_path and is_valid_url(web_url_path):
-                search_result = tavily_search(user_input, url=web_url_path)
+    def _retrieve(self, request: "LabRequest", budget: Optional[float]) -> None:
+        timeouts = {name: min(timeout, budget) for name, timeout in PREFETCH_TIMEOUTS.items()} if budget is not None else None
+        prefetched = self.prefetch(request.context, request.user_input, image_data=request.image_data,
+                                   web_url_path=request.web_url_path, timeouts=timeouts)
+        request.intent = prefetched.get("intent")
+        logger.info(f"Recognized intent: {request.intent}")
+
+        llava_response = prefetched.get("image_analysis")
+        if llava_response:
+            request.prompt = f"{request.prompt}\n[IMAGE_ANALYSIS:{llava_response}]"
+
+        # Without an intent (timed out or disabled) every result that arrived in time is used
+        search_result = prefetched.get("web_search") if request.intent in (None, "1", "3") else None
+        if isinstance(search_result, list) and search_result:
+            processed_results = process_search_results(search_result)
+            summary = summarize_search_results(processed_results, request.prompt)
+            request.prompt = f"{request.prompt}\n[WEB_SEARCH_SUMMARY:{summary}]"
+
+        rag_result = prefetched.get("rag") if request.intent in (None, "2", "3") else None
+        if rag_result and not (isinstance(rag_result, str) and rag_result.startswith(("Error", "RAG search is not available"))):
+            request.prompt = f"{request.prompt}\n[RAG_SEARCH:{rag_result}]"
+
+    def _converse(self, request: "LabRequest", budget: Optional[float]) -> None:
+        prompt = request.prompt
+        if request.history:
+            prompt = f"{prompt}\n[CONVERSATION_HISTORY:{request.history}]"
+
+        self.chat_controller.begin_request(len(self.groupchat.messages),
+                                           CHAT_ROUND_BUDGETS.get(request.intent, CHAT_DEFAULT_ROUND_BUDGET),
+                                           time_budget=budget)
+
+        chat_result = self.manager.initiate_chat(
+            request.primary_agent or self.agents[0],
+            message=prompt,
+            # Routed agents cache inside RoutedOpenAIClient, keyed on the model that served
+            cache=None if MODEL_ROUTING else completion_cache_for(agent_llm_config["temperature"]),
+        )
+        request.context.chat_report = self.chat_controller.report()
+        logger.info(f"Group chat finished: {request.context.chat_report}")
+
+        request.chat_history = chat_result.chat_history if hasattr(chat_result, 'chat_history') else chat_result
+        for message in request.chat_history:
+            logger.debug(f"Processing message: {message}")
+            if isinstance(message, dict) and 'role' in message:
+                if message['role'] == 'human':
+                    request.messages.append({
+                        'role': 'user',
+                        'name': 'You',
+                        'content': message['content']
+                    })
+                elif message['role'] == 'assistant':
+                    msg_to_send = {
+                        'role': 'assistant',
+                        'name': message.get('name', 'AI Assistant'),
+                        'content': message['content']
+                    }
+                    # If message has plot_output, include it
+                    if 'plot_output' in message:
+                        msg_to_send['plot_output'] = message['plot_output']
+                    request.messages.append(msg_to_send)
+
+    def _annotate(self, request: "LabRequest", budget: Optional[float]) -> None:
+        # SMILES markup; messages left when the budget runs out are returned as plain text
+        deadline = time.perf_counter() + budget if budget is not None else None
+        for index, msg in enumerate(request.messages):
+            if deadline is not None and time.perf_counter() > deadline:
+                logger.warning(f"Annotation budget spent, {len(request.messages) - index} messages left unannotated")
+                break
+            if msg['role'] == 'assistant':
+                msg['content'] = self.annotate_content(msg['content'])
             else:
-                search_result = tavily_search(user_input)
-
-            if search_result:
-                processed_results = process_search_results(search_result)
-                summary = summarize_search_results(processed_results, user_input)
-                user_input = f"{user_input}\n[WEB_SEARCH_SUMMARY:{summary}]"
-
-            chat_result = self.manager.initiate_chat(
-                self.agents[0],
-                message=user_input,
-            )
-
-            chat_history = chat_result.chat_history if hasattr(chat_result, 'chat_history') else chat_result
-
-            processed_messages = []
-            for message in chat_history:
-                logger.info(f"Processing message: {message}")
-                if isinstance(message, dict) and 'role' in message:
-                    if message['role'] == 'human':
-                        processed_messages.append({
-                            'role': 'user',
-                            'name': 'You',
-                            'content': message['content']
-                        })
-                    elif message['role'] == 'assistant':
-                        agent_name = message.get('name', 'AI Assistant')
-                        processed_content = process_smiles_in_text(message['content'])
-                        msg_to_send = {
-                            'role': 'assistant',
-                            'name': agent_name,
-                            'content': processed_content
-                       }
-            
-                        # If message has plot_output, include it
-                        if 'plot_output' in message:
-                            msg_to_send['plot_output'] = message['plot_output']
-                
-                        processed_messages.append(msg_to_send)
-
-            for msg in processed_messages:  
-                if isinstance(msg, dict) and 'content' in msg:
-                    msg['content'] = self.smiles_processor.process_text(msg['content'])
-            
-            for agent in self.agents:
-                agent.evolve()
-
-            logger.info(f"Generated responses: {json.dumps(processed_messages, indent=2)}")
-            return processed_messages
-        except Exception as e:
-            logger.error(f"Error processing user input: {str(e)}", exc_info=True)
-            return [{
-                'role': 'assistant',
-                'name': 'System',
-                'content': f"Error processing your input: {str(e)}"
-            }]
+                msg['content'] = self.smiles_processor.process_text(msg['content'])
+
+    def _evolve(self, request: "LabRequest", budget: Optional[float]) -> None:
+        # Agents not reached within the budget are the first to evolve after the next request
+        deadline = time.perf_counter() + budget if budget is not None else None
+        for index in range(len(self.agents)):
+            if deadline is not None and time.perf_counter() > deadline:
+                logger.warning(f"Evolution budget spent, {len(self.agents) - index} agents not evolved")
+                break
+            self.agents[self._next_evolve % len(self.agents)].evolve()
+            self._next_evolve = (self._next_evolve + 1) % len(self.agents)
+
+    def _persist(self, request: "LabRequest", budget: Optional[float]) -> None:
+        # Advisory budget: recording a turn is an in-memory append, summaries are folded in the background
+        get_conversation_memory().record(request.session_id, request.user_input,
+                                         final_answer(self.groupchat.messages or request.chat_history))
 
     def get_user_feedback(self, feedback_data):
         logger.info(f"Processing feedback: {feedback_data}")
@@ -1938,7 +2999,7 @@ class ChemistryLab:
         ]
 
         for name, sys_msg in agent_definitions: 
-            agent = ChemistryAgent(name=name, system_message=sys_msg, llm_config=agent_llm_config)
+            agent = use_model_router(ChemistryAgent(name=name, system_message=sys_msg, llm_config=agent_llm_config))
             agent.register_function(function_map={
                 "rag_search_tool_function": rag_search_tool_function, 
                 "tavily_search_tool_function": tavily_search_tool_function
@@ -1960,6 +3021,7 @@ class ChemistryLab:
             llm_config=agent_llm_config, # 使用包含所有工具定义的 agent_llm_config
             system_message=data_analyst_system_message
         )
+        use_model_router(data_analyst)
         self.agents.append(data_analyst)
         logger.info(f"Initialized agents: {[a.name for a in self.agents]}")
 
@@ -1974,21 +3036,137 @@ class ChemistryLab:
             system_message="You are a user proxy. Relay user messages to the group and return the final response."
         )
 
-        self.groupchat = autogen.GroupChat(
-            agents=[self.user_proxy] + self.agents,
-            messages=[],
-            max_round=12,
-            speaker_selection_method="auto",
-            allow_repeat_speaker=False,
+        all_agents = [self.user_proxy] + self.agents
+        self.chat_controller = AdaptiveChatController(
+            token_budget=CHAT_TOKEN_BUDGET,
+            time_budget=CHAT_TIME_BUDGET,
+            novelty_threshold=CHAT_NOVELTY_THRESHOLD,
+            min_rounds=CHAT_MIN_ROUNDS,
+            max_rounds=CHAT_MAX_ROUNDS,
+            count_tokens=count_tokens,
+            padding_replies=[self.user_proxy._default_auto_reply],
+            proxy_name=self.user_proxy.name
         )
+        if SPEAKER_SELECTION == "rules":
+            self.speaker_selector = SpeakerSelector(all_agents, topic_fn=self.extract_topic, use_model=SPEAKER_SELECTION_MODEL)
+            self.groupchat = autogen.GroupChat(
+                agents=all_agents,
+                messages=[],
+                max_round=CHAT_MAX_ROUNDS,
+                speaker_selection_method=self.chat_controller.wrap(self.speaker_selector),
+                allowed_or_disallowed_speaker_transitions=build_transition_graph(all_agents),
+                speaker_transitions_type="allowed",
+            )
+        else:
+            self.speaker_selector = None
+            self.groupchat = autogen.GroupChat(
+                agents=all_agents,
+                messages=[],
+                max_round=CHAT_MAX_ROUNDS,
+                speaker_selection_method=self.chat_controller.wrap(),
+                allow_repeat_speaker=False,
+            )
         self.manager = autogen.GroupChatManager(
             groupchat=self.groupchat, 
             llm_config=manager_llm_config
         )
+        # Streaming hooks are no-ops unless the running request has an active MessageStream;
+        # the caller hooks attribute completion cache hits to the replying agent
+        for agent in self.agents:
+            agent.register_hook("process_all_messages_before_reply", partial(_stream_reply_started, agent.name))
+            agent.register_hook("process_message_before_send", _stream_message_sent)
+            agent.register_hook("process_all_messages_before_reply", partial(_attribute_llm_calls, agent.name))
+            agent.register_hook("process_all_messages_before_reply", partial(_telemetry_round, agent.name))
+            agent.register_hook("process_message_before_send", _release_llm_caller)
         logger.info("Group chat and manager set up successfully.")
 
-def get_chemistry_lab(literature_path=""):
-    return ChemistryLab(literature_path)
+@lru_cache(maxsize=None)
+def get_intent_classifier() -> IntentClassifier:
+    """Process-wide intent classifier, trained in the background from stored LLM labels"""
+    classifier = IntentClassifier(
+        labels_path=INTENT_LABELS_PATH,
+        min_confidence=INTENT_MIN_CONFIDENCE,
+        audit_rate=INTENT_AUDIT_RATE,
+        max_labels=INTENT_MAX_LABELS
+    )
+    classifier.train_async()
+    return classifier
+
+@lru_cache(maxsize=None)
+def get_summary_llm() -> ChatOpenAI:
+    return routed_chat_model("conversation_summary", 0)
+
+def summarize_conversation(prompt: str) -> str:
+    if MODEL_ROUTING:
+        # The router retries and fails over; wrapping it in resilience.call would multiply the attempts
+        return get_summary_llm().predict(prompt).strip()
+    return resilience.call("openai", get_summary_llm().predict, prompt).strip()
+
+@lru_cache(maxsize=None)
+def get_conversation_memory() -> ConversationMemory:
+    """Process-wide conversation memory shared by every lab instance"""
+    return ConversationMemory(
+        window_turns=MEMORY_WINDOW_TURNS,
+        window_tokens=MEMORY_WINDOW_TOKENS,
+        summary_tokens=MEMORY_SUMMARY_TOKENS,
+        summarize=summarize_conversation if MEMORY_LLM_SUMMARY else None,
+        count_tokens=count_tokens
+    )
+
+def final_answer(messages: List[Dict[str, Any]]) -> str:
+    """Content of the last non-empty agent message of a chat"""
+    for message in reversed(messages):
+        content = message.get("content") if isinstance(message, dict) else None
+        if isinstance(content, str) and content.strip() and message.get("name") != "User_Proxy" and message.get("role") != "tool":
+            return content.replace("TERMINATE", "").strip()
+    return ""
+
+_feedback_lock = threading.Lock()
+_feedback_cache: Dict[str, Any] = {"loaded_at": 0.0, "analysis": None}
+
+def feedback_trends(extract_topic) -> Optional[Dict[str, Any]]:
+    """Analysis of the stored feedback, re-read from chat storage at most every FEEDBACK_REFRESH_INTERVAL seconds"""
+    with _feedback_lock:
+        if time.time() - _feedback_cache["loaded_at"] < FEEDBACK_REFRESH_INTERVAL:
+            return _feedback_cache["analysis"]
+        _feedback_cache["loaded_at"] = time.time()
+    try:
+        analysis = ChatSessionStorage(CHAT_HISTORY_DIR).analyze_feedback_trends(extract_topic)
+    except Exception as e:
+        logger.error(f"Error analyzing feedback: {str(e)}")
+        return _feedback_cache["analysis"]
+    with _feedback_lock:
+        _feedback_cache["analysis"] = analysis
+    return analysis
+
+def conversation_context(session_id: str) -> str:
+    """Summary and recent turns of a session, restored from the chat history on first use"""
+    memory = get_conversation_memory()
+    if not memory.has_session(session_id):
+        try:
+            entries = ChatSessionStorage(CHAT_HISTORY_DIR).get_session_history(session_id).get('session', [])
+            memory.seed(session_id, [
+                (entry.get('user_input', ''), final_answer([m for m in entry.get('response', []) if m.get('role') == 'assistant']))
+                for entry in entries
+            ])
+        except Exception as e:
+            logger.error(f"Error restoring conversation {session_id}: {str(e)}")
+    return memory.context(session_id)
+
+def get_chemistry_lab(literature_path="", collection=DEFAULT_RAG_COLLECTION):
+    return ChemistryLab(literature_path, collection=collection)
+
+@lru_cache(maxsize=None)
+def get_lab_pool() -> LabPool:
+    """Process-wide pool of warm labs; each request leases its own and picks its collection per message"""
+    return LabPool(
+        lambda: get_chemistry_lab().warm(),
+        warm_size=LAB_POOL_WARM,
+        max_size=LAB_POOL_MAX_SIZE,
+        max_idle=LAB_POOL_MAX_IDLE,
+        max_uses=LAB_POOL_MAX_USES,
+        acquire_timeout=LAB_POOL_ACQUIRE_TIMEOUT
+    )
 
 # Keep the simulate function at the end
 def simulate(message, image_data=None):
@@ -0,0 +1,184 @@
+"""
+Cheap speaker selection for the chemistry group chat.
+
+SpeakerSelector is passed to autogen.GroupChat as a callable
+speaker_selection_method. It routes by rules (tool call hand-offs, explicit
+name mentions, the request topic) and by keyword and TF-IDF similarity
+between the last message and each agent's role, restricted to a transition
+graph. Only when the best candidates are too close does it return "auto",
+so the GroupChatManager asks the LLM, and then only among the graph's
+allowed successors.
+"""
+import logging
+import re
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from autogen import Agent, GroupChat
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+logger = logging.getLogger(__name__)
+
+ROLE_KEYWORDS: Dict[str, List[str]] = {
+    "Lab_Director": ["summary", "summarize", "overall", "decide", "decision", "assign", "conclude", "conclusion", "final", "next steps"],
+    "Senior_Chemist": ["mechanism", "reaction", "synthesis", "organic", "inorganic", "physical", "thermodynamic", "kinetic",
+                       "molecule", "compound", "smiles", "structure", "bond", "reagent", "yield"],
+    "Lab_Manager": ["plan", "procedure", "protocol", "equipment", "resource", "schedule", "budget", "setup", "design",
+                    "project", "supplies", "inventory", "workflow"],
+    "Safety_Officer": ["safety", "hazard", "toxic", "risk", "ppe", "protection", "precaution", "flammable", "sds", "msds",
+                       "waste", "exposure", "regulation", "fume hood"],
+    "Analytical_Chemist": ["analysis", "analytical", "spectrum", "spectroscopy", "nmr", "hplc", "chromatography", "titration",
+                           "calibration", "quality control", "measurement", "purity", "detection"],
+    "Data_Analyst": ["data", "plot", "chart", "graph", "csv", "statistics", "regression", "trend", "visualize", "dataset"],
+}
+
+TOPIC_SPECIALISTS: Dict[str, str] = {
+    "organic_chemistry": "Senior_Chemist",
+    "inorganic_chemistry": "Senior_Chemist",
+    "physical_chemistry": "Senior_Chemist",
+    "analytical_chemistry": "Analytical_Chemist",
+    "safety": "Safety_Officer",
+    "lab_management": "Lab_Manager",
+    "general": "Lab_Director",
+}
+
+# Who may speak after whom; the director can hand over to anyone and closes the discussion
+TRANSITIONS: Dict[str, List[str]] = {
+    "User_Proxy": ["Lab_Director", "Senior_Chemist", "Lab_Manager", "Safety_Officer", "Analytical_Chemist", "Data_Analyst"],
+    "Lab_Director": ["Senior_Chemist", "Lab_Manager", "Safety_Officer", "Analytical_Chemist", "Data_Analyst", "User_Proxy"],
+    "Senior_Chemist": ["Lab_Director", "Safety_Officer", "Analytical_Chemist", "Lab_Manager"],
+    "Lab_Manager": ["Lab_Director", "Safety_Officer", "Senior_Chemist"],
+    "Safety_Officer": ["Lab_Director", "Lab_Manager", "Senior_Chemist"],
+    "Analytical_Chemist": ["Lab_Director", "Data_Analyst", "Senior_Chemist"],
+    "Data_Analyst": ["Lab_Director", "Analytical_Chemist"],
+}
+
+
+def build_transition_graph(agents: List[Agent], transitions: Dict[str, List[str]] = TRANSITIONS) -> Dict[Agent, List[Agent]]:
+    """Map the named transitions onto agent objects for GroupChat(allowed_or_disallowed_speaker_transitions=...)"""
+    by_name = {agent.name: agent for agent in agents}
+    return {
+        by_name[name]: [by_name[target] for target in targets if target in by_name]
+        for name, targets in transitions.items() if name in by_name
+    }
+
+
+class SpeakerSelector:
+    """Rule, topic and role-similarity routing with LLM selection only for ambiguous rounds"""
+
+    def __init__(self, agents: List[Agent], topic_fn: Optional[Callable[[str], str]] = None,
+                 transitions: Dict[str, List[str]] = TRANSITIONS, min_margin: float = 0.5,
+                 use_model: bool = True, default_speaker: str = "Lab_Director"):
+        """
+        Args:
+            agents (List[Agent]): All group chat agents
+            topic_fn: Maps the user request to a topic, e.g. ChemistryLab.extract_topic
+            transitions: Allowed successors per agent name
+            min_margin (float): Score lead the best candidate needs over the runner-up
+            use_model (bool): Add TF-IDF similarity between the message and agent roles to the score
+            default_speaker (str): Speaker for the first round when no topic specialist applies
+        """
+        self.agents = {agent.name: agent for agent in agents}
+        self.topic_fn = topic_fn
+        self.transitions = transitions
+        self.min_margin = min_margin
+        self.default_speaker = default_speaker
+        self.topic_specialists = dict(TOPIC_SPECIALISTS)
+        self.request_topic: Optional[str] = None
+        self._mention_patterns = {
+            name: re.compile(r"\b" + re.escape(name).replace("_", "[_ ]") + r"\b", re.IGNORECASE)
+            for name in self.agents
+        }
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._vectorizer = None
+        self._role_matrix = None
+        self._role_names: List[str] = []
+        if use_model:
+            self._fit_role_model()
+
+    def _fit_role_model(self) -> None:
+        documents = []
+        for name, agent in self.agents.items():
+            if name not in ROLE_KEYWORDS:
+                continue
+            self._role_names.append(name)
+            documents.append(f"{getattr(agent, 'system_message', '')} {' '.join(ROLE_KEYWORDS[name])}")
+        if documents:
+            self._vectorizer = TfidfVectorizer(stop_words="english", sublinear_tf=True)
+            self._role_matrix = self._vectorizer.fit_transform(documents)
+
+    def begin_request(self, user_input: str, topic_specialists: Optional[Dict[str, str]] = None) -> None:
+        """Set the topic of the request about to be discussed (and any feedback-based specialists)"""
+        self.request_topic = self.topic_fn(user_input) if self.topic_fn else None
+        if topic_specialists:
+            self.topic_specialists.update(topic_specialists)
+
+    def _count(self, decision: str) -> None:
+        with self._lock:
+            self._stats[decision] += 1
+
+    def _decide(self, decision: str, agent: Union[Agent, str]) -> Union[Agent, str]:
+        self._count(decision)
+        logger.info(f"Speaker selection ({decision}): {agent.name if isinstance(agent, Agent) else agent}")
+        return agent
+
+    def score(self, text: str, candidates: List[str]) -> Dict[str, float]:
+        """Keyword, topic and role-similarity score of each candidate for the given message"""
+        lowered = text.lower()
+        scores = {name: float(sum(1 for keyword in ROLE_KEYWORDS.get(name, []) if keyword in lowered)) for name in candidates}
+        specialist = self.topic_specialists.get(self.request_topic or "")
+        if specialist in scores:
+            scores[specialist] += 0.5
+        if self._vectorizer is not None and text.strip():
+            similarities = cosine_similarity(self._vectorizer.transform([text]), self._role_matrix)[0]
+            for name, similarity in zip(self._role_names, similarities):
+                if name in scores:
+                    scores[name] += 2.0 * float(similarity)
+        return scores
+
+    def __call__(self, last_speaker: Agent, groupchat: GroupChat) -> Union[Agent, str, None]:
+        messages = groupchat.messages
+        if not messages:
+            name = self.topic_specialists.get(self.request_topic or "", self.default_speaker)
+            return self._decide("topic", self.agents.get(name) or self.agents[self.default_speaker])
+
+        last = messages[-1]
+        # The agent that asked for a tool runs it (every chemistry agent has the tools registered)
+        # and then interprets the result itself, so tool rounds never need a selection call
+        if last.get("tool_calls") or last.get("function_call"):
+            calls = [call["function"]["name"] for call in last.get("tool_calls") or [] if call.get("type") == "function"]
+            if last.get("function_call"):
+                calls.append(last["function_call"]["name"])
+            if last_speaker.can_execute_function(calls):
+                return self._decide("tool_call", last_speaker)
+            executors = [agent for agent in groupchat.agents if agent.can_execute_function(calls)]
+            return self._decide("tool_call", executors[0]) if executors else self._decide("llm", "auto")
+        if last.get("role") == "tool" or last.get("tool_responses"):
+            return self._decide("tool_result", last_speaker)
+
+        content = last.get("content") or ""
+        if not isinstance(content, str):
+            content = str(content)
+        candidates = [name for name in self.transitions.get(last_speaker.name, self.agents) if name in self.agents]
+
+        # An explicit hand-off ("Data_Analyst, please plot ...") wins
+        mentioned = [name for name in candidates if self._mention_patterns[name].search(content)]
+        if len(mentioned) == 1:
+            return self._decide("mention", self.agents[mentioned[0]])
+
+        scores = self.score(content, [name for name in candidates if name in ROLE_KEYWORDS] or candidates)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        if ranked and ranked[0][1] > 0 and (len(ranked) == 1 or ranked[0][1] - ranked[1][1] >= self.min_margin):
+            return self._decide("rules", self.agents[ranked[0][0]])
+        # Ambiguous: let the manager's LLM choose among the graph's allowed successors
+        return self._decide("llm", "auto")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        total = sum(stats.values())
+        stats["llm_rate"] = round(stats.get("llm", 0) / total, 4) if total else None
+        return stats
@@ -0,0 +1,267 @@
+"""
+Token, latency and cache accounting for LLM, tool and external calls.
+
+Every call is recorded as (kind, name) with its latency, prompt and
+completion tokens, cache status and error flag:
+
+- "llm" calls come from autogen's runtime logging (TelemetryLogger sees
+  every OpenAIWrapper.create, including cache hits and the manager's
+  speaker selection) and from LangChain models (TelemetryCallback);
+- "tool" calls from the timed() decorator on tool functions;
+- "external" calls from resilience.call observers.
+
+Records go to the RequestTelemetry active in the current context (one per
+/simulate request, stored with its history entry, with a per-round
+breakdown) and to the process-wide rolling aggregates.
+"""
+import contextvars
+import datetime
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+from autogen.logger.base_logger import BaseLogger
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+logger = logging.getLogger(__name__)
+
+_current_telemetry: contextvars.ContextVar = contextvars.ContextVar("request_telemetry", default=None)
+
+# Throwaway agents autogen creates for LLM speaker selection
+SPEAKER_SELECTION_AGENTS = {"checking_agent", "speaker_selection_agent"}
+
+
+def _empty_totals() -> Dict[str, Any]:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency": 0.0, "cache_hits": 0, "errors": 0}
+
+
+def _add(totals: Dict[str, Any], record: Dict[str, Any]) -> None:
+    totals["calls"] += 1
+    totals["prompt_tokens"] += record["prompt_tokens"]
+    totals["completion_tokens"] += record["completion_tokens"]
+    totals["latency"] += record["latency"]
+    totals["cache_hits"] += int(record["cached"])
+    totals["errors"] += int(record["error"])
+
+
+def _rounded(totals: Dict[str, Any]) -> Dict[str, Any]:
+    return dict(totals, latency=round(totals["latency"], 3))
+
+
+class RequestTelemetry:
+    """Calls of one request, grouped by source and by group chat round"""
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._records: List[Dict[str, Any]] = []
+        self.round = 0
+        self.speaker: Optional[str] = None
+        self._round_speakers: Dict[int, str] = {}
+
+    def begin_round(self, speaker: str) -> None:
+        """Attribute the following calls to a new group chat round spoken by speaker"""
+        with self._lock:
+            self.round += 1
+            self.speaker = speaker
+            self._round_speakers[self.round] = speaker
+
+    def add(self, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self._records.append(dict(record, round=self.round))
+
+    @contextmanager
+    def activate(self) -> Iterator["RequestTelemetry"]:
+        token = _current_telemetry.set(self)
+        try:
+            yield self
+        finally:
+            _current_telemetry.reset(token)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            records = list(self._records)
+            speakers = dict(self._round_speakers)
+        totals = defaultdict(_empty_totals)
+        by_source = defaultdict(_empty_totals)
+        rounds = defaultdict(_empty_totals)
+        for record in records:
+            _add(totals[record["kind"]], record)
+            _add(by_source[f"{record['kind']}:{record['name']}"], record)
+            _add(rounds[record["round"]], record)
+        return {
+            "totals": {kind: _rounded(values) for kind, values in totals.items()},
+            "by_source": {source: _rounded(values) for source, values in by_source.items()},
+            "rounds": [
+                dict(_rounded(rounds[index]), round=index, speaker=speakers.get(index))
+                for index in sorted(rounds)
+            ],
+            "elapsed": round(time.time() - self.started, 3)
+        }
+
+
+class TelemetryAggregator:
+    """Rolling per-source aggregates over the last `window` calls plus lifetime totals"""
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._lock = threading.Lock()
+        self._recent: Dict[str, Deque[Dict[str, Any]]] = defaultdict(lambda: deque(maxlen=self.window))
+        self._lifetime: Dict[str, Dict[str, Any]] = defaultdict(_empty_totals)
+
+    def add(self, record: Dict[str, Any]) -> None:
+        source = f"{record['kind']}:{record['name']}"
+        with self._lock:
+            self._recent[source].append(record)
+            _add(self._lifetime[source], record)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            recent = {source: list(records) for source, records in self._recent.items()}
+            lifetime = {source: _rounded(totals) for source, totals in self._lifetime.items()}
+        sources = {}
+        for source, records in recent.items():
+            latencies = sorted(record["latency"] for record in records)
+            calls = len(records)
+            sources[source] = {
+                "recent_calls": calls,
+                "avg_prompt_tokens": round(sum(r["prompt_tokens"] for r in records) / calls, 1),
+                "avg_completion_tokens": round(sum(r["completion_tokens"] for r in records) / calls, 1),
+                "latency_p50": round(latencies[calls // 2], 3),
+                "latency_p95": round(latencies[min(calls - 1, int(calls * 0.95))], 3),
+                "cache_hit_rate": round(sum(r["cached"] for r in records) / calls, 4),
+                "error_rate": round(sum(r["error"] for r in records) / calls, 4),
+                "lifetime": lifetime.get(source)
+            }
+        # Most expensive sources first
+        return dict(sorted(sources.items(), key=lambda item: -(item[1]["lifetime"]["prompt_tokens"] + item[1]["lifetime"]["completion_tokens"])))
+
+
+aggregator = TelemetryAggregator()
+
+
+def current_telemetry() -> Optional[RequestTelemetry]:
+    return _current_telemetry.get()
+
+
+def record(kind: str, name: str, latency: float, prompt_tokens: int = 0, completion_tokens: int = 0,
+           cached: bool = False, error: bool = False) -> None:
+    """Record one call for the current request (if any) and the rolling aggregates"""
+    entry = {
+        "kind": kind, "name": name, "latency": latency, "prompt_tokens": prompt_tokens or 0,
+        "completion_tokens": completion_tokens or 0, "cached": bool(cached), "error": bool(error)
+    }
+    telemetry = current_telemetry()
+    if telemetry is not None:
+        telemetry.add(entry)
+    aggregator.add(entry)
+
+
+def timed(kind: str, name: Optional[str] = None) -> Callable:
+    """Decorator recording the latency and failures of a tool or helper function"""
+    def decorator(fn: Callable) -> Callable:
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                record(kind, label, time.perf_counter() - start, error=True)
+                raise
+            # Tool functions report failures as strings rather than raising
+            failed = isinstance(result, str) and result.startswith("Error")
+            record(kind, label, time.perf_counter() - start, error=failed)
+            return result
+        return wrapper
+    return decorator
+
+
+def observe_backend_call(backend: str, seconds: float, error: Optional[Exception]) -> None:
+    """resilience.add_call_observer callback"""
+    record("external", backend, seconds, error=error is not None)
+
+
+class TelemetryLogger(BaseLogger):
+    """autogen runtime logger that records chat completions and ignores everything else"""
+
+    def start(self) -> str:
+        return "telemetry"
+
+    def log_chat_completion(self, invocation_id, client_id, wrapper_id, source, request, response, is_cached, cost,
+                            start_time) -> None:
+        name = source if isinstance(source, str) else getattr(source, "name", str(source))
+        if name in SPEAKER_SELECTION_AGENTS:
+            name = "speaker_selection"
+        try:
+            started = datetime.datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S.%f")
+            latency = max(0.0, (datetime.datetime.utcnow() - started).total_seconds())
+        except (TypeError, ValueError):
+            latency = 0.0
+        usage = getattr(response, "usage", None)
+        record(
+            "llm", name, latency,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) if usage else 0,
+            completion_tokens=getattr(usage, "completion_tokens", 0) if usage else 0,
+            cached=bool(is_cached),
+            # Failed attempts are logged with an error string instead of a completion
+            error=isinstance(response, str)
+        )
+
+    def log_new_agent(self, agent, init_args) -> None:
+        pass
+
+    def log_event(self, source, name, **kwargs) -> None:
+        pass
+
+    def log_new_wrapper(self, wrapper, init_args) -> None:
+        pass
+
+    def log_new_client(self, client, wrapper, init_args) -> None:
+        pass
+
+    def log_function_use(self, source, function, args, returns) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def get_connection(self) -> None:
+        return None
+
+
+class TelemetryCallback(BaseCallbackHandler):
+    """LangChain callback recording each model call under name; cache hits come back without llm_output"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._started: Dict[Any, float] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs) -> None:
+        latency = time.perf_counter() - self._started.pop(run_id, time.perf_counter())
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        if not usage:
+            # Cached generations keep the usage metadata of the original message
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    prompt_tokens += metadata.get("input_tokens", 0)
+                    completion_tokens += metadata.get("output_tokens", 0)
+        record("llm", self.name, latency, prompt_tokens, completion_tokens, cached=response.llm_output is None)
+
+    def on_llm_error(self, error: BaseException, *, run_id, **kwargs) -> None:
+        latency = time.perf_counter() - self._started.pop(run_id, time.perf_counter())
+        record("llm", self.name, latency, error=True)
@@ -0,0 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from completion_cache import CompletionCache, llm_caller, set_llm_caller
+
+
+def test_llm_caller_does_not_leak_to_the_next_task_of_a_pooled_thread(tmp_path):
+    cache = CompletionCache(str(tmp_path))
+
+    def request():
+        with llm_caller("chat_manager"):
+            set_llm_caller("ChemistAgent")
+            cache.get("missing")
+
+    def next_request():
+        cache.get("missing")
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pool.submit(request).result()
+        pool.submit(next_request).result()
+    assert cache.metrics()["callers"]["ChemistAgent"]["misses"] == 1
+    assert cache.metrics()["callers"]["chat_manager"]["misses"] == 1
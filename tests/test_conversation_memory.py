@@ -0,0 +1,60 @@
+import threading
+
+from conversation_memory import ConversationMemory
+
+
+def blocking_memory(**kwargs):
+    started, release = threading.Event(), threading.Event()
+
+    def summarize(prompt):
+        started.set()
+        release.wait(5)
+        return "llm summary of the old turns"
+
+    return ConversationMemory(window_turns=1, summarize=summarize, **kwargs), started, release
+
+
+def drain(memory):
+    memory._executor.submit(lambda: None).result(5)
+
+
+def test_seed_during_fold_keeps_the_seeded_history():
+    memory, started, release = blocking_memory()
+    memory.record("s", "old question 1", "old answer 1")
+    memory.record("s", "old question 2", "old answer 2")
+    assert started.wait(5)
+    memory.seed("s", [("restored question 1", "restored answer 1"), ("restored question 2", "restored answer 2")])
+    release.set()
+    drain(memory)
+    context = memory.context("s")
+    assert "llm summary" not in context
+    assert "restored question 1" in context and "restored question 2" in context
+    assert memory.stats()["stale_folds"] == 1
+
+
+def test_turns_recorded_after_seed_are_still_folded():
+    memory, started, release = blocking_memory()
+    memory.record("s", "old question 1", "old answer 1")
+    memory.record("s", "old question 2", "old answer 2")
+    assert started.wait(5)
+    memory.seed("s", [("restored", "answer")])
+    memory.record("s", "new question", "new answer")
+    release.set()
+    drain(memory)
+    context = memory.context("s")
+    assert "llm summary" in context
+    assert "Also asked earlier" not in context
+    assert "new question" in context
+
+
+def test_fold_does_not_write_to_an_evicted_session():
+    memory, started, release = blocking_memory(max_sessions=1)
+    memory.record("a", "question 1", "answer 1")
+    memory.record("a", "question 2", "answer 2")
+    assert started.wait(5)
+    memory.record("b", "other question", "other answer")
+    memory.record("a", "fresh question", "fresh answer")
+    release.set()
+    drain(memory)
+    assert "llm summary" not in memory.context("a")
+    assert "fresh question" in memory.context("a")
@@ -0,0 +1,44 @@
+import json
+
+from intent_classifier import IntentClassifier
+
+
+def test_confident_rule_decisions_are_not_training_labels(tmp_path):
+    classifier = IntentClassifier(labels_path=str(tmp_path / "labels.jsonl"), audit_rate=0)
+    assert classifier.classify("latest news on lithium battery prices", llm_classify=lambda query: "3") == "1"
+    assert classifier.stats()["training_labels"] == 0
+    assert not (tmp_path / "labels.jsonl").exists()
+
+
+def test_llm_fallback_and_audit_answers_become_labels(tmp_path):
+    classifier = IntentClassifier(labels_path=str(tmp_path / "labels.jsonl"), audit_rate=0)
+    assert classifier.classify("what do you make of this", llm_classify=lambda query: "Answer: 2") == "2"
+    classifier._audit("latest price of acetone", "1", lambda query: "1")
+    assert classifier.stats()["training_labels"] == 2
+    reloaded = IntentClassifier(labels_path=str(tmp_path / "labels.jsonl"))
+    assert dict(reloaded._labels) == {"what do you make of this": "2", "latest price of acetone": "1"}
+
+
+def test_model_trains_on_llm_labels_only():
+    classifier = IntentClassifier(min_training_examples=4, retrain_every=1000)
+    assert not classifier.train()
+    for i in range(3):
+        classifier._record_llm_label(f"vendor quote {i}", None, "1")
+        classifier._record_llm_label(f"reaction route {i}", None, "2")
+    assert classifier.train()
+    assert classifier.stats()["model_trained"]
+
+
+def test_label_store_is_capped_in_memory_and_on_disk(tmp_path):
+    path = tmp_path / "labels.jsonl"
+    classifier = IntentClassifier(labels_path=str(path), max_labels=5, retrain_every=1000)
+    for i in range(30):
+        classifier._record_llm_label(f"query {i}", None, "2")
+    classifier._record_llm_label("query 29", None, "1")
+    assert list(classifier._labels) == [f"query {i}" for i in range(25, 30)]
+    assert classifier._labels["query 29"] == "1"
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert len(lines) <= 10
+    reloaded = IntentClassifier(labels_path=str(path), max_labels=5)
+    assert dict(reloaded._labels) == dict(classifier._labels)
+    assert all(json.loads(line)["intent"] in "12" for line in lines)
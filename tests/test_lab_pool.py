@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+from lab_pool import LabPool, LabPoolTimeout
+
+
+class Lab:
+    def __init__(self):
+        self.resets = 0
+
+    def reset(self):
+        self.resets += 1
+
+
+def test_concurrent_leases_never_share_a_lab():
+    pool = LabPool(Lab, warm_size=2, max_size=4, acquire_timeout=10)
+    in_use, lock, errors = set(), threading.Lock(), []
+    peak = [0]
+
+    def request():
+        try:
+            for _ in range(20):
+                with pool.lease() as lab:
+                    with lock:
+                        if id(lab) in in_use:
+                            errors.append("double lease")
+                        in_use.add(id(lab))
+                        peak[0] = max(peak[0], len(in_use))
+                    time.sleep(0.001)
+                    with lock:
+                        in_use.discard(id(lab))
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [threading.Thread(target=request) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert peak[0] <= 4
+    stats = pool.stats()
+    assert stats["leases"] == 16 * 20
+    assert stats["leased"] == 0 and stats["waiting"] == 0
+    assert stats["builds"] <= 4
+
+
+def test_waiters_time_out_cleanly_while_every_lab_is_leased():
+    pool = LabPool(Lab, warm_size=1, max_size=1, acquire_timeout=0.1)
+    held = pool.acquire()
+    failures = []
+
+    def request():
+        try:
+            pool.acquire()
+        except LabPoolTimeout:
+            failures.append(1)
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(failures) == 8
+    stats = pool.stats()
+    assert stats["timeouts"] == 8 and stats["waiting"] == 0
+    pool.release(held)
+    assert pool.acquire(timeout=1) is held
+    assert held.resets == 1
+
+
+def test_lab_is_retired_after_max_uses_and_replaced():
+    pool = LabPool(Lab, warm_size=1, max_size=1, max_uses=2, acquire_timeout=5)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    pool.release(first)
+    second = pool.acquire()
+    assert second is not first
+    pool.release(second)
+    assert pool.stats()["retired"] == 1
+
+
+def test_double_release_is_ignored():
+    pool = LabPool(Lab, max_size=1, acquire_timeout=5)
+    lab = pool.acquire()
+    pool.release(lab)
+    pool.release(lab)
+    assert pool.stats()["leased"] == 0
+    assert lab.resets == 1
+
+
+def test_failed_builds_are_retried_for_waiting_requests():
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("model download failed")
+        return Lab()
+
+    pool = LabPool(factory, warm_size=0, max_size=1, acquire_timeout=5)
+    lab = pool.acquire()
+    assert isinstance(lab, Lab)
+    assert pool.stats()["build_errors"] == 1
+    pool.release(lab)
+
+
+def test_lease_releases_when_the_request_fails():
+    pool = LabPool(Lab, max_size=1, acquire_timeout=5)
+    with pytest.raises(ValueError):
+        with pool.lease():
+            raise ValueError("request failed")
+    assert pool.stats()["leased"] == 0
@@ -0,0 +1,235 @@
+import copy
+import threading
+import time
+
+import httpx
+import pytest
+
+from model_router import ModelRouter, NoEndpointAvailable, RankedConfigList, RoutedOpenAIClient
+from resilience import RetryPolicy
+
+NO_BACKOFF = RetryPolicy(base_delay=0)
+
+
+def configs(*models):
+    return [{"model": model, "api_key": "key", "base_url": f"http://{model}.test/v1"} for model in models]
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def warm(router, **latencies):
+    for endpoint in router.endpoints:
+        if endpoint.model in latencies:
+            endpoint.latency = latencies[endpoint.model]
+
+
+def test_selects_fastest_endpoint():
+    router = ModelRouter(configs("slow", "fast"))
+    warm(router, slow=2.0, fast=0.1)
+    assert router.call(lambda endpoint: endpoint.model) == "fast"
+    assert [config["model"] for config in router.ranked_configs()] == ["fast", "slow"]
+
+
+def test_unmeasured_endpoint_is_tried_before_measured_ones():
+    router = ModelRouter(configs("known", "new"))
+    warm(router, known=0.1)
+    assert router.call(lambda endpoint: endpoint.model) == "new"
+
+
+def test_fails_over_to_next_endpoint():
+    router = ModelRouter(configs("first", "second"))
+    warm(router, first=0.1, second=0.5)
+    seen = []
+
+    def fn(endpoint):
+        seen.append(endpoint.model)
+        if endpoint.model == "first":
+            raise StatusError(503)
+        return "ok"
+
+    assert router.call(fn) == "ok"
+    assert seen == ["first", "second"]
+    assert router.stats()["first@http://first.test/v1"]["errors"] == 1
+
+
+def test_transient_errors_are_retried_after_every_endpoint_failed():
+    router = ModelRouter(configs("only"), retry=NO_BACKOFF)
+    seen = []
+
+    def flaky(endpoint):
+        seen.append(endpoint.model)
+        if len(seen) < 3:
+            raise StatusError(503)
+        return "ok"
+
+    assert router.call(flaky) == "ok"
+    assert seen == ["only"] * 3
+
+
+def test_retries_stop_after_the_policy_attempts():
+    router = ModelRouter(configs("a", "b"), failure_threshold=10, retry=RetryPolicy(attempts=3, base_delay=0))
+    seen = []
+
+    def fail(endpoint):
+        seen.append(endpoint.model)
+        raise StatusError(502)
+
+    with pytest.raises(StatusError):
+        router.call(fail)
+    assert len(seen) == 3
+
+
+def test_permanent_errors_fail_over_but_are_not_repeated():
+    router = ModelRouter(configs("a", "b"), failure_threshold=10, retry=NO_BACKOFF)
+    seen = []
+
+    def unauthorized(endpoint):
+        seen.append(endpoint.model)
+        raise StatusError(401)
+
+    with pytest.raises(StatusError):
+        router.call(unauthorized)
+    assert sorted(seen) == ["a", "b"]
+
+
+def test_request_errors_are_not_failed_over():
+    router = ModelRouter(configs("a", "b"))
+    seen = []
+
+    def fn(endpoint):
+        seen.append(endpoint.model)
+        raise StatusError(400)
+
+    with pytest.raises(StatusError):
+        router.call(fn)
+    assert len(seen) == 1
+
+
+def test_breaker_sheds_failing_endpoint_and_fails_fast_when_all_are_tripped():
+    router = ModelRouter(configs("a", "b"), failure_threshold=2, reset_timeout=60, acquire_timeout=30, retry=NO_BACKOFF)
+
+    def fail(endpoint):
+        raise StatusError(500)
+
+    for _ in range(2):
+        with pytest.raises(StatusError):
+            router.call(fail)
+    assert {stats["breaker"] for stats in router.stats().values()} == {"open"}
+    start = time.perf_counter()
+    with pytest.raises(NoEndpointAvailable):
+        router.call(lambda endpoint: "never")
+    assert time.perf_counter() - start < 1.0
+
+
+def test_rate_limited_endpoint_is_skipped_until_reset():
+    router = ModelRouter(configs("limited", "other"))
+    warm(router, limited=0.1, other=1.0)
+    limited = router.endpoints[0]
+    router.observe_response(limited, httpx.Response(429, headers={"retry-after": "0.3"}))
+    assert router.call(lambda endpoint: endpoint.model) == "other"
+    router.observe_response(router.endpoints[1], httpx.Response(429, headers={"retry-after": "0.3"}))
+    start = time.perf_counter()
+    with pytest.raises(NoEndpointAvailable):
+        router.call(lambda endpoint: endpoint.model)
+    assert time.perf_counter() - start < 0.2
+    time.sleep(0.35)
+    assert router.call(lambda endpoint: endpoint.model) == "limited"
+
+
+def test_busy_endpoints_are_waited_for():
+    router = ModelRouter(configs("only"), max_concurrency=1, acquire_timeout=5)
+    release = threading.Event()
+    started = threading.Event()
+
+    def hold(endpoint):
+        started.set()
+        release.wait()
+        return "first"
+
+    thread = threading.Thread(target=router.call, args=(hold,))
+    thread.start()
+    started.wait()
+    threading.Timer(0.2, release.set).start()
+    assert router.call(lambda endpoint: "second") == "second"
+    thread.join()
+
+
+def test_idle_endpoints_are_probed_in_the_background_not_with_user_traffic():
+    probed = []
+    done = threading.Event()
+
+    def probe(endpoint):
+        probed.append(endpoint.model)
+        done.set()
+
+    router = ModelRouter(configs("fast", "slow"), probe_interval=0, probe=probe)
+    warm(router, fast=0.1, slow=5.0)
+    for _ in range(3):
+        assert router.call(lambda endpoint: endpoint.model) == "fast"
+    assert done.wait(1)
+    assert "slow" in probed
+
+
+def test_tripped_endpoints_are_not_probed():
+    probed = []
+    router = ModelRouter(configs("a"), failure_threshold=1, probe_interval=0, probe=lambda endpoint: probed.append(1))
+    warm(router, a=0.1)
+    router.endpoints[0].breaker.record_failure()
+    with pytest.raises(NoEndpointAvailable):
+        router.call(lambda endpoint: "never")
+    time.sleep(0.05)
+    assert probed == []
+
+
+def test_ranked_config_list_follows_the_router_after_deepcopy():
+    router = ModelRouter(configs("a", "b"))
+    warm(router, a=1.0, b=0.1)
+    view = copy.deepcopy({"config_list": RankedConfigList(router)})["config_list"]
+    assert [config["model"] for config in view] == ["b", "a"]
+    warm(router, a=0.01)
+    assert [config["model"] for config in view] == ["a", "b"]
+
+
+class DictCache:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def set(self, key, value):
+        self.entries[key] = value
+
+
+class FakeClient:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def create(self, params):
+        self.calls.append(params["model"])
+        return f"answer from {params['model']}"
+
+
+def routed_client(router, cache, calls):
+    client = RoutedOpenAIClient({"model": "placeholder"}, router=router, cache=cache)
+    client._client = lambda endpoint: FakeClient(calls)
+    return client
+
+
+def test_routed_client_caches_under_the_serving_model():
+    router = ModelRouter(configs("a", "b"))
+    warm(router, a=0.1, b=1.0)
+    cache, calls = DictCache(), []
+    client = routed_client(router, cache, calls)
+    params = {"model": "placeholder", "messages": [{"role": "user", "content": "hi"}]}
+    assert client.create(params) == "answer from a"
+    assert client.create(params) == "answer from a"
+    assert calls == ["a"]
+    # Once b is the faster endpoint, a's cached answer is not served as b's
+    warm(router, a=2.0)
+    assert client.create(params) == "answer from b"
+    assert calls == ["a", "b"]
@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+from request_pipeline import RequestPipeline, Stage, parse_budgets
+
+
+class State:
+    def __init__(self):
+        self.ran = []
+
+
+def stage(name, action=None, **kwargs):
+    def run(state, budget):
+        state.ran.append((name, budget))
+        if action is not None:
+            action(state, budget)
+    return Stage(name, run, **kwargs)
+
+
+def fail(state, budget):
+    raise RuntimeError("boom")
+
+
+def test_stages_run_in_order_and_skips_are_reported():
+    pipeline = RequestPipeline([
+        stage("first", required=True),
+        stage("disabled"),
+        stage("skipped", skip=lambda state: "no_input"),
+        stage("last"),
+    ], enabled=["skipped", "last"])
+    state = State()
+    report = pipeline.run(state)
+    assert [name for name, _ in state.ran] == ["first", "last"]
+    assert [(entry["stage"], entry["status"], entry.get("reason")) for entry in report] == [
+        ("first", "ok", None), ("disabled", "skipped", "disabled"), ("skipped", "skipped", "no_input"), ("last", "ok", None)]
+
+
+def test_required_stage_failure_stops_the_request_and_keeps_the_report():
+    pipeline = RequestPipeline([stage("setup", fail, required=True), stage("after")])
+    state, report = State(), []
+    with pytest.raises(RuntimeError):
+        pipeline.run(state, report=report)
+    assert [name for name, _ in state.ran] == ["setup"]
+    assert report == [{"stage": "setup", "status": "failed", "elapsed": report[0]["elapsed"], "budget": None, "error": "boom"}]
+
+
+def test_optional_stage_failure_is_skipped_over():
+    pipeline = RequestPipeline([stage("extra", fail), stage("main", required=True)])
+    state = State()
+    report = pipeline.run(state)
+    assert [name for name, _ in state.ran] == ["extra", "main"]
+    assert [entry["status"] for entry in report] == ["failed", "ok"]
+
+
+def test_stage_budget_is_capped_by_the_remaining_request_budget():
+    pipeline = RequestPipeline([
+        stage("slow", lambda state, budget: time.sleep(0.2), budget=0.05),
+        stage("capped", budget=10),
+        stage("optional"),
+        stage("required", required=True),
+    ], request_budget=0.1)
+    state = State()
+    report = pipeline.run(state)
+    assert report[0]["status"] == "over_budget"
+    assert report[1] == {"stage": "capped", "status": "skipped", "reason": "request_budget"}
+    assert report[2]["reason"] == "request_budget"
+    # Required stages run even after the request budget is spent, with no time left
+    assert state.ran[-1] == ("required", 0.0)
+
+
+def test_parse_budgets():
+    assert parse_budgets("retrieve=20, annotate = 2.5,bad,evolve=x,") == {"retrieve": 20.0, "annotate": 2.5}
+    assert parse_budgets("1=3,4=1", int) == {"1": 3, "4": 1}
+    assert parse_budgets("") == {}
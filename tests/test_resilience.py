@@ -0,0 +1,57 @@
+import httpx
+import pytest
+
+from resilience import CircuitBreaker, ResilientBackend, RetryPolicy, is_transient
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def backend(attempts=3, failure_threshold=5):
+    return ResilientBackend("test", policy=RetryPolicy(attempts=attempts, base_delay=0),
+                            breaker=CircuitBreaker(failure_threshold=failure_threshold, name="test"))
+
+
+def counting(error):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise error
+    return fn, calls
+
+
+@pytest.mark.parametrize("error, transient", [
+    (StatusError(500), True),
+    (StatusError(503), True),
+    (StatusError(429), True),
+    (StatusError(400), False),
+    (StatusError(401), False),
+    (StatusError(404), False),
+    (httpx.ConnectError("refused"), True),
+    (httpx.ReadTimeout("slow"), True),
+    (TimeoutError(), True),
+    (ValueError("bad input"), False),
+])
+def test_is_transient(error, transient):
+    assert is_transient(error) is transient
+
+
+def test_transient_errors_are_retried():
+    fn, calls = counting(StatusError(503))
+    with pytest.raises(StatusError):
+        backend().call(fn)
+    assert len(calls) == 3
+
+
+def test_client_errors_fail_at_once_without_tripping_the_breaker():
+    service = backend(failure_threshold=1)
+    fn, calls = counting(StatusError(400))
+    with pytest.raises(StatusError):
+        service.call(fn)
+    assert len(calls) == 1
+    assert service.breaker.state == "closed"
+    assert service.stats.snapshot()["retries"] == 0
@@ -0,0 +1,152 @@
+import threading
+
+import numpy as np
+import pytest
+
+from vector_store import QuantizedVectorStore, prune_stores
+
+DIM = 32
+
+
+class HashEmbeddings:
+    """Deterministic random unit vectors per text"""
+
+    def embed_query(self, text):
+        rng = np.random.default_rng(sum(ord(c) * 31 ** i for i, c in enumerate(text)) % 2 ** 32)
+        return rng.normal(size=DIM).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+class ClusteredEmbeddings(HashEmbeddings):
+    """Texts "<cluster> <i>" lie around one of 40 random centers, like topical document embeddings"""
+
+    centers = np.random.default_rng(1).normal(size=(40, DIM))
+
+    def embed_query(self, text):
+        cluster = int(text.split()[0]) if text.split()[0].isdigit() else 0
+        return (self.centers[cluster] + 0.5 * np.array(super().embed_query(text)) / np.sqrt(DIM) * 4).tolist()
+
+
+def texts(n, prefix="doc"):
+    return [f"{prefix} {i}" for i in range(n)]
+
+
+def exact_top_k(query, vectors, k):
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return set(np.argsort(-(vectors @ (query / np.linalg.norm(query))))[:k])
+
+
+@pytest.mark.parametrize("dtype,tolerance", [("int8", 0.02), ("float16", 0.002)])
+def test_quantized_round_trip(tmp_path, dtype, tolerance):
+    store = QuantizedVectorStore.from_texts(texts(50), HashEmbeddings(), persist_directory=str(tmp_path), dtype=dtype)
+    with store._snapshot() as generation:
+        restored = np.asarray(generation.vectors, dtype=np.float32) * np.asarray(generation.scales)[:, None]
+    original = np.array(HashEmbeddings().embed_documents(texts(50)))
+    original /= np.linalg.norm(original, axis=1, keepdims=True)
+    assert np.abs(restored - original).max() < tolerance
+    for text in ("doc 0", "doc 17", "doc 49"):
+        document, score = store.similarity_search_with_score(text, k=1)[0]
+        assert document.page_content == text
+        assert score == pytest.approx(1.0, abs=tolerance * 5)
+
+
+def test_ivf_recall_against_exact_search(tmp_path):
+    corpus = [f"{i % 40} {i}" for i in range(2000)]
+    embeddings = ClusteredEmbeddings()
+    store = QuantizedVectorStore.from_texts(corpus, embeddings, persist_directory=str(tmp_path),
+                                            ivf_min_rows=1000, nprobe=8)
+    assert store.manifest["ivf_rows"] == 2000
+    vectors = np.array(embeddings.embed_documents(corpus))
+    found = expected = 0
+    for i in range(50):
+        query = np.array(embeddings.embed_query(f"{i % 40} query {i}"))
+        exact = {corpus[i] for i in exact_top_k(query, vectors, 10)}
+        approximate = {doc.page_content for doc in store.similarity_search_by_vector(query.tolist(), k=10)}
+        found += len(exact & approximate)
+        expected += len(exact)
+    assert found / expected >= 0.9
+
+
+def test_append_after_partition_is_searched(tmp_path):
+    store = QuantizedVectorStore.from_texts(texts(300), HashEmbeddings(), persist_directory=str(tmp_path),
+                                            ivf_min_rows=100, nprobe=1)
+    ids = store.add_texts(["appended"], [{"chunk_id": "extra-1"}])
+    assert ids == ["extra-1"]
+    assert len(store) == 301
+    assert store.similarity_search("appended", k=1)[0].page_content == "appended"
+    assert [doc.page_content for doc in store.get_by_ids(["extra-1", "missing", "row-5"])] == ["appended", "doc 5"]
+    # A second process sees the appended row too
+    assert len(QuantizedVectorStore(HashEmbeddings(), str(tmp_path))) == 301
+
+
+def test_open_or_build_loads_corpus_once(tmp_path):
+    calls = []
+
+    def load():
+        calls.append(1)
+        return texts(20), None
+
+    first = QuantizedVectorStore.open_or_build(HashEmbeddings(), str(tmp_path), "key", load)
+    second = QuantizedVectorStore.open_or_build(HashEmbeddings(), str(tmp_path), "key", load)
+    assert len(calls) == 1
+    assert len(first) == len(second) == 20
+    QuantizedVectorStore.open_or_build(HashEmbeddings(), str(tmp_path), "other", lambda: (texts(5, "new"), None))
+    assert len(second.refresh().vectors) == 5
+
+
+def test_searches_stay_consistent_while_generations_are_published(tmp_path):
+    writer = QuantizedVectorStore.from_texts(texts(400), HashEmbeddings(), persist_directory=str(tmp_path))
+    reader = QuantizedVectorStore(HashEmbeddings(), str(tmp_path))
+    errors = []
+    done = threading.Event()
+
+    def search():
+        while not done.is_set():
+            try:
+                for text in ("doc 3", "doc 150", "doc 399"):
+                    assert reader.similarity_search(text, k=1)[0].page_content == text
+            except Exception as e:
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=search) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(6):
+            # Reordering rows is the case where offsets of one generation misread another's documents
+            writer.build_partition(n_lists=4 + i)
+            writer.add_texts([f"extra {i}"])
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+    assert not errors
+    assert len(reader.refresh().vectors) == 406
+    generations = [p for p in tmp_path.iterdir() if p.name.startswith("gen-")]
+    assert len(generations) <= 2
+
+
+def test_superseded_generation_is_closed_after_its_last_search(tmp_path):
+    store = QuantizedVectorStore.from_texts(texts(10), HashEmbeddings(), persist_directory=str(tmp_path))
+    with store._snapshot() as generation:
+        store.add_texts(["late"])
+        assert not generation.closed
+        assert generation.read_line(0)
+    assert generation.closed
+    assert not store.refresh().closed
+
+
+def test_prune_stores_removes_superseded_and_unused(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("a")
+    root = tmp_path / "stores"
+    for key in ("old", "current", "other"):
+        QuantizedVectorStore.open_or_build(HashEmbeddings(), str(root / key), key, lambda: (texts(3), None),
+                                           sources=[str(source)] if key != "other" else [])
+    prune_stores(str(root), keep="current", sources=[str(source)], max_age=3600)
+    assert sorted(p.name for p in root.iterdir()) == ["current", "other"]
+    prune_stores(str(root), keep="current", max_age=-1)
+    assert [p.name for p in root.iterdir()] == ["current"]
@@ -0,0 +1,127 @@
+"""
+Concurrent execution of the tool calls of one assistant message.
+
+autogen's generate_tool_calls_reply runs the tool calls of a message one
+after another, so a turn that asks for a literature search and a web search
+takes the sum of both. ParallelToolExecutor runs them on a shared, bounded
+thread pool instead, each in a copy of the caller's context (request
+context, telemetry and output stream stay attached), and returns the tool
+responses in the order of the calls. A call that exceeds its timeout is
+answered with an error message and left to finish in the background.
+Tools that are not thread-safe (pyplot keeps global figure state) can be
+declared serial: their calls still overlap with other tools but never with
+each other.
+"""
+import contextvars
+import inspect
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ParallelToolExecutor:
+    """Runs the tool calls of a message concurrently with per-tool timeouts"""
+
+    def __init__(self, max_workers: int = 8, default_timeout: float = 60.0,
+                 timeouts: Optional[Dict[str, float]] = None, serial: Iterable[str] = ()):
+        """
+        Args:
+            max_workers (int): Tool calls running at once across all agents
+            default_timeout (float): Seconds a tool call may take
+            timeouts: Per-tool overrides of default_timeout, by function name
+            serial: Names of tools whose calls must not run concurrently with each other
+        """
+        self.default_timeout = default_timeout
+        self.timeouts = dict(timeouts or {})
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self._lock = threading.Lock()
+        self._serial_locks = {name: threading.Lock() for name in serial}
+        self._stats = Counter()
+
+    def _count(self, stat: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[stat] += amount
+
+    def timeout_for(self, name: str) -> float:
+        return self.timeouts.get(name, self.default_timeout)
+
+    def _run(self, agent: Any, call: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        lock = self._serial_locks.get(call.get("name", ""))
+        if lock is None:
+            return agent.execute_function(call)
+        with lock:
+            return agent.execute_function(call)
+
+    def execute(self, agent: Any, tool_calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Tool responses for tool_calls, in call order"""
+        function_calls = [tool_call.get("function", {}) for tool_call in tool_calls]
+        self._count("messages")
+        self._count("calls", len(function_calls))
+        start = time.perf_counter()
+        if len(function_calls) > 1:
+            self._count("parallel_messages")
+        # A single call runs on the pool too, so its timeout applies
+        submitted = [
+            (call.get("name", ""), time.perf_counter(),
+             self._executor.submit(contextvars.copy_context().run, self._run, agent, call))
+            for call in function_calls
+        ]
+        contents = []
+        for name, submitted_at, future in submitted:
+            timeout = self.timeout_for(name)
+            try:
+                contents.append(future.result(timeout=max(0.0, submitted_at + timeout - time.perf_counter()))[1].get("content", ""))
+            except FutureTimeoutError:
+                self._count("timeouts")
+                logger.warning(f"Tool {name} of {agent.name} timed out after {timeout}s")
+                contents.append(f"Error: Tool {name} timed out after {timeout:g}s")
+            except Exception as e:
+                # execute_function reports tool errors itself; this is a failure of the call machinery
+                logger.error(f"Error running tool {name} of {agent.name}: {str(e)}", exc_info=True)
+                contents.append(f"Error: {e}")
+        self._count("elapsed_ms", int((time.perf_counter() - start) * 1000))
+        responses = []
+        for tool_call, content in zip(tool_calls, contents):
+            response = {"role": "tool", "content": content if content is not None else ""}
+            # Mistral-compatible APIs reject a tool_call_id they did not send
+            if tool_call.get("id") is not None:
+                response["tool_call_id"] = tool_call["id"]
+            responses.append(response)
+        return responses
+
+    def reply_func(self) -> Callable:
+        """Drop-in replacement for ConversableAgent.generate_tool_calls_reply (see agent.replace_reply_func)"""
+        from autogen import ConversableAgent
+
+        def generate_parallel_tool_calls_reply(agent: ConversableAgent, messages: Optional[List[Dict]] = None,
+                                               sender: Optional[Any] = None, config: Optional[Any] = None) -> Tuple[bool, Optional[Dict]]:
+            if messages is None:
+                messages = agent._oai_messages[sender]
+            tool_calls = messages[-1].get("tool_calls") or []
+            if not tool_calls:
+                # Called for every reply; only messages with tool calls are counted and executed
+                return False, None
+            if any(inspect.iscoroutinefunction(agent.function_map.get(call.get("function", {}).get("name"))) for call in tool_calls):
+                # Async tools need autogen's event loop handling
+                return ConversableAgent.generate_tool_calls_reply(agent, messages, sender, config)
+            tool_responses = self.execute(agent, tool_calls)
+            return True, {
+                "role": "tool",
+                "tool_responses": tool_responses,
+                "content": "\n\n".join(agent._str_for_tool_response(response) for response in tool_responses)
+            }
+
+        return generate_parallel_tool_calls_reply
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        messages = stats.pop("messages", 0)
+        stats["messages"] = messages
+        stats["avg_elapsed"] = round(stats.pop("elapsed_ms", 0) / 1000 / messages, 3) if messages else None
+        return stats
@@ -0,0 +1,508 @@
+"""
+Quantized, memory-mapped vector store for large literature collections.
+
+Embeddings are unit-normalized, quantized to int8 (per-row scale) or float16
+and written to NumPy files that every worker opens with ``mmap_mode='r'``, so
+the vectors live in the shared OS page cache instead of each process' heap.
+Document texts are read from disk on demand through an offsets table.
+
+Every write publishes a complete new generation into its own subdirectory
+and then points ``manifest.json`` at it, so a reader always sees the
+vectors, offsets and documents of one generation together. Readers keep the
+files of the generation they opened (memory maps and the documents file
+handle) while a search uses them and release them once a newer generation
+has replaced them. Builds take an exclusive file lock, so only one worker
+process writes at a time, and open_or_build lets the workers that find a
+finished store skip loading and splitting the corpus altogether.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+try:
+    import fcntl
+except ImportError:  # Windows: builds are only serialized within the process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_DTYPES = ("int8", "float16")
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = ".build.lock"
+GENERATION_PREFIX = "gen-"
+
+
+def corpus_fingerprint(paths: Iterable[str], extra: str = "") -> str:
+    """Stable key for a set of source files, used to reuse an existing store across workers"""
+    digest = hashlib.sha256(extra.encode("utf-8"))
+    for path in sorted(p for p in paths if p):
+        try:
+            stat = os.stat(path)
+            digest.update(f"{os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}".encode("utf-8"))
+        except OSError:
+            digest.update(f"{path}:missing".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def _id_hash(doc_id: str) -> int:
+    return int.from_bytes(hashlib.blake2b(doc_id.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def prune_stores(root: str, keep: str, sources: Iterable[str] = (), max_age: Optional[float] = None) -> None:
+    """
+    Remove store directories under root other than keep: those built from the same
+    sources (superseded when a source file changed) and those unused for max_age seconds
+    """
+    sources = sorted(os.path.abspath(path) for path in sources if path)
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name == keep or not os.path.isdir(path):
+            continue
+        try:
+            with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+                manifest_sources = json.load(f).get("sources")
+        except (OSError, ValueError):
+            manifest_sources = None
+        superseded = bool(sources) and manifest_sources == sources
+        unused = max_age is not None and now - os.path.getmtime(path) > max_age
+        if superseded or unused:
+            shutil.rmtree(path, ignore_errors=True)
+            logger.info(f"Removed {'superseded' if superseded else 'unused'} vector store {path}")
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantize unit vectors, returning (codes, per-row scales)"""
+    if dtype == "float16":
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _kmeans(vectors: np.ndarray, n_lists: int, iterations: int = 10, sample_size: int = 50000, seed: int = 42) -> np.ndarray:
+    """Spherical k-means on a sample, returns unit-normalized centroids"""
+    rng = np.random.default_rng(seed)
+    sample = vectors if len(vectors) <= sample_size else vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = sample[assignments == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+    return centroids
+
+
+class _Generation:
+    """The files of one published generation, opened together and closed once retired and unused"""
+
+    def __init__(self, directory: str, manifest: Dict[str, Any]):
+        self.manifest = manifest
+        self.id = manifest.get("generation")
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        self.scales = np.load(os.path.join(directory, "scales.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        # Document ids by hash, sorted, with their rows
+        self.id_hashes = np.load(os.path.join(directory, "id_hashes.npy"), mmap_mode="r")
+        self.id_rows = np.load(os.path.join(directory, "id_rows.npy"), mmap_mode="r")
+        self.centroids = self.list_offsets = None
+        if manifest.get("ivf_rows"):
+            self.centroids = np.load(os.path.join(directory, "centroids.npy"))
+            self.list_offsets = np.load(os.path.join(directory, "list_offsets.npy"))
+        # Held open so a later publish or cleanup cannot change the documents under these offsets
+        self.documents = open(os.path.join(directory, "documents.jsonl"), "rb")
+        self._read_lock = threading.Lock()
+        self._users = 0
+        self._retired = False
+        self.closed = False
+
+    def acquire(self) -> bool:
+        with self._read_lock:
+            if self.closed:
+                return False
+            self._users += 1
+            return True
+
+    def release(self) -> None:
+        with self._read_lock:
+            self._users -= 1
+            close = self._retired and self._users == 0
+        if close:
+            self._close()
+
+    def retire(self) -> None:
+        """Mark as replaced; closed now if no search uses it, else when the last one releases it"""
+        with self._read_lock:
+            self._retired = True
+            close = self._users == 0
+        if close:
+            self._close()
+
+    def _close(self) -> None:
+        with self._read_lock:
+            if self.closed:
+                return
+            self.closed = True
+            # The maps are unmapped as soon as no array refers to them any more
+            self.vectors = self.scales = self.offsets = self.id_hashes = self.id_rows = None
+            self.documents.close()
+
+    def read_line(self, row: int) -> bytes:
+        start, stop = int(self.offsets[row]), int(self.offsets[row + 1])
+        with self._read_lock:
+            self.documents.seek(start)
+            return self.documents.read(stop - start)
+
+    def read_all(self) -> List[str]:
+        with self._read_lock:
+            self.documents.seek(0)
+            return self.documents.read().decode("utf-8").splitlines()
+
+    def find(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        """Stored record of a document id, or None"""
+        target = _id_hash(doc_id)
+        position = int(np.searchsorted(self.id_hashes, target))
+        while position < len(self.id_hashes) and int(self.id_hashes[position]) == target:
+            record = json.loads(self.read_line(int(self.id_rows[position])).decode("utf-8"))
+            if record.get("id") == doc_id:
+                return record
+            position += 1
+        return None
+
+
+class QuantizedVectorStore(VectorStore):
+    """
+    LangChain vector store backed by quantized, memory-mapped NumPy files
+
+    Search is an exact, vectorized dot product over the quantized rows. When the
+    store was built with an IVF partition, only the ``nprobe`` closest lists plus
+    rows appended after the partition was built are scanned.
+    """
+
+    def __init__(self, embedding: Embeddings, persist_directory: str, dtype: str = "int8",
+                 nprobe: int = 8, block_size: int = 65536):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported dtype '{dtype}', expected one of {SUPPORTED_DTYPES}")
+        self._embedding = embedding
+        self.persist_directory = persist_directory
+        self.dtype = dtype
+        self.nprobe = nprobe
+        self.block_size = block_size
+        self._write_lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = None
+        self._current: Optional[_Generation] = None
+        self._refresh_lock = threading.Lock()
+        self.manifest: Dict[str, Any] = {}
+        os.makedirs(persist_directory, exist_ok=True)
+        self.refresh()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def __len__(self) -> int:
+        return int(self.manifest.get("rows", 0))
+
+    # --- Loading -------------------------------------------------------------
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.persist_directory, name)
+
+    def _read_manifest(self) -> Dict[str, Any]:
+        try:
+            with open(self._path(MANIFEST_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def refresh(self) -> Optional[_Generation]:
+        """(Re)open the generation the manifest names if another process published a new one"""
+        with self._refresh_lock:
+            for _ in range(3):
+                manifest = self._read_manifest()
+                previous = self._current
+                if previous is not None and manifest.get("generation") == previous.id:
+                    return previous
+                if not manifest:
+                    self.manifest, self._current = {}, None
+                else:
+                    try:
+                        generation = _Generation(self._path(manifest["directory"]), manifest)
+                    except FileNotFoundError:
+                        # The generation was replaced and cleaned up between reading the manifest and opening it
+                        continue
+                    self.dtype = manifest.get("dtype", self.dtype)
+                    self.manifest, self._current = manifest, generation
+                    logger.info(f"Opened quantized vector store at {self.persist_directory} "
+                                f"({len(generation.vectors)} rows, {self.dtype}, generation {generation.id})")
+                if previous is not None:
+                    previous.retire()
+                return self._current
+        raise RuntimeError(f"Vector store at {self.persist_directory} keeps changing while being opened")
+
+    @contextmanager
+    def _snapshot(self):
+        """The current generation, kept open until the block ends even if a newer one is published"""
+        for _ in range(3):
+            generation = self.refresh()
+            if generation is None or generation.acquire():
+                break
+        else:
+            raise RuntimeError(f"Vector store at {self.persist_directory} keeps changing while being read")
+        try:
+            yield generation
+        finally:
+            if generation is not None:
+                generation.release()
+
+    def matches_corpus(self, corpus_key: str) -> bool:
+        return bool(self.manifest) and self.manifest.get("corpus_key") == corpus_key
+
+    # --- Writing -------------------------------------------------------------
+
+    @contextmanager
+    def _build_lock(self):
+        """Exclusive across the threads of this process and, where flock exists, across processes"""
+        with self._write_lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                self._lock_file = open(self._path(LOCK_FILE), "a")
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_file is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def _existing_rows(self, generation: Optional[_Generation]) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        if generation is None:
+            return np.empty((0, 0), dtype=self.dtype), np.empty(0, dtype=np.float32), []
+        return np.array(generation.vectors), np.array(generation.scales), generation.read_all()
+
+    def _publish(self, codes: np.ndarray, scales: np.ndarray, lines: List[str], manifest: Dict[str, Any],
+                 centroids: Optional[np.ndarray] = None, list_offsets: Optional[np.ndarray] = None) -> None:
+        """Write a new generation into its own directory, then point the manifest at it; call under _build_lock"""
+        generation_id = hashlib.sha1(os.urandom(16)).hexdigest()[:12]
+        directory = GENERATION_PREFIX + generation_id
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.persist_directory)
+        try:
+            offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+            with open(os.path.join(staging, "documents.jsonl"), "wb") as f:
+                for i, line in enumerate(lines):
+                    encoded = (line + "\n").encode("utf-8")
+                    f.write(encoded)
+                    offsets[i + 1] = offsets[i] + len(encoded)
+            np.save(os.path.join(staging, "vectors.npy"), codes)
+            np.save(os.path.join(staging, "scales.npy"), scales.astype(np.float32))
+            np.save(os.path.join(staging, "offsets.npy"), offsets)
+            hashes = np.array([_id_hash(json.loads(line)["id"]) for line in lines], dtype=np.uint64)
+            order = np.argsort(hashes, kind="stable")
+            np.save(os.path.join(staging, "id_hashes.npy"), hashes[order])
+            np.save(os.path.join(staging, "id_rows.npy"), order.astype(np.int64))
+            if centroids is not None:
+                np.save(os.path.join(staging, "centroids.npy"), centroids.astype(np.float32))
+                np.save(os.path.join(staging, "list_offsets.npy"), list_offsets)
+            os.replace(staging, self._path(directory))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        manifest = dict(manifest, generation=generation_id, directory=directory, dtype=self.dtype, rows=len(lines))
+        manifest_tmp = self._path(f".{MANIFEST_FILE}.{generation_id}")
+        with open(manifest_tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        # The only switch readers observe: one rename of the manifest naming a complete generation
+        os.replace(manifest_tmp, self._path(MANIFEST_FILE))
+        previous = self._current
+        self.refresh()
+        self._remove_generations(keep={directory, previous.manifest.get("directory") if previous else None})
+
+    def _remove_generations(self, keep: Iterable[Optional[str]] = ()) -> None:
+        """
+        Delete superseded generation directories; the one just replaced is kept for readers
+        that read the old manifest but have not opened its files yet. Open files stay
+        readable where the OS allows unlinking them (POSIX); elsewhere removal is retried
+        on the next publish.
+        """
+        keep = set(keep)
+        for name in os.listdir(self.persist_directory):
+            if name.startswith(GENERATION_PREFIX) and name not in keep:
+                shutil.rmtree(self._path(name), ignore_errors=True)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = _normalize(self._embedding.embed_documents(texts))
+        new_codes, new_scales = _quantize(vectors, self.dtype)
+        with self._build_lock():
+            # replace=True publishes the texts as the whole store instead of appending them
+            generation = None if kwargs.get("replace") else self.refresh()
+            codes, scales, lines = self._existing_rows(generation)
+            start = len(lines)
+            ids = [metadata.get("chunk_id") or f"row-{start + i}" for i, metadata in enumerate(metadatas)]
+            lines = lines + [json.dumps({"id": doc_id, "page_content": text, "metadata": metadata}, ensure_ascii=False)
+                             for doc_id, text, metadata in zip(ids, texts, metadatas)]
+            codes = new_codes if not len(codes) else np.concatenate([codes, new_codes])
+            scales = np.concatenate([scales, new_scales])
+            manifest = dict(self.manifest or {}) if generation is not None else {}
+            extra = {}
+            if manifest.get("ivf_rows"):
+                extra = {"centroids": generation.centroids, "list_offsets": generation.list_offsets}
+            manifest.update(kwargs.get("manifest", {}))
+            self._publish(codes, scales, lines, manifest, **extra)
+        return ids
+
+    def build_partition(self, n_lists: Optional[int] = None) -> None:
+        """Build an IVF coarse partition and reorder rows so each list is a contiguous slice"""
+        with self._build_lock():
+            codes, scales, lines = self._existing_rows(self.refresh())
+            if not len(lines):
+                return
+            n_lists = n_lists or max(1, int(np.sqrt(len(lines))))
+            n_lists = min(n_lists, len(lines))
+            vectors = _normalize(codes.astype(np.float32) * scales[:, None])
+            centroids = _kmeans(vectors, n_lists)
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=n_lists)
+            list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            manifest = dict(self.manifest, ivf_rows=len(lines), n_lists=n_lists)
+            self._publish(codes[order], scales[order], [lines[i] for i in order], manifest,
+                          centroids=centroids, list_offsets=list_offsets)
+        logger.info(f"Built IVF partition with {n_lists} lists over {len(lines)} rows")
+
+    # --- Search --------------------------------------------------------------
+
+    def _probe_ranges(self, generation: _Generation, query: np.ndarray) -> List[Tuple[int, int]]:
+        ivf_rows = generation.manifest.get("ivf_rows", 0)
+        if not ivf_rows or generation.centroids is None:
+            return [(0, len(generation.vectors))]
+        nprobe = min(self.nprobe, len(generation.centroids))
+        probes = np.argpartition(-(generation.centroids @ query), nprobe - 1)[:nprobe]
+        ranges = [(int(generation.list_offsets[i]), int(generation.list_offsets[i + 1])) for i in sorted(probes)]
+        if len(generation.vectors) > ivf_rows:
+            # Rows appended after the partition was built are always scanned
+            ranges.append((ivf_rows, len(generation.vectors)))
+        return [r for r in ranges if r[1] > r[0]]
+
+    def _top_k(self, generation: _Generation, query: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        if not len(generation.vectors):
+            return []
+        query_codes = query.astype(np.float32)
+        best_rows, best_scores = [], []
+        for start, stop in self._probe_ranges(generation, query_codes):
+            for block_start in range(start, stop, self.block_size):
+                block_stop = min(block_start + self.block_size, stop)
+                block = np.asarray(generation.vectors[block_start:block_stop], dtype=np.float32)
+                scores = (block @ query_codes) * generation.scales[block_start:block_stop]
+                take = min(k, len(scores))
+                idx = np.argpartition(-scores, take - 1)[:take]
+                best_rows.append(idx + block_start)
+                best_scores.append(scores[idx])
+        rows = np.concatenate(best_rows)
+        scores = np.concatenate(best_scores)
+        order = np.argsort(-scores)[:k]
+        return [(int(rows[i]), float(scores[i])) for i in order]
+
+    @staticmethod
+    def _read_document(generation: _Generation, row: int) -> Document:
+        record = json.loads(generation.read_line(row).decode("utf-8"))
+        return Document(page_content=record["page_content"], metadata=record.get("metadata", {}))
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        # Rows and their documents come from the same generation, whatever is published meanwhile
+        with self._snapshot() as generation:
+            if generation is None:
+                return []
+            query = _normalize(np.asarray(embedding)[None, :])[0]
+            return [(self._read_document(generation, row), score) for row, score in self._top_k(generation, query, k)]
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        """Stored documents with the given ids, in order; unknown ids are left out"""
+        with self._snapshot() as generation:
+            if generation is None:
+                return []
+            records = [generation.find(doc_id) for doc_id in ids]
+        return [Document(page_content=record["page_content"], metadata=record.get("metadata", {}))
+                for record in records if record is not None]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # Scores are cosine similarities in [-1, 1]
+        return lambda score: (score + 1.0) / 2.0
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   persist_directory: str = "vector_store", dtype: str = "int8", ivf_min_rows: int = 20000,
+                   corpus_key: str = "", **kwargs: Any) -> "QuantizedVectorStore":
+        return cls.open_or_build(embedding, persist_directory, corpus_key, lambda: (texts, metadatas),
+                                 dtype=dtype, ivf_min_rows=ivf_min_rows, **kwargs)
+
+    @classmethod
+    def open_or_build(cls, embedding: Embeddings, persist_directory: str, corpus_key: str,
+                      load: Callable[[], Tuple[List[str], Optional[List[dict]]]], dtype: str = "int8",
+                      ivf_min_rows: int = 20000, sources: Iterable[str] = (), **kwargs: Any) -> "QuantizedVectorStore":
+        """
+        Open the store built for corpus_key, or build it from load() (texts, metadatas)
+
+        Workers starting together wait on the build lock; only the first one calls load(),
+        the others reuse its store without touching the corpus.
+        """
+        store = cls(embedding, persist_directory, dtype=dtype, **kwargs)
+        with store._build_lock():
+            store.refresh()
+            if corpus_key and store.matches_corpus(corpus_key):
+                logger.info(f"Reusing quantized vector store for corpus {corpus_key}")
+            else:
+                texts, metadatas = load()
+                manifest = {"corpus_key": corpus_key, "sources": sorted(os.path.abspath(p) for p in sources if p)}
+                store.add_texts(texts, metadatas, manifest=manifest, replace=True)
+                if len(store) >= ivf_min_rows:
+                    store.build_partition()
+        # Marks the store as in use for prune_stores
+        os.utime(persist_directory)
+        return store
+
+    def clear(self) -> None:
+        with self._build_lock():
+            try:
+                os.remove(self._path(MANIFEST_FILE))
+            except FileNotFoundError:
+                pass
+            self._remove_generations()
+            self.refresh()